@@ -5,12 +5,15 @@ import uuid
 import json
 import base64
 from datetime import datetime
-from io import StringIO
-from typing import Any, Dict, Tuple
+from io import StringIO, BytesIO
+from contextlib import nullcontext
+from typing import Any, Dict, Optional, Tuple
 from flask import Flask, request
 
-from google_pubsub_manager import get_pubsub_manager, Topics
+from google_pubsub_manager import get_pubsub_manager, get_message_deduplicator, Topics, has_payload, read_payload, DUPLICATE_DONE, DUPLICATE_IN_PROGRESS
 from anonymizer import process_anonymization 
+from profiling import JobProfile, profile_payloads
+from metrics import timed, record_processed, payload_stage, payload_size, queue_delay_seconds, observe_queue_delay, update_process_rss, metrics_response
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -42,7 +45,8 @@ class AnonymizationService:
             },
             'differential-privacy': {
                 'parameters': {
-                    'epsilon': {'type': 'float', 'default': 1.0, 'min': 0.1, 'max': 10.0, 'description': 'Privacy budget (epsilon) for differential privacy'}
+                    'epsilon': {'type': 'float', 'default': 1.0, 'min': 0.1, 'max': 10.0, 'description': 'Privacy budget (epsilon) for differential privacy'},
+                    'seed': {'type': 'int', 'default': None, 'description': 'Random seed, makes the noise reproducible (and the result cacheable)'}
                 }
             }
         }
@@ -57,6 +61,10 @@ class AnonymizationService:
                 param_value = params.get(param_name)
                 if param_value is None and 'default' not in param_config:
                     return False, f"Missing required parameter for {method}: {param_name}"
+                if param_value is None:
+                    # An explicit null means the default, like a missing parameter
+                    params[param_name] = param_config.get('default')
+                    continue
                 expected_type = param_config.get('type')
                 if expected_type == 'int' and not isinstance(param_value, int):
                     try:
@@ -86,62 +94,81 @@ class AnonymizationService:
         except Exception as e:
             return False, f"Parameter validation error: {str(e)}"
 
-    def handle_anonymization_request(self, data: Dict[str, Any]):
+    def handle_anonymization_request(self, data: Dict[str, Any], queue_wait_seconds: Optional[float] = None):
         job_id = data.get('job_id')
         method = data.get('method')
         params = data.get('params', {})
         user_id = data.get('user_id')
         user_selections = data.get('user_selections', [])
-        processed_data_content_base64 = data.get('processed_data_content_base64')
-        metadata_content_base64 = data.get('metadata_content_base64')
+        # Jobs analyzed before the Parquet intermediate carry no format tag and are CSV
+        processed_data_format = data.get('processed_data_format', 'csv')
 
-        logger.info(f"Anonymization Service: Processing request for job {job_id} using method {method}")
+        logger.info(f"Anonymization Service: Processing request for job {job_id} using method {method} "
+                    f"({data.get('lane', 'small')} lane, queued for {queue_wait_seconds}s)")
+        # Requested by an operator through the orchestrator, see profiling.py
+        profile = JobProfile(job_id) if data.get('profile') else None
 
         try:
-            is_valid, validation_error = self.validate_anonymization_params(method, params)
-            if not is_valid:
-                raise ValueError(f"Invalid anonymization parameters: {validation_error}")
-            if not processed_data_content_base64 or not metadata_content_base64:
-                raise ValueError("Processed data or metadata content in Base64 is missing.")
-            decoded_processed_data = base64.b64decode(processed_data_content_base64).decode('utf-8')
-            decoded_metadata = base64.b64decode(metadata_content_base64).decode('utf-8')
-            df = pd.read_csv(StringIO(decoded_processed_data))
-            metadata_df = pd.read_json(StringIO(decoded_metadata), orient='records')
+            with profile or nullcontext():
+                is_valid, validation_error = self.validate_anonymization_params(method, params)
+                if not is_valid:
+                    raise ValueError(f"Invalid anonymization parameters: {validation_error}")
+                if not has_payload(data, 'processed_data') or not has_payload(data, 'metadata'):
+                    raise ValueError("Processed data or metadata content is missing.")
+                with timed(payload_stage(data, 'processed_data')):
+                    decoded_processed_data = read_payload(data, 'processed_data')
+                with timed(payload_stage(data, 'metadata')):
+                    decoded_metadata = read_payload(data, 'metadata').decode('utf-8')
+                with timed('parse'):
+                    if processed_data_format == 'parquet':
+                        df = pd.read_parquet(BytesIO(decoded_processed_data), engine='pyarrow')
+                    elif processed_data_format == 'csv':
+                        df = pd.read_csv(StringIO(decoded_processed_data.decode('utf-8')))
+                    else:
+                        raise ValueError(f"Unsupported processed data format: {processed_data_format}")
+                    metadata_df = pd.read_json(StringIO(decoded_metadata), orient='records')
 
-            extended_metadata_data = []
-            for col_name in metadata_df['column_name']:
-                col_info = next((item for item in user_selections if item['column_name'] == col_name), None)
-                is_qi = col_info['is_quasi_identifier'] if col_info else False
-                should_anon = col_info['should_anonymize'] if col_info else False
-                extended_metadata_data.append({
-                    'column_name': col_name,
-                    'data_type': metadata_df[metadata_df['column_name'] == col_name]['data_type'].iloc[0],
-                    'is_quasi_identifier': is_qi,
-                    'should_anonymize': should_anon
+                extended_metadata_data = []
+                for col_name in metadata_df['column_name']:
+                    col_info = next((item for item in user_selections if item['column_name'] == col_name), None)
+                    is_qi = col_info['is_quasi_identifier'] if col_info else False
+                    should_anon = col_info['should_anonymize'] if col_info else False
+                    column_metadata = metadata_df[metadata_df['column_name'] == col_name].iloc[0]
+                    extended_metadata_data.append({
+                        'column_name': col_name,
+                        'data_type': column_metadata['data_type'],
+                        'is_quasi_identifier': is_qi,
+                        'should_anonymize': should_anon,
+                        'stats': column_metadata.get('stats')  # Sketches from the formatter, missing for older jobs
+                    })
+                extended_metadata_df = pd.DataFrame(extended_metadata_data)
+                anonymized_df, error_anonymizer = process_anonymization(df, extended_metadata_df, method, params)
+                if error_anonymizer:
+                    raise ValueError(f"Anonymization failed in core anonymizer: {error_anonymizer}")
+                with timed('serialize'):
+                    anonymized_csv_buffer = StringIO()
+                    anonymized_df.to_csv(anonymized_csv_buffer, index=False)
+                    anonymized_csv_content = anonymized_csv_buffer.getvalue()
+                    # The preview is sent as JSON records so the orchestrator can store it as is
+                    anonymized_preview_json = anonymized_df.head(10).to_json(orient='records', date_format='iso')
+            logger.info(f"Job {job_id}: Anonymization completed.")
+            record_processed(method, len(anonymized_df), payload_size(data, 'processed_data'))
+            with timed('publish'):
+                self.pubsub_manager.publish(Topics.ANONYMIZATION_RESULTS, {
+                    'job_id': job_id,
+                    'status': 'completed',
+                    'anonymized_preview': anonymized_preview_json,
+                    'method_used': method,
+                    'params_used': params,
+                    'user_id': user_id,
+                    'anonymized_at': datetime.now().isoformat(),
+                    # Lets the orchestrator track the queue wait of each size lane
+                    'lane': data.get('lane'),
+                    'queue_wait_seconds': queue_wait_seconds
+                }, attributes={'job_id': job_id}, payloads={
+                    'anonymized_file': anonymized_csv_content.encode('utf-8'),
+                    **profile_payloads(profile)
                 })
-            extended_metadata_df = pd.DataFrame(extended_metadata_data)
-            anonymized_df, error_anonymizer = process_anonymization(df, extended_metadata_df, method, params)
-            if error_anonymizer:
-                raise ValueError(f"Anonymization failed in core anonymizer: {error_anonymizer}")
-            anonymized_csv_buffer = StringIO()
-            anonymized_df.to_csv(anonymized_csv_buffer, index=False)
-            anonymized_csv_content = anonymized_csv_buffer.getvalue()
-            encoded_anonymized_csv = base64.b64encode(anonymized_csv_content.encode('utf-8')).decode('utf-8')
-            anonymized_sample_csv_buffer = StringIO()
-            anonymized_df.head(10).to_csv(anonymized_sample_csv_buffer, index=False)
-            anonymized_sample_csv_content = anonymized_sample_csv_buffer.getvalue()
-            encoded_anonymized_sample_csv = base64.b64encode(anonymized_sample_csv_content.encode('utf-8')).decode('utf-8')
-            logger.info(f"Job {job_id}: Anonymization completed. Content encoded to Base64.")
-            self.pubsub_manager.publish(Topics.ANONYMIZATION_RESULTS, {
-                'job_id': job_id,
-                'status': 'completed',
-                'anonymized_file_content_base64': encoded_anonymized_csv,
-                'anonymized_sample_content_base64': encoded_anonymized_sample_csv,
-                'method_used': method,
-                'params_used': params,
-                'user_id': user_id,
-                'anonymized_at': datetime.now().isoformat()
-            }, attributes={'job_id': job_id})
         except Exception as e:
             logger.error(f"Anonymization Service: Error processing job {job_id}: {e}", exc_info=True)
             self.pubsub_manager.publish(Topics.ERROR_NOTIFICATIONS, {
@@ -150,9 +177,10 @@ class AnonymizationService:
                 'stage': 'anonymization',
                 'error': str(e),
                 'timestamp': datetime.now().isoformat()
-            }, attributes={'job_id': job_id})
+            }, attributes={'job_id': job_id}, payloads=profile_payloads(profile))
 
 service = AnonymizationService()
+deduplicator = get_message_deduplicator()
 
 @app.route("/", methods=["POST"])
 def pubsub_push_handler():
@@ -162,14 +190,37 @@ def pubsub_push_handler():
         return 'Bad Request', 200
     pubsub_message = envelope['message']
     try:
-        payload = base64.b64decode(pubsub_message['data']).decode('utf-8')
-        data = json.loads(payload)
+        with timed('decode'):
+            payload = base64.b64decode(pubsub_message['data']).decode('utf-8')
+            data = json.loads(payload)
         logger.info(f"Received Pub/Sub push: {data}")
-        service.handle_anonymization_request(data.get('data'))  # From pub/sub json extract only the payload relevant for app use
+        message_id = data.get('message_id')
+        job_id = (data.get('data') or {}).get('job_id')
+        # A redelivery of a processed message is acked without doing the work again; one still being processed
+        # (slow ack, or a copy processed elsewhere) is refused, so Pub/Sub retries it once the lease can expire
+        claim = deduplicator.claim(message_id, job_id)
+        if claim == DUPLICATE_DONE:
+            logger.info(f"Duplicate message {message_id} for job {job_id} acked without processing")
+            return ('', 204)
+        if claim == DUPLICATE_IN_PROGRESS:
+            logger.info(f"Message {message_id} for job {job_id} is being processed, redelivery refused")
+            return ('', 409, {'Retry-After': str(int(deduplicator.lease_seconds))})
+        try:
+            queue_wait_seconds = queue_delay_seconds(pubsub_message, data)
+            observe_queue_delay((data.get('data') or {}).get('lane'), queue_wait_seconds)
+            # From pub/sub json extract only the payload relevant for app use
+            service.handle_anonymization_request(data.get('data'), queue_wait_seconds)
+        finally:
+            deduplicator.complete(message_id, job_id)
+            update_process_rss()
     except Exception as e:
         logger.error(f"Failed to process incoming Pub/Sub push: {e}", exc_info=True)
         return 'Bad Request', 200
     return ('', 204)
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return metrics_response()
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file
@@ -12,6 +12,8 @@ import json
 import uuid
 from datetime import datetime, timedelta
 
+from metrics import timed
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -34,6 +36,12 @@ class Anonymizer:
             logger.warning("No user selections found in metadata. Using automatic detection.")
             self.user_qi_selections = {}
             self.user_anon_selections = {}
+
+        # Column statistics computed by the formatter during analysis (sketches), when present
+        self.column_stats = {}
+        if 'stats' in metadata.columns:
+            self.column_stats = {col: stats for col, stats in zip(metadata['column_name'], metadata['stats'])
+                                 if isinstance(stats, dict)}
         
     def anonymize(self):
         """Abstract method to be implemented by subclasses."""
@@ -80,6 +88,33 @@ class Anonymizer:
         else:
             return []
     
+    def set_values(self, mask, col, value):
+        """Assign a replacement value to the masked rows, widening typed columns (e.g. Int64) that cannot hold it."""
+        if mask.any() and not pd.api.types.is_object_dtype(self.df[col]):
+            self.df[col] = self.df[col].astype(object)
+        self.df.loc[mask, col] = value
+
+    def get_distinct_count(self, col):
+        """Return the number of distinct values of a column, estimated from the analysis stats when available."""
+        stats = self.column_stats.get(col)
+        if stats and stats.get('distinct_estimate') is not None:
+            return stats['distinct_estimate']
+        return self.df[col].nunique()
+
+    def get_column_range(self, col):
+        """Return (min, max) of a numeric column, taken from the analysis stats when available."""
+        stats = self.column_stats.get(col)
+        if stats and isinstance(stats.get('min'), (int, float)) and isinstance(stats.get('max'), (int, float)):
+            return stats['min'], stats['max']
+        return self.df[col].min(), self.df[col].max()
+
+    def get_quantile_edges(self, col, n_bins):
+        """Return n_bins + 1 edges at evenly spaced quantiles from the analysis sketch, or None if not available."""
+        quantiles = (self.column_stats.get(col) or {}).get('quantiles')
+        if not quantiles or any(value is None for value in quantiles['values']):
+            return None
+        return np.interp(np.linspace(0, 1, n_bins + 1), quantiles['probs'], quantiles['values'])
+
     def save_result(self, output_path):
         """Save the anonymized dataframe to a CSV file."""
         self.df.to_csv(output_path, index=False)
@@ -116,10 +151,12 @@ class KAnonymityAnonymizer(Anonymizer):
         logger.info(f"Using quasi-identifiers: {quasi_identifiers}")
         
         # Step 1: Generalize only the quasi-identifier columns
-        self._generalize_columns(quasi_identifiers)
+        with timed('generalize'):
+            self._generalize_columns(quasi_identifiers)
         
         # Step 2: Check for k-anonymity and suppress groups smaller than k
-        self._enforce_k_anonymity(quasi_identifiers)
+        with timed('enforce'):
+            self._enforce_k_anonymity(quasi_identifiers)
         
         return self.df
     
@@ -136,23 +173,35 @@ class KAnonymityAnonymizer(Anonymizer):
             if pd.api.types.is_numeric_dtype(self.df[col]):
                 # Generalize numeric columns using binning
                 logger.info(f"Generalizing numeric column: {col}")
-                n_bins = min(10, max(2, self.df[col].nunique() // self.k))
+                n_unique = self.get_distinct_count(col)
+                n_bins = min(10, max(2, n_unique // self.k))
                 
                 # Handle the case where all values are the same
-                if self.df[col].nunique() <= 1:
+                if n_unique <= 1:
                     logger.info(f"Column {col} has only one unique value. Skipping generalization.")
                     continue
                     
                 try:
-                    # Use quantile binning to create more balanced bins
-                    discretizer = KBinsDiscretizer(n_bins=n_bins, encode='ordinal', strategy='quantile')
-                    
-                    # Reshape for sklearn and handle NaN values
-                    values = self.df[col].fillna(self.df[col].mean()).values.reshape(-1, 1)
-                    bins = discretizer.fit_transform(values).flatten()
+                    sketch_edges = self.get_quantile_edges(col, n_bins)
+                    if sketch_edges is not None:
+                        # Quantile bins straight from the analysis sketch, no extra pass to fit them
+                        bin_edges = np.unique(sketch_edges)
+                        if len(bin_edges) < 2:
+                            logger.info(f"Column {col} has a degenerate value range. Skipping generalization.")
+                            continue
+                        values = self.df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+                        bins = np.clip(np.searchsorted(bin_edges[1:-1], values, side='right'), 0, len(bin_edges) - 2)
+                    else:
+                        # Use quantile binning to create more balanced bins
+                        discretizer = KBinsDiscretizer(n_bins=n_bins, encode='ordinal', strategy='quantile')
+                        
+                        # Reshape for sklearn and handle NaN values
+                        numeric_values = self.df[col].astype('float64')
+                        values = numeric_values.fillna(numeric_values.mean()).values.reshape(-1, 1)
+                        bins = discretizer.fit_transform(values).flatten()
+                        bin_edges = discretizer.bin_edges_[0]
                     
                     # Create range labels for the bins
-                    bin_edges = discretizer.bin_edges_[0]
                     bin_labels = [f"{bin_edges[i]:.2f}-{bin_edges[i+1]:.2f}" for i in range(len(bin_edges)-1)]
                     
                     # Map bin indices to labels
@@ -223,12 +272,11 @@ class KAnonymityAnonymizer(Anonymizer):
                 if col in columns_to_anonymize or col in valid_qis:
                     if pd.api.types.is_numeric_dtype(self.df[col]) and col not in valid_qis:
                         # For numeric sensitive attributes, use range suppression
-                        min_val = self.df[col].min()
-                        max_val = self.df[col].max()
-                        self.df.loc[mask, col] = f"[{min_val:.2f}-{max_val:.2f}]"
+                        min_val, max_val = self.get_column_range(col)
+                        self.set_values(mask, col, f"[{min_val:.2f}-{max_val:.2f}]")
                     else:
                         # For quasi-identifiers and text attributes, use generic suppression
-                        self.df.loc[mask, col] = '***SUPPRESSED***'
+                        self.set_values(mask, col, '***SUPPRESSED***')
         else:
             logger.info("All groups satisfy k-anonymity requirement.")
 
@@ -269,8 +317,9 @@ class LDiversityAnonymizer(KAnonymityAnonymizer):
         logger.info(f"Using sensitive attributes: {valid_sensitive}")
         
         # Apply l-diversity for each sensitive attribute
-        for sensitive_attr in valid_sensitive:
-            self._enforce_l_diversity(valid_qis, sensitive_attr)
+        with timed('enforce'):
+            for sensitive_attr in valid_sensitive:
+                self._enforce_l_diversity(valid_qis, sensitive_attr)
             
         return self.df
         
@@ -295,16 +344,19 @@ class LDiversityAnonymizer(KAnonymityAnonymizer):
                 mask = self.df[quasi_identifiers].apply(tuple, axis=1).isin([tuple(g) if isinstance(g, (list, tuple)) else (g,) for g in low_diversity_groups])
             
             # Suppression - replace sensitive attribute values with general category
-            self.df.loc[mask, sensitive_attr] = '***DIVERSE***'
+            self.set_values(mask, sensitive_attr, '***DIVERSE***')
         else:
             logger.info(f"All groups satisfy l-diversity requirement for {sensitive_attr}.")
 
 class DifferentialPrivacyAnonymizer(Anonymizer):
     """Implements differential privacy by adding noise to numeric data."""
     
-    def __init__(self, df, metadata, epsilon=1.0):
+    def __init__(self, df, metadata, epsilon=1.0, seed=None):
         super().__init__(df, metadata)
         self.epsilon = epsilon  # Privacy parameter (smaller = more privacy)
+        # Without a seed the noise differs on every run
+        self.rng = np.random.default_rng(seed)
+        self.random = random.Random(seed)
         
     def anonymize(self):
         logger.info(f"Applying differential privacy with epsilon={self.epsilon}")
@@ -321,23 +373,24 @@ class DifferentialPrivacyAnonymizer(Anonymizer):
         logger.info(f"Preserving: {columns_to_preserve}")
         
         # Apply differential privacy to selected columns
-        for col in columns_to_anonymize:
-            if col in columns_to_preserve:
-                logger.info(f"Skipping {col} - marked for preservation")
-                continue
-                
-            if col not in self.df.columns:
-                logger.warning(f"Column {col} not found in dataset")
-                continue
+        with timed('perturb'):
+            for col in columns_to_anonymize:
+                if col in columns_to_preserve:
+                    logger.info(f"Skipping {col} - marked for preservation")
+                    continue
+                    
+                if col not in self.df.columns:
+                    logger.warning(f"Column {col} not found in dataset")
+                    continue
+                    
+                dtype = self.column_types.get(col, 'unknown')
                 
-            dtype = self.column_types.get(col, 'unknown')
-            
-            # For numerical columns, add Laplace noise
-            if pd.api.types.is_numeric_dtype(self.df[col]):
-                self._add_laplace_noise(col)
-            # For categorical columns, use randomized response
-            elif dtype in ['text', 'alphanumeric', 'email', 'phone_number']:
-                self._apply_randomized_response(col)
+                # For numerical columns, add Laplace noise
+                if pd.api.types.is_numeric_dtype(self.df[col]):
+                    self._add_laplace_noise(col)
+                # For categorical columns, use randomized response
+                elif dtype in ['text', 'alphanumeric', 'email', 'phone_number']:
+                    self._apply_randomized_response(col)
         
         return self.df
     
@@ -354,7 +407,8 @@ class DifferentialPrivacyAnonymizer(Anonymizer):
             logger.info(f"Adding Laplace noise to {column}")
             
             # Calculate sensitivity (using range as a simple approximation)
-            data_range = self.df[column].max() - self.df[column].min()
+            min_val, max_val = self.get_column_range(column)
+            data_range = max_val - min_val
             if data_range == 0:
                 logger.info(f"Column {column} has no variance. Skipping noise addition.")
                 return
@@ -363,7 +417,7 @@ class DifferentialPrivacyAnonymizer(Anonymizer):
             
             # Add Laplace noise to each value
             scale = sensitivity / self.epsilon
-            noise = np.random.laplace(0, scale, size=len(self.df))
+            noise = self.rng.laplace(0, scale, size=len(self.df))
             
             # Add noise to the data
             self.df[column] = self.df[column] + noise
@@ -394,9 +448,9 @@ class DifferentialPrivacyAnonymizer(Anonymizer):
             
             # For each value, decide whether to randomize
             for i in range(len(self.df)):
-                if random.random() < p and not pd.isna(self.df.at[i, column]):
+                if self.random.random() < p and not pd.isna(self.df.at[i, column]):
                     # Randomly select another value from the column
-                    self.df.at[i, column] = random.choice(unique_values)
+                    self.df.at[i, column] = self.random.choice(unique_values)
                         
         except Exception as e:
             logger.error(f"Error applying randomized response to {column}: {e}")
@@ -416,7 +470,7 @@ def process_anonymization(df: pd.DataFrame, metadata: pd.DataFrame, method: str,
             anonymizer = LDiversityAnonymizer(df, metadata, k=k, l=l)
         elif method == "differential-privacy":
             epsilon = params.get("epsilon", 1.0)
-            anonymizer = DifferentialPrivacyAnonymizer(df, metadata, epsilon=epsilon)
+            anonymizer = DifferentialPrivacyAnonymizer(df, metadata, epsilon=epsilon, seed=params.get("seed"))
         else:
             logger.error(f"Unknown anonymization method: {method}")
             return None, "Unknown anonymization method"
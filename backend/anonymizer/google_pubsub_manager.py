@@ -3,11 +3,18 @@
 
 import os
 import json
+import base64
+import time
+import hashlib
 import logging
-from typing import Dict, Any, Optional
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, BinaryIO, Optional, Tuple
 from google.cloud import pubsub_v1
 import uuid
+from io import BytesIO
 from datetime import datetime
+from storage_backend import get_storage_backend
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -18,11 +25,29 @@ if not PROJECT_ID:
     logger.error("GOOGLE_CLOUD_PROJECT_ID environment variable not set. Please set it.")
     raise ValueError("GOOGLE_CLOUD_PROJECT_ID environment variable not set.")
 
+# Payloads larger than this are written to object storage and only a reference travels in the message (claim-check)
+CLAIM_CHECK_THRESHOLD_BYTES = int(os.environ.get('CLAIM_CHECK_THRESHOLD_BYTES', 512 * 1024))
+
+# Redelivered push messages are recognized by their message_id (see MessageDeduplicator).
+# DEDUP_STORE selects the shared record: 'storage' (markers next to the job artifacts) or 'memory' (this process only)
+DEDUP_STORE = os.environ.get('DEDUP_STORE', 'storage')
+DEDUP_MAX_ENTRIES = int(os.environ.get('DEDUP_MAX_ENTRIES', 10000))
+DEDUP_LEASE_SECONDS = int(os.environ.get('DEDUP_LEASE_SECONDS', 900))
+# Outcomes of MessageDeduplicator.claim: process the message, ack a redelivery of a message already
+# processed, or refuse (non-2xx) a redelivery of a message another delivery is still processing, so that
+# Pub/Sub delivers it again later instead of losing it if that delivery never completes
+CLAIMED = 'claimed'
+DUPLICATE_DONE = 'done'
+DUPLICATE_IN_PROGRESS = 'in_progress'
+MESSAGE_MARKERS_FOLDER = 'messages'
+
 # Topics
 class Topics:
     DATA_UPLOAD_REQUESTS = os.environ.get('FORMATTER_INPUT_TOPIC')
     ANALYSIS_RESULTS = os.environ.get('FORMATTER_OUTPUT_TOPIC')
     ANONYMIZATION_REQUESTS = os.environ.get('ANONYMIZER_INPUT_TOPIC')
+    # Large lane: jobs over the size thresholds, processed by their own worker pool (see lanes.py in the orchestrator)
+    ANONYMIZATION_REQUESTS_LARGE = os.environ.get('ANONYMIZER_INPUT_LARGE_TOPIC')
     ANONYMIZATION_RESULTS = os.environ.get('ANONYMIZER_OUTPUT_TOPIC')
     ERROR_NOTIFICATIONS = os.environ.get('ERROR_INFORMATIONS_TOPIC')
 
@@ -39,13 +64,23 @@ class GooglePubSubManager:
     def _full_subscription_name(self, subscription_id: str) -> str:
         return self.subscriber.subscription_path(PROJECT_ID, subscription_id)
 
-    def publish(self, topic_id: str, data: Dict[str, Any], attributes: Optional[Dict[str, str]] = None):
-        """Publish a message to a Pub/Sub topic."""
+    def publish(self, topic_id: str, data: Dict[str, Any], attributes: Optional[Dict[str, str]] = None,
+                payloads: Optional[Dict[str, bytes]] = None):
+        """
+        Publish a message to a Pub/Sub topic.
+        Every entry of payloads is attached to data either inline as '<name>_content_base64' or,
+        above CLAIM_CHECK_THRESHOLD_BYTES, as a '<name>_ref' pointing to object storage. Read it back with read_payload.
+        """
         topic_path = self._full_topic_name(topic_id)
         
         # Add a unique ID and timestamp to the message
         message_id = str(uuid.uuid4())
         timestamp = datetime.now().isoformat()
+
+        if payloads:
+            data = dict(data)
+            for name, content in payloads.items():
+                data.update(attach_payload(name, content, data.get('job_id'), message_id))
         
         # Add meta-information to the message payload
         payload = {
@@ -66,7 +101,7 @@ class GooglePubSubManager:
         future = self.publisher.publish(topic_path, data_json, **attributes)
         future.add_done_callback(lambda future: logger.info(
             f"Published message {message_id} to {topic_id} (job_id: {attributes.get('job_id', 'N/A')}). "
-            f"Message: {data_json.decode('utf-8')}. Result: {future.result()}"
+            f"Size: {len(data_json)} bytes. Result: {future.result()}"
         ))
         
         return message_id
@@ -77,6 +112,162 @@ class GooglePubSubManager:
         self.subscriber.api.transport.close()
         logger.info("Pub/Sub clients closed.")
 
+def attach_payload(name: str, content: bytes, job_id: Optional[str], message_id: str) -> Dict[str, Any]:
+    """Returns the message fields carrying a payload, storing it under the job prefix when it is too big to inline."""
+    if len(content) <= CLAIM_CHECK_THRESHOLD_BYTES:
+        return {f"{name}_content_base64": base64.b64encode(content).decode('utf-8')}
+
+    key = f"{job_id or 'no_job'}/payloads/{message_id}/{name}"
+    get_storage_backend().put_bytes(key, content)
+    logger.info(f"Payload '{name}' of {len(content)} bytes stored at {key} (claim-check)")
+    return payload_reference(name, key, len(content), hashlib.sha256(content).hexdigest())
+
+def payload_reference(name: str, key: str, size: int, sha256: Optional[str] = None) -> Dict[str, Any]:
+    """Message fields referencing an object already in storage, sha256 is omitted when unknown (e.g. composed uploads)."""
+    reference = {"uri": get_storage_backend().uri(key), "size": size}
+    if sha256:
+        reference["sha256"] = sha256
+    return {f"{name}_ref": reference}
+
+def has_payload(data: Dict[str, Any], name: str) -> bool:
+    return f"{name}_ref" in data or f"{name}_content_base64" in data
+
+def read_payload(data: Dict[str, Any], name: str) -> bytes:
+    """Resolves a payload attached by publish, fetching and verifying it when it was passed by reference."""
+    reference = data.get(f"{name}_ref")
+    if reference is None:
+        inline = data.get(f"{name}_content_base64")
+        if inline is None:
+            raise KeyError(f"Message has no '{name}' payload")
+        return base64.b64decode(inline)
+
+    storage = get_storage_backend()
+    content = storage.get_bytes(storage.key_from_uri(reference['uri']))
+    if len(content) != reference['size'] or \
+            ('sha256' in reference and hashlib.sha256(content).hexdigest() != reference['sha256']):
+        raise ValueError(f"Payload '{name}' at {reference['uri']} does not match its checksum")
+    return content
+
+def open_payload(data: Dict[str, Any], name: str) -> BinaryIO:
+    """Seekable binary stream over a payload; referenced payloads are read from storage without loading them whole."""
+    reference = data.get(f"{name}_ref")
+    if reference is None:
+        return BytesIO(read_payload(data, name))
+    storage = get_storage_backend()
+    return storage.open_read(storage.key_from_uri(reference['uri']))
+
+def store_payload(data: Dict[str, Any], name: str, key: str, content_type: Optional[str] = None):
+    """Persists a payload at key without holding it in memory when it was passed by reference (server-side move)."""
+    storage = get_storage_backend()
+    reference = data.get(f"{name}_ref")
+    if reference is not None:
+        storage.move(storage.key_from_uri(reference['uri']), key)
+    else:
+        storage.put_bytes(key, read_payload(data, name), content_type=content_type)
+
+class StorageMessageStore:
+    """
+    Shared de-dup records for services without a database: one small marker object per message under
+    '<job_id>/messages/', created atomically, so redeliveries reaching another instance are recognized
+    too. The markers are deleted with the rest of the job.
+    """
+
+    def _key(self, message_id: str, job_id: str) -> str:
+        return f"{job_id}/{MESSAGE_MARKERS_FOLDER}/{message_id}"
+
+    def claim(self, message_id: str, job_id: str, now: float, lease_seconds: float) -> str:
+        storage = get_storage_backend()
+        key = self._key(message_id, job_id)
+        marker = json.dumps({"state": "processing", "claimed_at": now}).encode('utf-8')
+        if storage.create_if_absent(key, marker):
+            return CLAIMED
+        try:
+            current = json.loads(storage.get_bytes(key))
+        except Exception:
+            return DUPLICATE_IN_PROGRESS
+        if current.get('state') == 'done':
+            return DUPLICATE_DONE
+        if current.get('claimed_at', 0) < now - lease_seconds:
+            # The instance that claimed it did not finish within the lease, most likely it died
+            storage.put_bytes(key, marker)
+            return CLAIMED
+        return DUPLICATE_IN_PROGRESS
+
+    def complete(self, message_id: str, job_id: str):
+        get_storage_backend().put_bytes(self._key(message_id, job_id), json.dumps({"state": "done"}).encode('utf-8'))
+
+class MessageDeduplicator:
+    """
+    Recognizes redelivered push messages by the message_id stamped by publish. Recently seen ids are kept
+    in a bounded in-memory LRU; an optional shared store (StorageMessageStore, or a database table in the
+    orchestrator) also catches redeliveries that reach another instance. A message is claimed while it is
+    processed: a redelivery within DEDUP_LEASE_SECONDS is a duplicate, after that it takes the message over.
+    Only duplicates of processed messages may be acked; one in progress must be refused, see CLAIMED.
+    """
+
+    def __init__(self, store=None, max_entries: int = DEDUP_MAX_ENTRIES, lease_seconds: float = DEDUP_LEASE_SECONDS):
+        self.store = store
+        self.max_entries = max_entries
+        self.lease_seconds = lease_seconds
+        self._entries: 'OrderedDict[str, Tuple[str, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def claim(self, message_id: Optional[str], job_id: Optional[str]) -> str:
+        """CLAIMED if the message has to be processed, otherwise DUPLICATE_DONE or DUPLICATE_IN_PROGRESS."""
+        if not message_id:
+            return CLAIMED
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is not None and (entry[0] == 'done' or entry[1] >= now - self.lease_seconds):
+                self._entries.move_to_end(message_id)
+                self.duplicates += 1
+                return DUPLICATE_DONE if entry[0] == 'done' else DUPLICATE_IN_PROGRESS
+            self._remember(message_id, ('processing', now))
+
+        outcome = self.store.claim(message_id, job_id, now, self.lease_seconds) if self.store is not None and job_id else CLAIMED
+        if outcome != CLAIMED:
+            with self._lock:
+                self.duplicates += 1
+                if outcome == DUPLICATE_DONE:
+                    self._remember(message_id, ('done', now))
+                else:
+                    # Held elsewhere: the next redelivery asks the store again
+                    self._entries.pop(message_id, None)
+        return outcome
+
+    def complete(self, message_id: Optional[str], job_id: Optional[str]):
+        if not message_id:
+            return
+        with self._lock:
+            self._remember(message_id, ('done', time.time()))
+        if self.store is not None and job_id:
+            try:
+                self.store.complete(message_id, job_id)
+            except Exception as e:
+                # The lease still expires, a later redelivery is then processed again
+                logger.warning(f"Could not record message {message_id} as processed: {e}")
+
+    def _remember(self, message_id: str, entry: Tuple[str, float]):
+        self._entries[message_id] = entry
+        self._entries.move_to_end(message_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+_message_deduplicator_instance = None
+
+def get_message_deduplicator() -> MessageDeduplicator:
+    global _message_deduplicator_instance
+    if _message_deduplicator_instance is None:
+        if DEDUP_STORE == 'storage':
+            _message_deduplicator_instance = MessageDeduplicator(StorageMessageStore())
+        elif DEDUP_STORE == 'memory':
+            _message_deduplicator_instance = MessageDeduplicator()
+        else:
+            raise ValueError(f"Unknown DEDUP_STORE: {DEDUP_STORE}")
+    return _message_deduplicator_instance
+
 # Singleton instance for the manager
 _pubsub_manager_instance = None
 
@@ -84,4 +275,11 @@ def get_pubsub_manager() -> GooglePubSubManager:
     global _pubsub_manager_instance
     if _pubsub_manager_instance is None:
         _pubsub_manager_instance = GooglePubSubManager()
-    return _pubsub_manager_instance
\ No newline at end of file
+    return _pubsub_manager_instance
+
+def _reset_after_fork():
+    # gRPC channels do not survive a fork: a forked child creates its own publisher on first use
+    global _pubsub_manager_instance
+    _pubsub_manager_instance = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
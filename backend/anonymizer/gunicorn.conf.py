@@ -0,0 +1,41 @@
+# gunicorn.conf.py
+# Production server for the anonymizer. The anonymization methods are CPU-bound pandas/scikit-learn
+# work, so requests are served by pre-forked sync workers, one per available CPU, each processing one
+# request at a time. Cloud Run's max_instance_request_concurrency must match the number of workers.
+
+import os
+import shutil
+
+def available_cpus() -> int:
+    """CPUs granted by the container CPU quota (cgroup v2), os.cpu_count() reports the host's."""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != 'max':
+            return max(int(int(quota) / int(period)), 1)
+    except (OSError, ValueError):
+        pass
+    return os.cpu_count() or 1
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+worker_class = 'sync'
+workers = int(os.environ.get('GUNICORN_WORKERS', available_cpus()))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 300))
+graceful_timeout = 30
+# The app is imported by each worker after the fork, so the Pub/Sub and storage clients (gRPC channels,
+# HTTP sessions, background threads) are created per process and never shared across a fork
+preload_app = False
+accesslog = '-'
+
+# Each worker writes its Prometheus samples to this directory and /metrics aggregates them (see metrics.py);
+# set here, before the workers import prometheus_client
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus_multiproc')
+
+def on_starting(server):
+    # Samples of a previous run of the container must not be summed with the new ones
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -5,11 +5,14 @@ import json
 import base64
 from datetime import datetime
 from io import StringIO, BytesIO
+from contextlib import nullcontext
 from flask import Flask, request
 from typing import Any, Dict
 
-from google_pubsub_manager import get_pubsub_manager, Topics
-from dataAnalyzer import read_dataset_for_web, structure_dataset 
+from google_pubsub_manager import get_pubsub_manager, get_message_deduplicator, Topics, has_payload, open_payload, DUPLICATE_DONE, DUPLICATE_IN_PROGRESS
+from dataAnalyzer import iter_dataset_chunks, structure_dataset_chunks
+from profiling import JobProfile, profile_payloads
+from metrics import timed, record_processed, payload_size, queue_delay_seconds, observe_queue_delay, update_process_rss, metrics_response
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -17,8 +20,18 @@ logger = logging.getLogger(__name__)
 PROCESSED_DATA_FOLDER = 'processed_data'
 os.makedirs(PROCESSED_DATA_FOLDER, exist_ok=True)
 
+# Intermediate format of the structured dataset sent to the other services.
+# Parquet keeps the dtypes worked out by structure_dataset (Int64, datetime, string) and is compressed.
+PROCESSED_DATA_FORMAT = 'parquet'
+PARQUET_COMPRESSION = os.environ.get('PARQUET_COMPRESSION', 'zstd')
+
 app = Flask(__name__)
 
+def iter_upload_chunks(data: Dict[str, Any], filename: str, report: dict, encoding: str = None):
+    """The uploaded file streamed from storage as DataFrame chunks, re-opened for each structuring pass."""
+    with open_payload(data, 'file') as file_stream:
+        yield from iter_dataset_chunks(file_stream, filename, report=report, encoding=encoding)
+
 class AnalysisService:
     def __init__(self):
         self.pubsub_manager = get_pubsub_manager()
@@ -26,48 +39,53 @@ class AnalysisService:
     def handle_data_upload(self, data: Dict[str, Any]):
         job_id = data.get('job_id')
         filename = data.get('filename')
-        file_content_base64 = data.get('file_content_base64')
         user_id = data.get('user_id')
 
         logger.info(f"Analysis Service: Processing upload for job {job_id}, file {filename}")
+        # Requested by an operator through the orchestrator, see profiling.py
+        profile = JobProfile(job_id) if data.get('profile') else None
 
         try:
-            if not file_content_base64:
-                raise ValueError("No file content received in Base64.")
-
-            decoded_file_content = base64.b64decode(file_content_base64)
-            file_stream = BytesIO(decoded_file_content)
-            df = read_dataset_for_web(file_stream, filename)
-            structured_df, metadata = structure_dataset(df)
-
-            logger.info(f"Job {job_id}: Data structured. Columns: {structured_df.columns.tolist()}")
-
-            processed_csv_buffer = StringIO()
-            structured_df.to_csv(processed_csv_buffer, index=False)
-            processed_csv_content = processed_csv_buffer.getvalue()
-            encoded_processed_csv = base64.b64encode(processed_csv_content.encode('utf-8')).decode('utf-8')
-
-            metadata_json_buffer = StringIO()
-            metadata.to_json(metadata_json_buffer, orient='records', indent=4)
-            metadata_json_content = metadata_json_buffer.getvalue()
-            encoded_metadata_json = base64.b64encode(metadata_json_content.encode('utf-8')).decode('utf-8')
-
-            logger.info(f"Job {job_id}: Processed data and metadata encoded to Base64.")
-
-            self.pubsub_manager.publish(Topics.ANALYSIS_RESULTS, {
-                'job_id': job_id,
-                'status': 'analyzed',
-                'processed_data_content_base64': encoded_processed_csv,
-                'metadata_content_base64': encoded_metadata_json,
-                'user_id': user_id,
-                'filename': filename,
-                'dataset_info': {
-                    'rows': len(structured_df),
-                    'columns': len(structured_df.columns),
-                    'column_types': metadata.groupby('data_type').size().to_dict()
-                },
-                'analyzed_at': datetime.now().isoformat()
-            }, attributes={'job_id': job_id})
+            if not has_payload(data, 'file'):
+                raise ValueError("No file content received.")
+
+            with profile or nullcontext():
+                read_report = {}
+                # Uploads are streamed from storage and read in chunks, all formats share the chunked structuring path;
+                # each structured chunk is written as a Parquet row group as soon as it is converted
+                processed_parquet_buffer = BytesIO()
+                metadata, rows = structure_dataset_chunks(lambda encoding: iter_upload_chunks(data, filename, read_report, encoding),
+                                                          processed_parquet_buffer, compression=PARQUET_COMPRESSION)
+
+                logger.info(f"Job {job_id}: Data structured. Columns: {metadata['column_name'].tolist()}")
+
+                with timed('serialize'):
+                    processed_parquet_content = processed_parquet_buffer.getvalue()
+                    metadata_json_buffer = StringIO()
+                    metadata.to_json(metadata_json_buffer, orient='records', indent=4)
+                    metadata_json_content = metadata_json_buffer.getvalue()
+            logger.info(f"Job {job_id}: Structured data serialized to {PROCESSED_DATA_FORMAT} ({len(processed_parquet_content)} bytes).")
+            record_processed('analysis', rows, payload_size(data, 'file'))
+
+            with timed('publish'):
+                self.pubsub_manager.publish(Topics.ANALYSIS_RESULTS, {
+                    'job_id': job_id,
+                    'status': 'analyzed',
+                    'processed_data_format': PROCESSED_DATA_FORMAT,
+                    'user_id': user_id,
+                    'filename': filename,
+                    'dataset_info': {
+                        'rows': rows,
+                        'columns': len(metadata),
+                        'column_types': metadata.groupby('data_type').size().to_dict(),
+                        'encoding_detection': read_report or None
+                    },
+                    'analyzed_at': datetime.now().isoformat()
+                }, attributes={'job_id': job_id}, payloads={
+                    'processed_data': processed_parquet_content,
+                    'metadata': metadata_json_content.encode('utf-8'),
+                    **profile_payloads(profile)
+                })
 
         except Exception as e:
             logger.error(f"Analysis Service: Error processing job {job_id}: {e}", exc_info=True)
@@ -77,9 +95,10 @@ class AnalysisService:
                 'user_id': user_id,
                 'error': str(e),
                 'timestamp': datetime.now().isoformat()
-            }, attributes={'job_id': job_id})
+            }, attributes={'job_id': job_id}, payloads=profile_payloads(profile))
 
 service = AnalysisService()
+deduplicator = get_message_deduplicator()
 
 @app.route("/", methods=["POST"])
 def pubsub_push_handler():
@@ -89,14 +108,36 @@ def pubsub_push_handler():
         return 'Bad Request', 200
     pubsub_message = envelope['message']
     try:
-        payload = base64.b64decode(pubsub_message['data']).decode('utf-8')
-        data = json.loads(payload)
+        with timed('decode'):
+            payload = base64.b64decode(pubsub_message['data']).decode('utf-8')
+            data = json.loads(payload)
         logger.info(f"Received Pub/Sub push: {data}")
-        service.handle_data_upload(data.get('data'))  # From pub/sub json extract only the payload relevant for app use
+        message_id = data.get('message_id')
+        job_id = (data.get('data') or {}).get('job_id')
+        # A redelivery of a processed message is acked without doing the work again; one still being processed
+        # (slow ack, or a copy processed elsewhere) is refused, so Pub/Sub retries it once the lease can expire
+        claim = deduplicator.claim(message_id, job_id)
+        if claim == DUPLICATE_DONE:
+            logger.info(f"Duplicate message {message_id} for job {job_id} acked without processing")
+            return ('', 204)
+        if claim == DUPLICATE_IN_PROGRESS:
+            logger.info(f"Message {message_id} for job {job_id} is being processed, redelivery refused")
+            return ('', 409, {'Retry-After': str(int(deduplicator.lease_seconds))})
+        try:
+            # Analyses have a single lane, counted with the small one
+            observe_queue_delay(None, queue_delay_seconds(pubsub_message, data))
+            service.handle_data_upload(data.get('data'))  # From pub/sub json extract only the payload relevant for app use
+        finally:
+            deduplicator.complete(message_id, job_id)
+            update_process_rss()
     except Exception as e:
         logger.error(f"Failed to process incoming Pub/Sub push: {e}", exc_info=True)
         return 'Bad Request', 200
     return ('', 204)
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return metrics_response()
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file
@@ -0,0 +1,256 @@
+# column_sketches.py
+# Mergeable per-column sketches computed once during analysis, so that downstream services
+# (anonymizer, UI) can read cardinality, ranges and quantiles from the metadata instead of
+# re-scanning the whole dataset.
+
+import base64
+import numpy as np
+import pandas as pd
+from typing import Any, Dict, List, Optional
+
+# Quantile grid exported in the metadata summary (every 5%)
+QUANTILE_PROBS = [round(i / 20, 2) for i in range(21)]
+HLL_PRECISION = 11
+KLL_K = 128
+# Fixed compaction seed: the same data always yields the same quantiles (and so the same k-anonymity bins)
+KLL_SEED = 0
+TOP_K = 10
+# Misra-Gries keeps more counters than it reports to tighten the count error
+HEAVY_HITTER_COUNTERS = 4 * TOP_K
+
+
+class HyperLogLog:
+    """HyperLogLog cardinality sketch, vectorized over pandas Series."""
+
+    def __init__(self, p: int = HLL_PRECISION, registers: Optional[np.ndarray] = None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = registers if registers is not None else np.zeros(self.m, dtype=np.uint8)
+
+    def update(self, series: pd.Series):
+        if series.empty:
+            return
+        hashes = pd.util.hash_pandas_object(series, index=False).to_numpy(dtype=np.uint64)
+        idx = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        rest = hashes << np.uint64(self.p)
+        # Exact bit length of 'rest': split off the low 11 bits so the float conversion never rounds
+        high = rest >> np.uint64(11)
+        bit_length = np.where(
+            high > 0,
+            np.frexp(high.astype(np.float64))[1] + 11,
+            np.frexp((rest & np.uint64(0x7FF)).astype(np.float64))[1]
+        )
+        rank = np.minimum(64 - bit_length + 1, 64 - self.p + 1).astype(np.uint8)
+        np.maximum.at(self.registers, idx, rank)
+
+    def merge(self, other: 'HyperLogLog'):
+        if other.p != self.p:
+            raise ValueError("Cannot merge HyperLogLog sketches with different precision")
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        raw = alpha * self.m * self.m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * self.m and zeros > 0:
+            # Small range correction (linear counting)
+            return int(round(self.m * np.log(self.m / zeros)))
+        return int(round(raw))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'p': self.p, 'registers': base64.b64encode(self.registers.tobytes()).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'HyperLogLog':
+        registers = np.frombuffer(base64.b64decode(data['registers']), dtype=np.uint8).copy()
+        return cls(p=data['p'], registers=registers)
+
+
+class KLLSketch:
+    """KLL quantile sketch; each level holds items of weight 2**level."""
+
+    def __init__(self, k: int = KLL_K, c: float = 2 / 3, seed: int = KLL_SEED):
+        self.k = k
+        self.c = c
+        self.n = 0
+        self.levels: List[np.ndarray] = [np.empty(0, dtype=np.float64)]
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self.levels) - level - 1
+        return max(int(np.ceil(self.k * (self.c ** depth))), 2)
+
+    def update(self, values: np.ndarray):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return
+        self.n += values.size
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0, dtype=np.float64))
+                items = np.sort(self.levels[level])
+                # An odd item stays behind so that no weight is lost
+                keep = items[-1:] if len(items) % 2 else items[:0]
+                pairs = items[:len(items) - len(keep)]
+                offset = int(self._rng.integers(0, 2))
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], pairs[offset::2]])
+                self.levels[level] = keep
+                # Capacities depend on the height, so restart from the bottom
+                level = 0
+                continue
+            level += 1
+
+    def merge(self, other: 'KLLSketch'):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0, dtype=np.float64))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.n += other.n
+        self._compress()
+
+    def quantiles(self, probs: List[float]) -> List[Optional[float]]:
+        if self.n == 0:
+            return [None for _ in probs]
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items_), 2 ** level, dtype=np.float64)
+                                  for level, items_ in enumerate(self.levels)])
+        order = np.argsort(items, kind='mergesort')
+        items, weights = items[order], weights[order]
+        cumulative = np.cumsum(weights) / weights.sum()
+        positions = np.searchsorted(cumulative, probs, side='left')
+        positions = np.clip(positions, 0, len(items) - 1)
+        return [float(items[pos]) for pos in positions]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'k': self.k, 'n': self.n, 'levels': [items.tolist() for items in self.levels]}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'KLLSketch':
+        sketch = cls(k=data['k'])
+        sketch.n = data['n']
+        sketch.levels = [np.asarray(items, dtype=np.float64) for items in data['levels']] or [np.empty(0)]
+        return sketch
+
+
+class ColumnSketch:
+    """
+    Aggregates all the per-column statistics: count, null count, min/max,
+    HyperLogLog cardinality, KLL quantiles (numeric columns only) and
+    Misra-Gries top-k heavy hitters. Every part is mergeable across chunks.
+    """
+
+    def __init__(self, data_type: str, top_k: int = TOP_K):
+        self.data_type = data_type
+        self.top_k = top_k
+        self.count = 0
+        self.null_count = 0
+        self.min = None
+        self.max = None
+        self.hll = HyperLogLog()
+        self.kll = KLLSketch() if data_type in ('integer', 'float') else None
+        self.heavy_hitters: Dict[str, int] = {}
+
+    def update(self, series: pd.Series):
+        self.count += len(series)
+        nulls = series.isna()
+        self.null_count += int(nulls.sum())
+        values = series[~nulls]
+        if values.empty:
+            return
+
+        self.hll.update(values)
+        if self.kll is not None:
+            self.kll.update(values.to_numpy(dtype=np.float64, na_value=np.nan))
+        if self.data_type in ('integer', 'float', 'datetime'):
+            self._update_range(values.min(), values.max())
+
+        chunk_counts = values.astype(str).value_counts()
+        self._merge_heavy_hitters(chunk_counts.head(HEAVY_HITTER_COUNTERS + 1).to_dict())
+
+    def _update_range(self, low, high):
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def _merge_heavy_hitters(self, counts: Dict[str, int]):
+        merged = dict(self.heavy_hitters)
+        for value, count in counts.items():
+            merged[value] = merged.get(value, 0) + int(count)
+        if len(merged) > HEAVY_HITTER_COUNTERS:
+            # Misra-Gries merge: subtract the (k+1)-th largest counter and drop non-positive ones
+            threshold = sorted(merged.values(), reverse=True)[HEAVY_HITTER_COUNTERS]
+            merged = {value: count - threshold for value, count in merged.items() if count > threshold}
+        self.heavy_hitters = merged
+
+    def merge(self, other: 'ColumnSketch'):
+        self.count += other.count
+        self.null_count += other.null_count
+        if other.min is not None:
+            self._update_range(other.min, other.max)
+        self.hll.merge(other.hll)
+        if self.kll is not None and other.kll is not None:
+            self.kll.merge(other.kll)
+        self._merge_heavy_hitters(other.heavy_hitters)
+
+    @staticmethod
+    def _to_json_scalar(value):
+        if value is None:
+            return None
+        if isinstance(value, pd.Timestamp):
+            return value.isoformat()
+        if isinstance(value, (np.integer, int)):
+            return int(value)
+        return float(value)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Summary used by downstream services, stored in the job metadata. The sketch state (a few KB
+        per column) is left out, see state_dict.
+        """
+        stats = {
+            'count': self.count,
+            'null_count': self.null_count,
+            'distinct_estimate': self.hll.estimate(),
+            'min': self._to_json_scalar(self.min),
+            'max': self._to_json_scalar(self.max),
+            'top_k': [{'value': value, 'count': count} for value, count in
+                      sorted(self.heavy_hitters.items(), key=lambda item: item[1], reverse=True)[:self.top_k]]
+        }
+        if self.kll is not None:
+            values = self.kll.quantiles(QUANTILE_PROBS)
+            if self.min is not None:
+                # The extremes are tracked exactly, no need to approximate them
+                values[0], values[-1] = float(self.min), float(self.max)
+            stats['quantiles'] = {'probs': QUANTILE_PROBS, 'values': values}
+        return stats
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Serialized HLL/KLL state, what from_dict needs on top of the summary to merge the sketch again."""
+        state = {'hll': self.hll.to_dict()}
+        if self.kll is not None:
+            state['kll'] = self.kll.to_dict()
+        return state
+
+    @classmethod
+    def from_dict(cls, data_type: str, stats: Dict[str, Any], state: Optional[Dict[str, Any]] = None) -> 'ColumnSketch':
+        """Rebuilds a sketch from the 'stats' entry of a metadata record, mergeable when its state_dict is given."""
+        sketch = cls(data_type)
+        sketch.count = stats.get('count', 0)
+        sketch.null_count = stats.get('null_count', 0)
+        parse = pd.Timestamp if data_type == 'datetime' else (lambda value: value)
+        if stats.get('min') is not None:
+            sketch.min, sketch.max = parse(stats['min']), parse(stats['max'])
+        sketch.heavy_hitters = {item['value']: item['count'] for item in stats.get('top_k', [])}
+        # Metadata written before the state was split off carries it under 'sketches'
+        sketches = state or stats.get('sketches', {})
+        if 'hll' in sketches:
+            sketch.hll = HyperLogLog.from_dict(sketches['hll'])
+        if sketch.kll is not None and 'kll' in sketches:
+            sketch.kll = KLLSketch.from_dict(sketches['kll'])
+        return sketch
@@ -1,16 +1,104 @@
 # dataAnalyzer.py
 import datetime
+import io
+import os
+import csv
+import gzip
+import json
+import time
+import codecs
+import shutil
+import zipfile
+import tempfile
+import zstandard
+import numpy as np
 import pandas as pd
+import openpyxl
+import pyarrow as pa
+import pyarrow.parquet as pq
 import re
 import argparse
 from pathlib import Path
-import chardet
+from chardet.universaldetector import UniversalDetector
 from io import StringIO, BytesIO # Ensure BytesIO and StringIO are imported
+from column_sketches import ColumnSketch
+from metrics import timed, observe_stage
+
+# Encoding detection never looks past this many bytes, whatever the file size
+ENCODING_DETECTION_BYTE_BUDGET = int(os.environ.get('ENCODING_DETECTION_BYTE_BUDGET', 1024 * 1024))
+# chardet is far slower than UTF-8 validation, so it gets a smaller share of the budget
+CHARDET_BYTE_BUDGET = int(os.environ.get('CHARDET_BYTE_BUDGET', 64 * 1024))
+ENCODING_DETECTION_BLOCK_SIZE = 64 * 1024
+# The whole read restarts with it when the detected encoding turns out to be wrong past the examined prefix,
+# it decodes any byte
+FALLBACK_ENCODING = 'latin-1'
+
+def detect_stream_encoding(stream, byte_budget=ENCODING_DETECTION_BYTE_BUDGET):
+    """
+    Detect the encoding of a binary stream looking only at a bounded prefix.
+    A fast UTF-8 validation runs first; only if it fails chardet's UniversalDetector
+    is fed, block by block, until it is confident or its byte budget is exhausted.
+    Returns a report dict (encoding, confidence, method, bytes_examined, elapsed_ms).
+    The stream is left after the examined prefix, callers must rewind it.
+    """
+    start = time.perf_counter()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    blocks = []
+    bytes_examined = 0
+    detector = None
+    fed_to_detector = 0
+    exhausted = False
+
+    while bytes_examined < byte_budget:
+        block = stream.read(min(ENCODING_DETECTION_BLOCK_SIZE, byte_budget - bytes_examined))
+        if not block:
+            exhausted = True
+            break
+        bytes_examined += len(block)
+        if detector is None:
+            blocks.append(block)
+            try:
+                utf8_decoder.decode(block)
+                continue
+            except UnicodeDecodeError:
+                # Not UTF-8: replay what has been read so far into chardet
+                detector = UniversalDetector()
+                for previous_block in blocks:
+                    detector.feed(previous_block)
+                    if detector.done:
+                        break
+                fed_to_detector = bytes_examined
+                blocks = []
+        else:
+            detector.feed(block)
+            fed_to_detector += len(block)
+        if detector.done or fed_to_detector >= CHARDET_BYTE_BUDGET:
+            break
+
+    if detector is None:
+        prefix_start = b''.join(blocks[:1])[:len(codecs.BOM_UTF8)]
+        encoding = 'utf-8-sig' if prefix_start.startswith(codecs.BOM_UTF8) else 'utf-8'
+        # A valid prefix only proves the whole file is UTF-8 if the file ended within the budget
+        confidence = 1.0 if exhausted else 0.99
+        method = 'utf8-validation'
+    else:
+        detector.close()
+        encoding = detector.result['encoding'] or FALLBACK_ENCODING
+        confidence = detector.result['confidence'] or 0.0
+        method = 'chardet'
+
+    return {
+        'encoding': encoding,
+        'confidence': round(confidence, 3),
+        'method': method,
+        'bytes_examined': bytes_examined,
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 3)
+    }
 
 def detect_file_encoding(file_path):
     """Detect the encoding of a file."""
     with open(file_path, 'rb') as f:
-        result = chardet.detect(f.read())
+        result = detect_stream_encoding(f)
     return result['encoding']
 
 def detect_delimiter(file_path, encoding):
@@ -55,91 +143,529 @@ def read_dataset(file_path):
         print(f"Error reading dataset: {e}")
         raise
 
-def read_dataset_for_web(file_stream: (StringIO | BytesIO), filename: str): # Modified signature
+# Rows per DataFrame chunk produced by the streaming readers
+CHUNK_ROWS = int(os.environ.get('FORMATTER_CHUNK_ROWS', 50000))
+
+BOOLEAN_LIKE_VALUES = ['true', 'false', 'yes', 'no', '1', '0']
+CATEGORICAL_MAX_DISTINCT = 50
+
+def _text_stream(file_stream: BytesIO, encoding: str):
+    """Binary stream -> text stream decoded lazily with the detected encoding."""
+    return io.TextIOWrapper(file_stream, encoding=encoding, newline='')
+
+def _sniff_csv_dialect(text_stream):
+    """Detect delimiter and quote char on the first lines of a text stream, then rewind it."""
+    sample = text_stream.read(ENCODING_DETECTION_BLOCK_SIZE)
+    text_stream.seek(0)
+    # Only whole lines are handed to the sniffer
+    if len(sample) == ENCODING_DETECTION_BLOCK_SIZE and '\n' in sample:
+        sample = sample[:sample.rindex('\n')]
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',\t|;')
+        return dialect.delimiter, dialect.quotechar or '"'
+    except csv.Error:
+        print("Delimiter not found, defaulting to ,")
+        return ',', '"'
+
+def _iter_csv_chunks(file_stream: BytesIO, encoding: str, chunk_rows: int):
+    text_stream = _text_stream(file_stream, encoding)
+    delimiter, quotechar = _sniff_csv_dialect(text_stream)
+    yield from pd.read_csv(text_stream, sep=delimiter, quotechar=quotechar, chunksize=chunk_rows)
+
+def _iter_excel_chunks(file_stream: BytesIO, chunk_rows: int):
+    """Row iteration over the first sheet in openpyxl read-only mode, the workbook is never fully loaded."""
+    workbook = openpyxl.load_workbook(file_stream, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [name if name is not None else f"Unnamed: {i}" for i, name in enumerate(header)]
+        buffer = []
+        for row in rows:
+            buffer.append(row)
+            if len(buffer) >= chunk_rows:
+                yield pd.DataFrame(buffer, columns=columns)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=columns)
+    finally:
+        workbook.close()
+
+def _iter_json_array_records(text_stream, block_size: int = ENCODING_DETECTION_BLOCK_SIZE):
+    """Incrementally decode the objects of a top-level JSON array, keeping only one block in memory."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    while not buffer:
+        block = text_stream.read(block_size)
+        if not block:
+            break
+        buffer = block.lstrip()
+    if not buffer.startswith('['):
+        raise ValueError("Not a JSON array")
+    position = 1
+    while True:
+        # Skip separators, refilling the buffer when needed
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer):
+                break
+            more = text_stream.read(block_size)
+            if not more:
+                raise ValueError("Unterminated JSON array")
+            buffer, position = more, 0
+        if buffer[position] == ']':
+            return
+        while True:
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+                # A value touching the end of the buffer (e.g. a number) may continue in the next block
+                if end < len(buffer):
+                    break
+            except json.JSONDecodeError:
+                pass
+            more = text_stream.read(block_size)
+            if not more:
+                record, end = decoder.raw_decode(buffer, position)
+                break
+            buffer, position = buffer[position:] + more, 0
+        yield record
+        position = end
+
+def _iter_json_chunks(file_stream: BytesIO, encoding: str, chunk_rows: int):
+    text_stream = _text_stream(file_stream, encoding)
+    records = _iter_json_array_records(text_stream)
+    try:
+        first = next(records, None)
+    except ValueError:
+        # Not an array of records (e.g. column oriented): let pandas handle the whole document
+        text_stream.seek(0)
+        yield pd.read_json(text_stream)
+        return
+    if first is None:
+        return
+    buffer = [first]
+    for record in records:
+        buffer.append(record)
+        if len(buffer) >= chunk_rows:
+            yield pd.DataFrame.from_records(buffer)
+            buffer = []
+    if buffer:
+        yield pd.DataFrame.from_records(buffer)
+
+# Compressed uploads are decompressed as a stream, the inner format comes from the remaining extension
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.gzip': 'gzip', '.zst': 'zstd', '.zstd': 'zstd', '.zip': 'zip'}
+# How many decompressed bytes can be re-read after encoding and dialect sniffing
+REPLAY_WINDOW_BYTES = 4 * 1024 * 1024
+# Excel needs random access: decompressed workbooks spill to disk past this size
+EXCEL_SPOOL_MAX_MEMORY = 64 * 1024 * 1024
+
+class ReplayableStream(io.RawIOBase):
     """
-    Read a dataset from a file-like object for web upload.
-    This function handles CSV, Excel, and JSON files by sniffing their format
-    from the filename extension and reads from the provided stream.
+    Wraps a forward-only stream (e.g. a decompressor) and records the first bytes read,
+    so that callers can seek back within that window after sniffing the content.
+    Once more than 'window' bytes have been read the record is dropped and the stream
+    becomes forward-only.
     """
-    file_extension = Path(filename).suffix.lower()
 
-    try:
-        if file_extension == '.csv' or file_extension == '.txt':
-            # For CSV/TXT, assume text stream (StringIO). Pandas can read from BytesIO for CSV as well
-            # if the content is UTF-8, but StringIO is explicit for text.
-            # If the original content for CSV was BytesIO, pd.read_csv can handle it directly.
-            df = pd.read_csv(file_stream, sep=None, engine='python') # sep=None to auto-detect delimiter
+    def __init__(self, raw, window: int = REPLAY_WINDOW_BYTES):
+        self._raw = raw
+        self._window = window
+        self._recorded = bytearray()
+        self._recording = True
+        self._position = 0
 
-        elif file_extension == '.xlsx' or file_extension == '.xls':
-            # For Excel, assume binary stream (BytesIO)
-            df = pd.read_excel(file_stream)
-        elif file_extension == '.json':
-            # For JSON, assume text stream (StringIO)
-            df = pd.read_json(file_stream)
-        # Add other formats if needed
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self._recording
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Only absolute seeks are supported")
+        if not self._recording or offset > len(self._recorded):
+            raise io.UnsupportedOperation("Can only seek within the replay window")
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer):
+        if self._position < len(self._recorded):
+            size = min(len(buffer), len(self._recorded) - self._position)
+            buffer[:size] = self._recorded[self._position:self._position + size]
+            self._position += size
+            return size
+        data = self._raw.read(len(buffer))
+        if not data:
+            return 0
+        size = len(data)
+        buffer[:size] = data
+        self._position += size
+        if self._recording:
+            if len(self._recorded) + size > self._window:
+                self._recording = False
+                self._recorded = bytearray()
+            else:
+                self._recorded += data
+        return size
+
+def open_decompressed(file_stream, filename: str):
+    """
+    Returns (stream, inner_filename, compression) for gzip, zstd and single-entry zip uploads;
+    plain files are returned unchanged with compression None. Nothing is decompressed up front.
+    """
+    path = Path(filename)
+    compression = COMPRESSION_SUFFIXES.get(path.suffix.lower())
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=file_stream, mode='rb'), path.stem, compression
+    elif compression == 'zstd':
+        reader = zstandard.ZstdDecompressor().stream_reader(file_stream, read_across_frames=True)
+        return reader, path.stem, compression
+    elif compression == 'zip':
+        archive = zipfile.ZipFile(file_stream)
+        entries = [entry for entry in archive.infolist()
+                   if not entry.is_dir() and not entry.filename.startswith('__MACOSX/')]
+        if len(entries) != 1:
+            raise ValueError(f"Zip uploads must contain exactly one dataset file, found {len(entries)}")
+        return archive.open(entries[0]), Path(entries[0].filename).name, compression
+    return file_stream, filename, None
+
+def iter_dataset_chunks(file_stream: BytesIO, filename: str, report: dict = None, chunk_rows: int = CHUNK_ROWS,
+                        encoding: str = None):
+    """
+    Stream a dataset from a binary file-like object as DataFrame chunks of at most chunk_rows rows.
+    Supports CSV/TXT, Excel (.xlsx), JSON arrays and NDJSON (.jsonl/.ndjson), optionally
+    compressed with gzip (.gz), zstd (.zst) or as a single-entry .zip; the format is taken
+    from the filename extension. If a 'report' dict is given, it is filled with the
+    compression and encoding detection details.
+    Text is decoded strictly: a UnicodeDecodeError means the detected encoding was wrong past
+    the examined prefix, and the caller restarts the read passing encoding=FALLBACK_ENCODING,
+    which skips the detection.
+    """
+    report = report if report is not None else {}
+    file_stream, filename, compression = open_decompressed(file_stream, filename)
+    file_extension = Path(filename).suffix.lower()
+    if compression:
+        report['compression'] = compression
+        if file_extension in ('.xlsx', '.xls'):
+            # Workbooks are zip containers themselves and need a seekable file
+            spooled = tempfile.SpooledTemporaryFile(max_size=EXCEL_SPOOL_MAX_MEMORY)
+            shutil.copyfileobj(file_stream, spooled)
+            spooled.seek(0)
+            file_stream = spooled
         else:
-            raise ValueError(f"Unsupported file format: {file_extension}")
+            # The decompressed stream is forward-only: keep the sniffed prefix replayable
+            file_stream = io.BufferedReader(ReplayableStream(file_stream))
 
-        return df
+    if encoding is not None:
+        # Restarted read: the encoding detected on the previous attempt is kept in the report
+        report.setdefault('detected_encoding', report.get('encoding'))
+        report['encoding'] = encoding
+    elif file_extension in ('.csv', '.txt', '.json', '.jsonl', '.ndjson'):
+        # Text formats arrive as raw bytes: detect the encoding on a bounded prefix, then rewind
+        report.update(detect_stream_encoding(file_stream))
+        file_stream.seek(0)
+    encoding = report.get('encoding', 'utf-8')
+
+    if file_extension == '.csv' or file_extension == '.txt':
+        yield from _iter_csv_chunks(file_stream, encoding, chunk_rows)
+    elif file_extension == '.xlsx':
+        yield from _iter_excel_chunks(file_stream, chunk_rows)
+    elif file_extension == '.xls':
+        # Legacy binary workbooks have no streaming reader
+        yield pd.read_excel(file_stream)
+    elif file_extension == '.json':
+        yield from _iter_json_chunks(file_stream, encoding, chunk_rows)
+    elif file_extension in ('.jsonl', '.ndjson'):
+        yield from pd.read_json(_text_stream(file_stream, encoding), lines=True, chunksize=chunk_rows)
+    # Add other formats if needed
+    else:
+        raise ValueError(f"Unsupported file format: {file_extension}")
+
+def read_dataset_for_web(file_stream: (StringIO | BytesIO), filename: str, report: dict = None): # Modified signature
+    """
+    Read a dataset from a file-like object for web upload.
+    This function handles CSV, Excel, and JSON files by sniffing their format
+    from the filename extension and reads from the provided stream.
+    If a 'report' dict is given, it is filled with the encoding detection details.
+    """
+    try:
+        if isinstance(file_stream, StringIO):
+            file_stream = BytesIO(file_stream.getvalue().encode('utf-8'))
+        try:
+            chunks = list(iter_dataset_chunks(file_stream, filename, report))
+        except UnicodeDecodeError as e:
+            print(f"Warning: {e}. Reading the whole file again as {FALLBACK_ENCODING}.")
+            file_stream.seek(0)
+            chunks = list(iter_dataset_chunks(file_stream, filename, report, encoding=FALLBACK_ENCODING))
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
     except Exception as e:
         print(f"Error reading dataset for web: {e}")
         raise
 
 def identify_column_type(series):
     """Identify the general type of data in a Pandas Series."""
-    if pd.api.types.is_numeric_dtype(series):
-        if all(series.dropna().apply(lambda x: x == int(x))):
-            return 'integer'
-        return 'float'
-    elif pd.api.types.is_datetime64_any_dtype(series):
-        return 'datetime'
-    # Check for boolean-like strings
-    elif series.astype(str).str.lower().isin(['true', 'false', 'yes', 'no', '1', '0']).any():
-        return 'boolean'
-    elif series.nunique() / len(series) < 0.1 and series.nunique() < 50:
-        return 'categorical'
-    return 'string'
+    evidence = ColumnTypeEvidence()
+    evidence.update(series)
+    return evidence.resolve()
 
-def structure_dataset(df):
+class ColumnTypeEvidence:
     """
-    Structures the dataset by identifying column types and creating a metadata DataFrame.
+    Accumulates, chunk after chunk, what identify_column_type needs to classify a column
+    without holding the whole column: numeric/datetime dtypes, integrality, boolean-like
+    values and a distinct count capped at the categorical threshold.
     """
-    metadata_records = []
-    
-    # Analyze columns for data types and basic statistics
-    for col in df.columns:
-        original_type = identify_column_type(df[col])
-        
-        # Convert columns to appropriate types based on identified type
-        if original_type == 'datetime':
-            # Attempt more robust datetime conversion
-            try:
-                df[col] = pd.to_datetime(df[col], errors='coerce', infer_datetime_format=True)
-            except Exception:
-                # If conversion fails, keep as string and log warning
-                df[col] = df[col].astype(str)
-                original_type = 'string'
-                print(f"Warning: Could not convert column '{col}' to datetime. Keeping as string.")
-        elif original_type == 'integer':
-            # Convert to numeric, then to Int64 to allow NaN
-            df[col] = pd.to_numeric(df[col], errors='coerce').astype(pd.Int64Dtype())
-        elif original_type == 'float':
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-        # For 'boolean', 'categorical', 'string', keep as object or convert to string
+
+    def __init__(self):
+        self.rows = 0
+        self.numeric = True
+        self.integral = True
+        self.datetime = True
+        self.boolean_like = False
+        self.distinct = set()
+        self.distinct_overflow = False
+
+    def update(self, series):
+        self.rows += len(series)
+        if pd.api.types.is_numeric_dtype(series):
+            values = series.dropna()
+            if self.integral and len(values):
+                values = values.to_numpy(dtype='float64')
+                self.integral = bool(np.all(values == np.floor(values)))
         else:
-            df[col] = df[col].astype(str) # Ensure all non-numeric/datetime are strings
-
-        # Add metadata for the column
-        metadata_records.append({
-            'column_name': col,
-            'data_type': original_type,
-            'is_quasi_identifier': False, # Default
-            'should_anonymize': False     # Default
-        })
-    
-    metadata_df = pd.DataFrame(metadata_records)
-    
-    return df, metadata_df
+            self.numeric = False
+        if not pd.api.types.is_datetime64_any_dtype(series):
+            self.datetime = False
+        if not self.boolean_like:
+            self.boolean_like = bool(series.astype(str).str.lower().isin(BOOLEAN_LIKE_VALUES).any())
+        if not self.distinct_overflow:
+            self.distinct.update(series.dropna().unique().tolist())
+            if len(self.distinct) >= CATEGORICAL_MAX_DISTINCT:
+                self.distinct_overflow = True
+                self.distinct = set()
+
+    def resolve(self):
+        if self.numeric:
+            return 'integer' if self.integral else 'float'
+        elif self.datetime:
+            return 'datetime'
+        # Check for boolean-like strings
+        elif self.boolean_like:
+            return 'boolean'
+        elif not self.distinct_overflow and self.rows and len(self.distinct) / self.rows < 0.1:
+            return 'categorical'
+        return 'string'
+
+def _convert_column(series, data_type):
+    """
+    Convert a column (or a chunk of it) to the dtype matching its identified type. The dtype only
+    depends on the type, not on the values of the chunk (e.g. a float column whose chunk holds
+    only integers is still float64), so every chunk matches the schema of parquet_schema.
+    """
+    if data_type == 'datetime':
+        converted = pd.to_datetime(series, errors='coerce')
+        if isinstance(converted.dtype, pd.DatetimeTZDtype):
+            # Timezone-aware values are stored as naive UTC
+            converted = converted.dt.tz_convert(None)
+        return converted.astype('datetime64[ns]')
+    elif data_type == 'integer':
+        # Convert to numeric, then to Int64 to allow NaN
+        return pd.to_numeric(series, errors='coerce').astype(pd.Int64Dtype())
+    elif data_type == 'float':
+        return pd.to_numeric(series, errors='coerce').astype('float64')
+    # For 'boolean', 'categorical', 'string', keep as object or convert to string
+    return series.astype(str) # Ensure all non-numeric/datetime are strings
+
+# A value of each dtype produced by _convert_column, parquet_schema derives the schema from them
+SCHEMA_SAMPLES = {
+    'datetime': lambda: pd.Series([0], dtype='datetime64[ns]'),
+    'integer': lambda: pd.Series([0], dtype=pd.Int64Dtype()),
+    'float': lambda: pd.Series([0.0], dtype='float64'),
+}
+
+def parquet_schema(columns, column_types):
+    """
+    Parquet schema of the structured dataset, built from the identified types: timestamp[ns] for
+    datetime, int64 (restored as Int64 on read) for integer, float64 for float, string otherwise.
+    It carries the pandas metadata, so that reading the file back gives the same dtypes.
+    """
+    sample = pd.DataFrame({
+        col: SCHEMA_SAMPLES.get(column_types[col], lambda: pd.Series([''], dtype=object))()
+        for col in columns
+    }, columns=columns)
+    return pa.Schema.from_pandas(sample, preserve_index=False)
+
+class DatetimeConversionError(Exception):
+    """A column identified as datetime could not be converted, it is structured as string instead."""
+
+    def __init__(self, column):
+        super().__init__(f"Could not convert column '{column}' to datetime")
+        self.column = column
+
+def _timed_reads(chunks):
+    """Yields the chunks, observing the time spent reading them (once per pass) as the 'parse' stage."""
+    chunks = iter(chunks)
+    elapsed = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - started
+            yield chunk
+    finally:
+        observe_stage('parse', elapsed)
+
+def infer_column_types(chunks):
+    """
+    First pass of the chunked structuring path: gathers the type evidence of every column,
+    one chunk at a time. Returns the column names and their identified types. Chunks of
+    records (JSON, NDJSON) may have different keys: the columns are all the keys, in order
+    of first appearance, and the rows without one count as nulls of that column.
+    """
+    columns = None
+    evidence = {}
+    rows = 0
+    for chunk in chunks:
+        if columns is None:
+            columns = []
+        for col in chunk.columns:
+            if col not in evidence:
+                columns.append(col)
+                evidence[col] = ColumnTypeEvidence()
+                if rows:
+                    evidence[col].update(pd.Series(np.nan, index=range(rows)))
+        chunk = chunk.reindex(columns=columns)
+        for col in columns:
+            evidence[col].update(chunk[col])
+        rows += len(chunk)
+    if columns is None:
+        raise ValueError("The dataset is empty.")
+    return columns, {col: evidence[col].resolve() for col in columns}
+
+def _structure_pass(chunks, columns, column_types, write_chunk):
+    """
+    Second pass: converts each chunk to the identified types, feeds fresh column sketches
+    and hands the structured chunk to write_chunk. Returns the sketches and the row count.
+    """
+    sketches = {col: ColumnSketch(column_types[col]) for col in columns}
+    rows = 0
+    for chunk in chunks:
+        # Keys missing from the records of this chunk become null columns
+        chunk = chunk.reindex(columns=columns)
+        structured = {}
+        for col in columns:
+            # Nulls are captured before conversion, astype(str) would turn them into 'nan'
+            null_mask = chunk[col].isna()
+            try:
+                structured[col] = _convert_column(chunk[col], column_types[col])
+            except Exception as e:
+                if column_types[col] != 'datetime':
+                    raise
+                raise DatetimeConversionError(col) from e
+            sketches[col].update(structured[col].mask(null_mask))
+        write_chunk(pd.DataFrame(structured, columns=columns))
+        rows += len(chunk)
+    return sketches, rows
+
+def _keep_as_string(column_types, error):
+    # If datetime conversion fails, keep as string and log warning
+    print(f"Warning: Could not convert column '{error.column}' to datetime. Keeping as string.")
+    column_types[error.column] = 'string'
+
+def _metadata_df(columns, column_types, sketches):
+    return pd.DataFrame([{
+        'column_name': col,
+        'data_type': column_types[col],
+        'is_quasi_identifier': False, # Default
+        'should_anonymize': False,    # Default
+        'stats': sketches[col].to_dict()
+    } for col in columns])
+
+class ParquetChunkWriter:
+    """
+    Writes DataFrame chunks to a binary sink as the row groups of a single Parquet file
+    with the given schema (see parquet_schema); every chunk is converted to it.
+    """
+
+    def __init__(self, sink, schema, compression='snappy'):
+        self.schema = schema
+        self._writer = pq.ParquetWriter(sink, schema, compression=compression)
+
+    def write(self, df):
+        table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        self._writer.write_table(table, row_group_size=max(len(df), 1))
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+def structure_dataset_chunks(open_chunks, sink, compression='snappy'):
+    """
+    Chunked structuring path shared by every reader. open_chunks(encoding) returns a fresh
+    iterator over the raw DataFrame chunks (decoded with encoding, or the detected one when
+    None) and is called once per pass: the first pass gathers the type evidence, the second
+    converts each chunk, feeds the column sketches and writes it to sink as its own Parquet
+    row group, so that only one chunk is in memory at a time. If the detected encoding fails
+    past the examined prefix, the first pass starts over with FALLBACK_ENCODING.
+    Returns the metadata DataFrame and the row count; each metadata record carries a 'stats'
+    entry summarizing the column sketches (cardinality, min/max, quantiles, null count,
+    top-k values).
+    """
+    encoding = None
+    while True:
+        try:
+            with timed('type_inference'):
+                columns, column_types = infer_column_types(_timed_reads(open_chunks(encoding)))
+            break
+        except UnicodeDecodeError as e:
+            if encoding is not None:
+                raise
+            print(f"Warning: {e}. Reading the whole file again as {FALLBACK_ENCODING}.")
+            encoding = FALLBACK_ENCODING
+
+    start = sink.tell()
+    while True:
+        try:
+            with timed('structure'), ParquetChunkWriter(sink, parquet_schema(columns, column_types), compression) as writer:
+                sketches, rows = _structure_pass(_timed_reads(open_chunks(encoding)), columns, column_types, writer.write)
+            break
+        except DatetimeConversionError as e:
+            # The row groups already written hold the column as datetime: the pass starts over
+            _keep_as_string(column_types, e)
+            sink.seek(start)
+            sink.truncate()
+    return _metadata_df(columns, column_types, sketches), rows
+
+def structure_dataset(df):
+    """
+    Structures a whole DataFrame in memory by identifying column types and creating a metadata DataFrame.
+    Returns the structured DataFrame and the metadata DataFrame.
+    """
+    columns, column_types = infer_column_types([df])
+    while True:
+        structured_chunks = []
+        try:
+            sketches, _ = _structure_pass([df], columns, column_types, structured_chunks.append)
+            break
+        except DatetimeConversionError as e:
+            _keep_as_string(column_types, e)
+    return structured_chunks[0], _metadata_df(columns, column_types, sketches)
 
 def save_structured_data(df, metadata_df, output_dir):
     """Save the structured DataFrame and its metadata to specified directory."""
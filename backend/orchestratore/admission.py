@@ -0,0 +1,204 @@
+# admission.py
+# Admission control for the endpoints that create work for the formatter and the anonymizer:
+# a token bucket per user and kind of job (rate and burst from the user's plan), a global cap on the
+# jobs waiting for a worker (counted in the jobs table), and the plan quotas on upload size and rows.
+# Rejections carry a Retry-After. Buckets live in the rate_limit_buckets table so every instance
+# shares them; ADMISSION_BUCKET_STORE=memory keeps them in process for local runs and tests.
+
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+from datetime import datetime, timezone
+from sqlalchemy import text
+from reaper import ANALYSIS_TIMEOUT, ANONYMIZATION_TIMEOUT
+
+ANALYSIS = 'analysis'
+ANONYMIZATION = 'anonymization'
+# Jobs queued for (or being processed by) the worker of each kind
+IN_FLIGHT_STATUSES = {ANALYSIS: 'uploaded', ANONYMIZATION: 'anonymization_requested'}
+# Jobs requested longer ago than the reaper's timeouts are not counted: their worker is given up on
+# (e.g. it died), they must not hold the cap until the reaper marks them as failed
+IN_FLIGHT_MAX_AGE = {ANALYSIS: ANALYSIS_TIMEOUT, ANONYMIZATION: ANONYMIZATION_TIMEOUT}
+IN_FLIGHT_LIMITS = {
+    ANALYSIS: int(os.environ.get('MAX_IN_FLIGHT_ANALYSES', 500)),
+    ANONYMIZATION: int(os.environ.get('MAX_IN_FLIGHT_ANONYMIZATIONS', 500))
+}
+# The in-flight counts are read at most once per this interval per instance
+IN_FLIGHT_REFRESH_SECONDS = 1.0
+IN_FLIGHT_RETRY_AFTER_SECONDS = 30
+MEMORY_BUCKETS_MAX_ENTRIES = 100000
+
+class Plan(NamedTuple):
+    name: str
+    jobs_per_minute: float  # Sustained rate, per kind of job
+    burst: int  # Jobs that can be created back to back
+    max_upload_bytes: int
+    max_rows: int
+
+PLANS = {
+    'free': Plan('free', jobs_per_minute=10, burst=20, max_upload_bytes=200 * 1024 * 1024, max_rows=2000000),
+    'pro': Plan('pro', jobs_per_minute=60, burst=100, max_upload_bytes=2 * 1024 * 1024 * 1024, max_rows=50000000),
+    # Load tests through the noauth routes, only bounded by the in-flight caps
+    'internal': Plan('internal', jobs_per_minute=60000, burst=10000, max_upload_bytes=2 * 1024 * 1024 * 1024, max_rows=50000000)
+}
+DEFAULT_PLAN = os.environ.get('DEFAULT_PLAN', 'free')
+NOAUTH_PLAN = os.environ.get('NOAUTH_PLAN', 'internal')
+
+def plan_named(name: Optional[str]) -> Plan:
+    """The plan of a user (the 'plan' custom claim of their ID token), the default one when unknown."""
+    return PLANS.get(name) or PLANS[DEFAULT_PLAN]
+
+class Rejection(NamedTuple):
+    status: int
+    error: str
+    retry_after: Optional[float] = None
+
+class MemoryBucketStore:
+    """Token buckets in process memory, per instance."""
+
+    def __init__(self, max_entries: int = MEMORY_BUCKETS_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._buckets: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, capacity: float, rate: float, now: float) -> float:
+        """Takes a token, returns 0 on success or the seconds until one is available."""
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            admitted = tokens >= 1
+            if admitted:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_entries:
+                # The least recently used buckets have been refilling the longest
+                self._buckets.popitem(last=False)
+        return 0.0 if admitted else (1 - tokens) / rate
+
+    def peek(self, key: str, capacity: float, rate: float, now: float) -> float:
+        """Like take, without taking the token."""
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+class SQLBucketStore:
+    """Token buckets in the rate_limit_buckets table (see db_migrations.py), refilled and taken by one upsert."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        # Two-argument MIN is the scalar minimum in SQLite, Postgres calls it LEAST
+        least = 'LEAST' if engine.dialect.name == 'postgresql' else 'MIN'
+        refilled = f'{least}(:capacity, rate_limit_buckets.tokens + (:now - rate_limit_buckets.updated_at) * :rate)'
+        self._take = text(f'''
+            INSERT INTO rate_limit_buckets (bucket_key, tokens, updated_at) VALUES (:bucket_key, :capacity - 1, :now)
+            ON CONFLICT (bucket_key) DO UPDATE SET tokens = {refilled} - 1, updated_at = :now
+            WHERE {refilled} >= 1
+            RETURNING tokens
+        ''')
+
+    def take(self, key: str, capacity: float, rate: float, now: float) -> float:
+        params = {"bucket_key": key, "capacity": float(capacity), "rate": rate, "now": now}
+        with self.engine.connect() as conn:
+            admitted = conn.execute(self._take, params).first() is not None
+            conn.commit()
+        # Only a rejected request pays a second statement, to compute its Retry-After
+        return 0.0 if admitted else self.peek(key, capacity, rate, now)
+
+    def peek(self, key: str, capacity: float, rate: float, now: float) -> float:
+        """Like take, without taking the token."""
+        with self.engine.connect() as conn:
+            row = conn.execute(text('SELECT tokens, updated_at FROM rate_limit_buckets WHERE bucket_key = :bucket_key'),
+                               {"bucket_key": key}).first()
+        tokens = min(capacity, row[0] + (now - row[1]) * rate) if row else capacity
+        return max((1 - tokens) / rate, 0.0)
+
+class AdmissionController:
+    def __init__(self, engine, buckets):
+        self.engine = engine
+        self.buckets = buckets
+        self._in_flight: Dict[str, int] = {}
+        self._in_flight_read_at = 0.0
+        self._lock = threading.Lock()
+        self.rejected = {'rate_limited': 0, 'in_flight': 0, 'quota': 0}
+
+    def admit(self, user_id: str, plan: Plan, kind: str) -> Optional[Rejection]:
+        """
+        None when the user can create a job of this kind now, otherwise why not. Admitting takes a token:
+        call it last, once the request is known to be valid.
+        """
+        # Checked first: a job refused because the workers are saturated does not cost the user a token
+        return self._saturated(kind) or self._rate_limited(kind, self.buckets.take(
+            f"{user_id}:{kind}", plan.burst, plan.jobs_per_minute / 60.0, time.time()))
+
+    def precheck(self, user_id: str, plan: Plan, kind: str) -> Optional[Rejection]:
+        """
+        The rejections admit would give, without taking a token: lets a request be refused before its
+        body is parsed, admit then takes the token once the body turned out valid.
+        """
+        return self._saturated(kind) or self._rate_limited(kind, self.buckets.peek(
+            f"{user_id}:{kind}", plan.burst, plan.jobs_per_minute / 60.0, time.time()))
+
+    def _saturated(self, kind: str) -> Optional[Rejection]:
+        if self.in_flight(kind) >= IN_FLIGHT_LIMITS[kind]:
+            self._count('in_flight')
+            return Rejection(503, f"Too many {kind} jobs in progress, try again later", IN_FLIGHT_RETRY_AFTER_SECONDS)
+        return None
+
+    def _rate_limited(self, kind: str, wait_seconds: float) -> Optional[Rejection]:
+        if wait_seconds > 0:
+            self._count('rate_limited')
+            return Rejection(429, f"Too many {kind} requests, try again later", wait_seconds)
+        return None
+
+    def check_upload_size(self, plan: Plan, size: Optional[int]) -> Optional[Rejection]:
+        if size is not None and size > plan.max_upload_bytes:
+            self._count('quota')
+            return Rejection(413, f"File exceeds the {plan.max_upload_bytes} bytes allowed by the {plan.name} plan")
+        return None
+
+    def check_rows(self, plan: Plan, rows: Optional[int]) -> Optional[Rejection]:
+        if rows is not None and rows > plan.max_rows:
+            self._count('quota')
+            return Rejection(413, f"Dataset exceeds the {plan.max_rows} rows allowed by the {plan.name} plan")
+        return None
+
+    def in_flight(self, kind: str) -> int:
+        with self._lock:
+            if time.monotonic() - self._in_flight_read_at >= IN_FLIGHT_REFRESH_SECONDS:
+                # One grouped count over the status index, shared by every request of the interval
+                statuses = {status: kind_name for kind_name, status in IN_FLIGHT_STATUSES.items()}
+                now = datetime.now(timezone.utc)
+                with self.engine.connect() as conn:
+                    rows = conn.execute(text('''
+                        SELECT status, COUNT(*) FROM jobs
+                        WHERE (status = 'uploaded' AND COALESCE(analysis_requested_at, upload_at) >= :analysis_cutoff)
+                           OR (status = 'anonymization_requested'
+                               AND COALESCE(anonymization_requested_at, upload_at) >= :anonymization_cutoff)
+                        GROUP BY status
+                    '''), {"analysis_cutoff": now - IN_FLIGHT_MAX_AGE[ANALYSIS],
+                           "anonymization_cutoff": now - IN_FLIGHT_MAX_AGE[ANONYMIZATION]}).fetchall()
+                self._in_flight = {kind_name: 0 for kind_name in IN_FLIGHT_STATUSES}
+                self._in_flight.update({statuses[status]: count for status, count in rows})
+                self._in_flight_read_at = time.monotonic()
+            return self._in_flight[kind]
+
+    def _count(self, reason: str):
+        with self._lock:
+            self.rejected[reason] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'in_flight': dict(self._in_flight), 'rejected': dict(self.rejected)}
+
+def retry_after_header(seconds: Optional[float]) -> Dict[str, str]:
+    return {'Retry-After': str(max(math.ceil(seconds), 1))} if seconds is not None else {}
+
+def get_bucket_store(engine):
+    if os.environ.get('ADMISSION_BUCKET_STORE', 'sql').lower() == 'memory':
+        return MemoryBucketStore()
+    return SQLBucketStore(engine)
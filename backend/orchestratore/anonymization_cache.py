@@ -0,0 +1,134 @@
+# anonymization_cache.py
+# Content-addressed reuse of anonymization results. The key covers everything the anonymizer output
+# depends on: the analyzed artifact (its SHA-256, recorded when the analysis results arrive), the column
+# names and types, the method, the normalized params and the user selections. A hit links the result of an
+# earlier job to the new one without publishing anything. Randomized methods are only cached when the
+# request carries a seed, and keys are scoped to the user, so a hit never reveals someone else's data.
+
+import json
+import hashlib
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional
+from sqlalchemy import text
+
+from metrics import ANONYMIZATION_CACHE_HITS, ANONYMIZATION_CACHE_MISSES
+
+# Bump when the anonymizer output changes for the same inputs, older entries stop matching
+ANONYMIZATION_CACHE_VERSION = 2
+# Methods whose output is random unless params carries a 'seed'
+RANDOMIZED_METHODS = ('differential-privacy',)
+SELECTION_FIELDS = ('column_name', 'is_quasi_identifier', 'should_anonymize')
+
+class CachedResult(NamedTuple):
+    job_id: str
+    path_file_anonymized: str
+    anonymized_preview: Optional[str]
+
+def _normalize_param(value: Any) -> Any:
+    # '3', 3 and 3.0 are the same parameter once the anonymizer has validated it
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    return value
+
+def _column_types(metadata: Optional[str]) -> List[List[str]]:
+    """
+    Names and types of the columns, all the anonymizer takes from the metadata besides the column
+    statistics, which are derived from the analyzed artifact and so already covered by its hash.
+    """
+    if not metadata:
+        return []
+    return [[str(record.get('column_name')), str(record.get('data_type'))] for record in json.loads(metadata)]
+
+def anonymization_cache_key(user_id: str, analyzed_sha256: Optional[str], metadata: Optional[str], method: str,
+                            params: Optional[Mapping[str, Any]], user_selections: List[Dict[str, Any]]) -> Optional[str]:
+    """The cache key of a request, None when its result cannot be reused."""
+    params = {name: _normalize_param(value) for name, value in (params or {}).items() if value is not None}
+    if not analyzed_sha256 or (method in RANDOMIZED_METHODS and 'seed' not in params):
+        return None
+    selections = sorted(
+        ({field: selection.get(field) for field in SELECTION_FIELDS} for selection in user_selections),
+        key=lambda selection: str(selection['column_name'])
+    )
+    material = json.dumps({
+        "version": ANONYMIZATION_CACHE_VERSION,
+        "user_id": user_id,
+        "analyzed_sha256": analyzed_sha256,
+        "columns": _column_types(metadata),
+        "method": method,
+        "params": params,
+        "user_selections": selections
+    }, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+class AnonymizationCache:
+    """Entries in the anonymization_cache table (see db_migrations.py), pointing at the job holding the result."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+
+    def lookup(self, cache_key: Optional[str]) -> Optional[CachedResult]:
+        if cache_key is None:
+            self._count('uncacheable')
+            return None
+        # Only an entry whose job completed is a hit: pending, failed and deleted jobs are skipped
+        with self.engine.connect() as conn:
+            row = conn.execute(text('''
+                SELECT j.job_id, j.path_file_anonymized, CAST(j.anonymized_preview AS TEXT) AS anonymized_preview
+                FROM anonymization_cache c JOIN jobs j ON j.job_id = c.job_id
+                WHERE c.cache_key = :cache_key AND j.status = 'anonymized' AND j.path_file_anonymized IS NOT NULL
+            '''), {"cache_key": cache_key}).mappings().first()
+        if row is None:
+            self._count('misses')
+            return None
+        return CachedResult(**row)
+
+    def remember(self, cache_key: str, job_id: str):
+        """Points the key at a job about to be anonymized; it becomes a hit once that job completes."""
+        with self.engine.connect() as conn:
+            conn.execute(text('''
+                INSERT INTO anonymization_cache (cache_key, job_id, created_at) VALUES (:cache_key, :job_id, :created_at)
+                ON CONFLICT (cache_key) DO UPDATE SET job_id = excluded.job_id, created_at = excluded.created_at
+            '''), {"cache_key": cache_key, "job_id": job_id, "created_at": datetime.now(timezone.utc)})
+            conn.commit()
+
+    def linked(self):
+        """Counts a hit, once the result found by lookup has been linked to the new job."""
+        self._count('hits')
+
+    def invalidate(self, cache_key: str):
+        """Drops an entry whose result could not be linked after all (e.g. its artifact is gone), it counts as a miss."""
+        self._count('misses')
+        with self.engine.connect() as conn:
+            conn.execute(text('DELETE FROM anonymization_cache WHERE cache_key = :cache_key'), {"cache_key": cache_key})
+            conn.commit()
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        # Per process above (/internal/stats), aggregated over every worker on /metrics
+        if counter == 'hits':
+            ANONYMIZATION_CACHE_HITS.inc()
+        elif counter == 'misses':
+            ANONYMIZATION_CACHE_MISSES.inc()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'uncacheable': self.uncacheable,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None
+            }
@@ -0,0 +1,287 @@
+# db_migrations.py
+# Versioned schema migrations for the orchestrator database. Applied versions are recorded in
+# schema_migrations; on Postgres an advisory lock makes concurrent instance start-ups wait for each other.
+# Postgres is the production database, SQLite is supported for tests and local runs.
+
+import logging
+from datetime import datetime, timezone
+from typing import Callable, List, Tuple
+from sqlalchemy import text
+from job_events import JOB_EVENTS_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_LOCK_ID = 7204061
+# Statuses allowed by migration 2, 'deleted' (soft delete, see reaper.py) was added by migration 6
+TYPED_JOB_STATUSES = ('uploading', 'uploaded', 'analyzed', 'anonymization_requested', 'anonymized', 'error')
+JOB_STATUSES = TYPED_JOB_STATUSES + ('deleted',)
+
+def _status_check(statuses=TYPED_JOB_STATUSES) -> str:
+    return "status IN ({})".format(', '.join(f"'{status}'" for status in statuses))
+
+def _baseline(conn, dialect: str):
+    """The original all-TEXT jobs table plus the version column; a no-op on databases created before migrations."""
+    conn.execute(text('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            user_id TEXT,
+            filename TEXT,
+            rows INTEGER,
+            metadata TEXT,
+            path_file_analyzed TEXT,
+            method TEXT,
+            anonymized_preview TEXT,
+            path_file_anonymized TEXT,
+            upload_at TEXT,
+            completed_at TEXT,
+            status TEXT,
+            error_message TEXT,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    '''))
+    if dialect == 'postgresql':
+        conn.execute(text('ALTER TABLE jobs ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0'))
+
+def _typed_columns(conn, dialect: str):
+    """Timestamps as TIMESTAMPTZ, metadata and preview as JSONB, status restricted to the known values."""
+    if dialect == 'postgresql':
+        conn.execute(text(f'''
+            ALTER TABLE jobs
+                ALTER COLUMN rows TYPE BIGINT,
+                ALTER COLUMN upload_at TYPE TIMESTAMPTZ USING NULLIF(upload_at, '')::timestamptz,
+                ALTER COLUMN completed_at TYPE TIMESTAMPTZ USING NULLIF(completed_at, '')::timestamptz,
+                ALTER COLUMN metadata TYPE JSONB USING NULLIF(metadata, '')::jsonb,
+                ALTER COLUMN anonymized_preview TYPE JSONB USING NULLIF(anonymized_preview, '')::jsonb,
+                ALTER COLUMN user_id SET NOT NULL,
+                ALTER COLUMN status SET NOT NULL,
+                ADD CONSTRAINT jobs_status_check CHECK ({_status_check()})
+        '''))
+        return
+    # SQLite cannot alter column types or add constraints: rebuild the table
+    conn.execute(text(f'''
+        CREATE TABLE jobs_typed (
+            job_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            filename TEXT,
+            rows BIGINT,
+            metadata JSON,
+            path_file_analyzed TEXT,
+            method TEXT,
+            anonymized_preview JSON,
+            path_file_anonymized TEXT,
+            upload_at TIMESTAMP,
+            completed_at TIMESTAMP,
+            status TEXT NOT NULL CHECK ({_status_check()}),
+            error_message TEXT,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    '''))
+    conn.execute(text('INSERT INTO jobs_typed SELECT * FROM jobs'))
+    conn.execute(text('DROP TABLE jobs'))
+    conn.execute(text('ALTER TABLE jobs_typed RENAME TO jobs'))
+
+def _indexes(conn, dialect: str):
+    conn.execute(text('CREATE INDEX IF NOT EXISTS jobs_user_upload_idx ON jobs (user_id, upload_at DESC, job_id DESC)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS jobs_status_idx ON jobs (status)'))
+
+def _change_triggers(conn, dialect: str):
+    """Every update bumps the job version; on Postgres it also notifies the instances listening for changes."""
+    if dialect == 'postgresql':
+        conn.execute(text('''
+            CREATE OR REPLACE FUNCTION jobs_bump_version() RETURNS trigger AS $$
+            BEGIN
+                NEW.version := OLD.version + 1;
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+        '''))
+        conn.execute(text(f'''
+            CREATE OR REPLACE FUNCTION jobs_notify_change() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    PERFORM pg_notify('{JOB_EVENTS_CHANNEL}', OLD.job_id);
+                ELSE
+                    PERFORM pg_notify('{JOB_EVENTS_CHANNEL}', NEW.job_id);
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        '''))
+        conn.execute(text('DROP TRIGGER IF EXISTS jobs_bump_version ON jobs'))
+        conn.execute(text('CREATE TRIGGER jobs_bump_version BEFORE UPDATE ON jobs FOR EACH ROW EXECUTE FUNCTION jobs_bump_version()'))
+        conn.execute(text('DROP TRIGGER IF EXISTS jobs_notify_change ON jobs'))
+        conn.execute(text('CREATE TRIGGER jobs_notify_change AFTER UPDATE OR DELETE ON jobs FOR EACH ROW EXECUTE FUNCTION jobs_notify_change()'))
+    else:
+        # Recursive triggers are off by default in SQLite, the inner UPDATE does not fire it again
+        conn.execute(text('DROP TRIGGER IF EXISTS jobs_bump_version'))
+        conn.execute(text('''
+            CREATE TRIGGER jobs_bump_version AFTER UPDATE ON jobs FOR EACH ROW
+            BEGIN
+                UPDATE jobs SET version = OLD.version + 1 WHERE job_id = NEW.job_id;
+            END
+        '''))
+
+def _processed_messages(conn, dialect: str):
+    """De-dup records of the received Pub/Sub messages (see message_store.py)."""
+    timestamp_type = 'TIMESTAMPTZ' if dialect == 'postgresql' else 'TIMESTAMP'
+    conn.execute(text(f'''
+        CREATE TABLE IF NOT EXISTS processed_messages (
+            message_id TEXT PRIMARY KEY,
+            job_id TEXT,
+            state TEXT NOT NULL CHECK (state IN ('processing', 'done')),
+            claimed_at {timestamp_type} NOT NULL
+        )
+    '''))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS processed_messages_claimed_idx ON processed_messages (claimed_at)'))
+
+def _soft_delete(conn, dialect: str):
+    """'deleted' status and deleted_at: deleted jobs disappear at once and the reaper removes them later."""
+    if dialect == 'postgresql':
+        conn.execute(text(f'''
+            ALTER TABLE jobs
+                ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ,
+                DROP CONSTRAINT IF EXISTS jobs_status_check,
+                ADD CONSTRAINT jobs_status_check CHECK ({_status_check(JOB_STATUSES)})
+        '''))
+    else:
+        # The status CHECK is part of the SQLite table definition: rebuild it, indexes and triggers go with it
+        conn.execute(text(f'''
+            CREATE TABLE jobs_soft_delete (
+                job_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                filename TEXT,
+                rows BIGINT,
+                metadata JSON,
+                path_file_analyzed TEXT,
+                method TEXT,
+                anonymized_preview JSON,
+                path_file_anonymized TEXT,
+                upload_at TIMESTAMP,
+                completed_at TIMESTAMP,
+                status TEXT NOT NULL CHECK ({_status_check(JOB_STATUSES)}),
+                error_message TEXT,
+                version INTEGER NOT NULL DEFAULT 0,
+                deleted_at TIMESTAMP
+            )
+        '''))
+        conn.execute(text('''
+            INSERT INTO jobs_soft_delete (job_id, user_id, filename, rows, metadata, path_file_analyzed, method, anonymized_preview,
+                                          path_file_anonymized, upload_at, completed_at, status, error_message, version)
+            SELECT job_id, user_id, filename, rows, metadata, path_file_analyzed, method, anonymized_preview,
+                   path_file_anonymized, upload_at, completed_at, status, error_message, version
+            FROM jobs
+        '''))
+        conn.execute(text('DROP TABLE jobs'))
+        conn.execute(text('ALTER TABLE jobs_soft_delete RENAME TO jobs'))
+        _indexes(conn, dialect)
+        _change_triggers(conn, dialect)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS jobs_deleted_idx ON jobs (deleted_at) WHERE status = 'deleted'"))
+
+def _anonymization_cache(conn, dialect: str):
+    """SHA-256 of the analyzed artifact and the anonymization result cache (see anonymization_cache.py)."""
+    timestamp_type = 'TIMESTAMPTZ' if dialect == 'postgresql' else 'TIMESTAMP'
+    if dialect == 'postgresql':
+        conn.execute(text('ALTER TABLE jobs ADD COLUMN IF NOT EXISTS analyzed_sha256 TEXT'))
+    else:
+        conn.execute(text('ALTER TABLE jobs ADD COLUMN analyzed_sha256 TEXT'))
+    conn.execute(text(f'''
+        CREATE TABLE IF NOT EXISTS anonymization_cache (
+            cache_key TEXT PRIMARY KEY,
+            job_id TEXT NOT NULL,
+            created_at {timestamp_type} NOT NULL
+        )
+    '''))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS anonymization_cache_job_idx ON anonymization_cache (job_id)'))
+
+def _rate_limit_buckets(conn, dialect: str):
+    """Per user token buckets of the admission control (see admission.py), timestamps as epoch seconds."""
+    number_type = 'DOUBLE PRECISION' if dialect == 'postgresql' else 'REAL'
+    conn.execute(text(f'''
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            bucket_key TEXT PRIMARY KEY,
+            tokens {number_type} NOT NULL,
+            updated_at {number_type} NOT NULL
+        )
+    '''))
+
+def _job_profiles(conn, dialect: str):
+    """Storage key of the job's latest profile, when an operator asked for one (see profiling.py in the workers)."""
+    if dialect == 'postgresql':
+        conn.execute(text('ALTER TABLE jobs ADD COLUMN IF NOT EXISTS path_profile TEXT'))
+    else:
+        conn.execute(text('ALTER TABLE jobs ADD COLUMN path_profile TEXT'))
+
+def _analyzed_size(conn, dialect: str):
+    """Size of the analyzed artifact, recorded with the analysis results to pick the anonymization lane."""
+    if dialect == 'postgresql':
+        conn.execute(text('ALTER TABLE jobs ADD COLUMN IF NOT EXISTS analyzed_size BIGINT'))
+    else:
+        conn.execute(text('ALTER TABLE jobs ADD COLUMN analyzed_size BIGINT'))
+
+def _jsonb_columns(conn, dialect: str):
+    """
+    Metadata and preview back to JSONB on Postgres, where migration 11 had made them JSON (a no-op where it
+    never ran). The compact rendering the responses splice in is produced when the values are read.
+    """
+    if dialect == 'postgresql':
+        conn.execute(text('''
+            ALTER TABLE jobs
+                ALTER COLUMN metadata TYPE JSONB USING metadata::jsonb,
+                ALTER COLUMN anonymized_preview TYPE JSONB USING anonymized_preview::jsonb
+        '''))
+
+def _requested_at(conn, dialect: str):
+    """When the analysis and the anonymization were requested, the reaper times the workers out from them."""
+    timestamp_type = 'TIMESTAMPTZ' if dialect == 'postgresql' else 'TIMESTAMP'
+    for column in ('analysis_requested_at', 'anonymization_requested_at'):
+        if dialect == 'postgresql':
+            conn.execute(text(f'ALTER TABLE jobs ADD COLUMN IF NOT EXISTS {column} {timestamp_type}'))
+        else:
+            conn.execute(text(f'ALTER TABLE jobs ADD COLUMN {column} {timestamp_type}'))
+
+# (version, description, migration); append only, never edit an applied migration
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, 'baseline jobs table', _baseline),
+    (2, 'typed jobs columns', _typed_columns),
+    (3, 'jobs indexes', _indexes),
+    (4, 'job version and change notification triggers', _change_triggers),
+    (5, 'processed messages table', _processed_messages),
+    (6, 'soft deleted jobs', _soft_delete),
+    (7, 'anonymization result cache', _anonymization_cache),
+    (8, 'rate limit buckets', _rate_limit_buckets),
+    (9, 'job profiles', _job_profiles),
+    (10, 'analyzed artifact size', _analyzed_size),
+    # 11 (metadata and preview as JSON) was withdrawn, 13 undoes it where it was applied
+    (12, 'analysis and anonymization request times', _requested_at),
+    (13, 'metadata and preview as JSONB', _jsonb_columns),
+]
+
+def run_migrations(engine):
+    dialect = engine.dialect.name
+    with engine.connect() as conn:
+        if dialect == 'postgresql':
+            # Session level lock, held until released below even across the per-migration commits
+            conn.execute(text('SELECT pg_advisory_lock(:lock_id)'), {"lock_id": MIGRATIONS_LOCK_ID})
+        try:
+            conn.execute(text('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP NOT NULL
+                )
+            '''))
+            conn.commit()
+            applied = {row[0] for row in conn.execute(text('SELECT version FROM schema_migrations'))}
+            for version, description, migration in MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info(f"Applying database migration {version}: {description}")
+                migration(conn, dialect)
+                conn.execute(text('INSERT INTO schema_migrations (version, description, applied_at) VALUES (:version, :description, :applied_at)'),
+                             {"version": version, "description": description, "applied_at": datetime.now(timezone.utc)})
+                conn.commit()
+        finally:
+            if dialect == 'postgresql':
+                conn.rollback()
+                conn.execute(text('SELECT pg_advisory_unlock(:lock_id)'), {"lock_id": MIGRATIONS_LOCK_ID})
+                conn.commit()
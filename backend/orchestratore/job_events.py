@@ -0,0 +1,90 @@
+# job_events.py
+# Wakes up requests waiting for a job to change (long-poll and Server-Sent Events).
+# Changes made by this instance are signalled directly; changes made by other instances arrive
+# through Postgres LISTEN/NOTIFY, fired by a trigger on the jobs table.
+
+import os
+import time
+import select
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Set
+
+logger = logging.getLogger(__name__)
+
+JOB_EVENTS_CHANNEL = 'job_status'
+LISTENER_RECONNECT_SECONDS = 5
+
+class JobEventHub:
+    def __init__(self):
+        self._waiters: Dict[str, Set[threading.Event]] = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, callback: Callable[[str], None]):
+        """Callback invoked with the job_id on every change, e.g. to invalidate caches."""
+        self._listeners.append(callback)
+
+    def notify(self, job_id: str):
+        for callback in self._listeners:
+            callback(job_id)
+        with self._lock:
+            waiters = self._waiters.pop(job_id, ())
+        for event in waiters:
+            event.set()
+
+    @contextmanager
+    def subscribe(self, job_id: str) -> Iterator[threading.Event]:
+        """
+        Event set by the next change of the job, while the block is running. Subscribe first, then
+        read the job, then wait on the event: a change made in between sets it instead of being missed.
+        """
+        event = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(job_id, set()).add(event)
+        try:
+            yield event
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(job_id)
+                if waiters is not None:
+                    waiters.discard(event)
+                    if not waiters:
+                        del self._waiters[job_id]
+
+def _listen_forever(engine, hub: JobEventHub):
+    while True:
+        connection = None
+        try:
+            # A dedicated connection outside of the pool, LISTEN needs it to stay open
+            connection = engine.raw_connection()
+            driver_connection = connection.driver_connection
+            driver_connection.autocommit = True
+            with driver_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {JOB_EVENTS_CHANNEL}")
+            logger.info(f"Listening for job changes on channel {JOB_EVENTS_CHANNEL}")
+            while True:
+                if select.select([driver_connection], [], [], LISTENER_RECONNECT_SECONDS) == ([], [], []):
+                    continue
+                driver_connection.poll()
+                while driver_connection.notifies:
+                    notification = driver_connection.notifies.pop(0)
+                    hub.notify(notification.payload)
+        except Exception as e:
+            logger.warning(f"Job change listener disconnected: {e}, reconnecting in {LISTENER_RECONNECT_SECONDS}s")
+            time.sleep(LISTENER_RECONNECT_SECONDS)
+        finally:
+            if connection is not None:
+                try:
+                    connection.invalidate()
+                except Exception:
+                    pass
+
+def start_listener(engine, hub: JobEventHub):
+    """Starts the LISTEN thread; only Postgres supports it, other databases rely on local notifications."""
+    if engine.dialect.name != 'postgresql' or os.environ.get('JOB_EVENTS_LISTENER', 'true').lower() != 'true':
+        return None
+    thread = threading.Thread(target=_listen_forever, args=(engine, hub), name='job-events-listener', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,117 @@
+# job_state.py
+# Job reads and writes in one statement each. Status transitions are conditional updates
+# (UPDATE ... WHERE job_id = :job_id AND status IN :allowed [AND user_id = :user_id] RETURNING ...),
+# so ownership and the current status are checked by the same round trip that applies the change,
+# and concurrent or repeated requests cannot apply the same transition twice.
+
+import time
+import secrets
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional
+from sqlalchemy import bindparam, text
+
+NOT_FOUND = 'not_found'
+FORBIDDEN = 'forbidden'
+CONFLICT = 'conflict'
+
+# Job ids are ULIDs: 48-bit millisecond timestamp + 80 random bits in Crockford base32, so they sort by creation time
+CROCKFORD_BASE32 = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+def new_job_id() -> str:
+    value = (int(time.time() * 1000) << 80) | secrets.randbits(80)
+    return ''.join(CROCKFORD_BASE32[(value >> shift) & 31] for shift in range(125, -1, -5))
+
+def job_id_created_at(job_id: str) -> Optional[datetime]:
+    """Creation time encoded in a job id: ULIDs carry it in the first 10 characters, older ids end with %Y%m%d%H%M%S."""
+    try:
+        if len(job_id) == 26:
+            milliseconds = 0
+            for character in job_id[:10]:
+                milliseconds = milliseconds * 32 + CROCKFORD_BASE32.index(character)
+            return datetime.fromtimestamp(milliseconds / 1000, timezone.utc)
+        return datetime.strptime(job_id[-14:], '%Y%m%d%H%M%S').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+class JobResult(NamedTuple):
+    """The job row (or the RETURNING columns) on success; on failure the error and, for conflicts, the current row."""
+    job: Optional[Mapping[str, Any]]
+    error: Optional[str] = None
+
+class JobStore:
+    def __init__(self, engine, columns: str, on_change: Callable[[str], None] = lambda job_id: None):
+        self.engine = engine
+        self.columns = columns
+        # Called with the job_id after every applied write (e.g. to wake up status watchers)
+        self.on_change = on_change
+
+    def get(self, job_id: str, user_id: Optional[str] = None, statuses: Optional[Iterable[str]] = None,
+            columns: Optional[str] = None) -> JobResult:
+        with self.engine.connect() as conn:
+            job = conn.execute(text(f'SELECT {columns or self.columns} FROM jobs WHERE job_id = :job_id'),
+                               {"job_id": job_id}).mappings().first()
+        return self._check(job, user_id, statuses)
+
+    def create(self, values: Dict[str, Any]):
+        names = ', '.join(values)
+        placeholders = ', '.join(f':{name}' for name in values)
+        with self.engine.connect() as conn:
+            conn.execute(text(f'INSERT INTO jobs ({names}) VALUES ({placeholders})'), values)
+            conn.commit()
+
+    def transition(self, job_id: str, to_status: str, allowed: Iterable[str], user_id: Optional[str] = None,
+                   values: Optional[Dict[str, Any]] = None, returning: str = 'job_id') -> JobResult:
+        """
+        Moves the job to to_status if its status is one of allowed (and it belongs to user_id, when given),
+        also setting the other columns in values. A job already in to_status is a conflict, which makes
+        redelivered messages and retried requests no-ops.
+        """
+        values = values or {}
+        assignments = ', '.join(['status = :to_status'] + [f'{name} = :value_{name}' for name in values])
+        owner_filter = 'AND user_id = :user_id' if user_id is not None else ''
+        statement = text(f'''
+            UPDATE jobs SET {assignments}
+            WHERE job_id = :job_id AND status IN :allowed {owner_filter}
+            RETURNING {returning}
+        ''').bindparams(bindparam('allowed', expanding=True))
+        params = {"job_id": job_id, "to_status": to_status, "allowed": list(allowed), "user_id": user_id}
+        params.update({f'value_{name}': value for name, value in values.items()})
+        with self.engine.connect() as conn:
+            job = conn.execute(statement, params).mappings().first()
+            if job is None:
+                # Only the failure path pays a second statement, to tell the caller why
+                return self._explain(conn, job_id, user_id)
+            conn.commit()
+        self.on_change(job_id)
+        return JobResult(job)
+
+    def mark_deleted(self, job_ids: List[str], user_id: str) -> List[str]:
+        """Soft delete: the jobs disappear at once, their artifacts and rows are removed by the reaper. Returns the ids marked."""
+        with self.engine.connect() as conn:
+            rows = conn.execute(text('''
+                UPDATE jobs SET status = 'deleted', deleted_at = :deleted_at
+                WHERE job_id IN :job_ids AND user_id = :user_id AND status <> 'deleted'
+                RETURNING job_id
+            ''').bindparams(bindparam('job_ids', expanding=True)),
+                {"job_ids": list(job_ids), "user_id": user_id, "deleted_at": datetime.now(timezone.utc)}).fetchall()
+            conn.commit()
+        deleted = [row[0] for row in rows]
+        for job_id in deleted:
+            self.on_change(job_id)
+        return deleted
+
+    def _explain(self, conn, job_id: str, user_id: Optional[str]) -> JobResult:
+        job = conn.execute(text('SELECT job_id, user_id, status FROM jobs WHERE job_id = :job_id'),
+                           {"job_id": job_id}).mappings().first()
+        result = self._check(job, user_id)
+        return result if result.error else JobResult(job, CONFLICT)
+
+    @staticmethod
+    def _check(job, user_id: Optional[str], statuses: Optional[Iterable[str]] = None) -> JobResult:
+        if job is None or job['status'] == 'deleted':
+            return JobResult(None, NOT_FOUND)
+        if user_id is not None and job['user_id'] != user_id:
+            return JobResult(None, FORBIDDEN)
+        if statuses is not None and job['status'] not in statuses:
+            return JobResult(job, CONFLICT)
+        return JobResult(job)
@@ -0,0 +1,64 @@
+# lanes.py
+# Size-aware routing of anonymization jobs. Row count and analyzed dataset size are known once the
+# analysis is done, so each request is classified and published to the topic of its lane: small jobs
+# to the latency-oriented pool (warm instances, SLO on the queue wait), large ones to the
+# throughput-oriented pool, where they cannot block interactive users. The anonymizer reports how long
+# each job waited in its queue and the waits are aggregated per lane.
+
+import os
+import threading
+from collections import deque
+from typing import Dict, Optional
+
+SMALL_LANE = 'small'
+LARGE_LANE = 'large'
+LARGE_JOB_ROWS = int(os.environ.get('LARGE_JOB_ROWS', 1000000))
+LARGE_JOB_BYTES = int(os.environ.get('LARGE_JOB_BYTES', 100 * 1024 * 1024))
+SMALL_LANE_QUEUE_WAIT_SLO_SECONDS = float(os.environ.get('SMALL_LANE_QUEUE_WAIT_SLO_SECONDS', 10))
+# Percentiles are computed over the most recent waits of each lane
+QUEUE_WAIT_WINDOW = 1000
+
+def anonymization_lane(rows: Optional[int], size_bytes: Optional[int]) -> str:
+    if (rows or 0) > LARGE_JOB_ROWS or (size_bytes or 0) > LARGE_JOB_BYTES:
+        return LARGE_LANE
+    return SMALL_LANE
+
+def lane_topic(topics, lane: str) -> str:
+    """Topic of a lane; without a large lane topic configured every job goes to the single input topic."""
+    if lane == LARGE_LANE and topics.ANONYMIZATION_REQUESTS_LARGE:
+        return topics.ANONYMIZATION_REQUESTS_LARGE
+    return topics.ANONYMIZATION_REQUESTS
+
+class QueueWaitStats:
+    """Queue wait of the anonymization jobs per lane, as reported with their results."""
+
+    def __init__(self, window: int = QUEUE_WAIT_WINDOW):
+        self.window = window
+        self._waits: Dict[str, deque] = {}
+        self._counts: Dict[str, int] = {}
+        self._slo_misses = 0
+        self._lock = threading.Lock()
+
+    def record(self, lane: str, wait_seconds: float):
+        with self._lock:
+            self._waits.setdefault(lane, deque(maxlen=self.window)).append(wait_seconds)
+            self._counts[lane] = self._counts.get(lane, 0) + 1
+            if lane == SMALL_LANE and wait_seconds > SMALL_LANE_QUEUE_WAIT_SLO_SECONDS:
+                self._slo_misses += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lanes = {}
+            for lane, waits in self._waits.items():
+                ordered = sorted(waits)
+                lanes[lane] = {
+                    'jobs': self._counts[lane],
+                    'p50_seconds': round(ordered[len(ordered) // 2], 3),
+                    'p95_seconds': round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)], 3),
+                    'max_seconds': round(ordered[-1], 3)
+                }
+            return {
+                'lanes': lanes,
+                'small_lane_slo_seconds': SMALL_LANE_QUEUE_WAIT_SLO_SECONDS,
+                'small_lane_slo_misses': self._slo_misses
+            }
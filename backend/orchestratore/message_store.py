@@ -0,0 +1,57 @@
+# message_store.py
+# Shared de-dup records of the Pub/Sub messages received by the orchestrator, in the processed_messages
+# table (see db_migrations.py), so a redelivery reaching any instance is recognized. Used as the store of
+# google_pubsub_manager.MessageDeduplicator.
+
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+from google_pubsub_manager import CLAIMED, DUPLICATE_DONE, DUPLICATE_IN_PROGRESS
+
+# Pub/Sub does not redeliver messages older than its 7 days retention, their records can go
+MESSAGE_RECORD_RETENTION = timedelta(days=7)
+PURGE_EVERY_CLAIMS = 1000
+
+class SQLMessageStore:
+    def __init__(self, engine):
+        self.engine = engine
+        self._claims = 0
+
+    def claim(self, message_id: str, job_id: str, now: float, lease_seconds: float) -> str:
+        # New message, or one whose processing lease expired: a single upsert decides which
+        statement = text('''
+            INSERT INTO processed_messages (message_id, job_id, state, claimed_at)
+            VALUES (:message_id, :job_id, 'processing', :claimed_at)
+            ON CONFLICT (message_id) DO UPDATE SET claimed_at = excluded.claimed_at
+            WHERE processed_messages.state = 'processing' AND processed_messages.claimed_at < :lease_expired
+            RETURNING message_id
+        ''')
+        claimed_at = datetime.fromtimestamp(now, timezone.utc)
+        with self.engine.connect() as conn:
+            claimed = conn.execute(statement, {
+                "message_id": message_id,
+                "job_id": job_id,
+                "claimed_at": claimed_at,
+                "lease_expired": claimed_at - timedelta(seconds=lease_seconds)
+            }).first() is not None
+            conn.commit()
+            if not claimed:
+                # Only duplicates pay a second statement: a processed message is acked, one in progress refused
+                state = conn.execute(text('SELECT state FROM processed_messages WHERE message_id = :message_id'),
+                                     {"message_id": message_id}).scalar()
+        self._claims += 1
+        if self._claims % PURGE_EVERY_CLAIMS == 0:
+            self.purge(claimed_at - MESSAGE_RECORD_RETENTION)
+        if claimed:
+            return CLAIMED
+        return DUPLICATE_DONE if state == 'done' else DUPLICATE_IN_PROGRESS
+
+    def complete(self, message_id: str, job_id: str):
+        with self.engine.connect() as conn:
+            conn.execute(text("UPDATE processed_messages SET state = 'done' WHERE message_id = :message_id"),
+                         {"message_id": message_id})
+            conn.commit()
+
+    def purge(self, older_than: datetime):
+        with self.engine.connect() as conn:
+            conn.execute(text('DELETE FROM processed_messages WHERE claimed_at < :older_than'), {"older_than": older_than})
+            conn.commit()
@@ -0,0 +1,119 @@
+# metrics.py
+# Prometheus metrics of the backend services, served on /metrics by each of them. Shared verbatim by
+# the formatter, the anonymizer and the orchestrator, like google_pubsub_manager.py and storage_backend.py.
+# Every label takes its values from a fixed set (stage, method, outcome, lane) so the number of series
+# stays bounded whatever the traffic. Under gunicorn with several workers, PROMETHEUS_MULTIPROC_DIR
+# (set in gunicorn.conf.py) makes /metrics aggregate the samples of every worker process.
+
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from flask import Response
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+
+# Internal processing stages; 'parse' covers every upload format, 'perturb' is the differential privacy noise
+STAGES = ('decode', 'parse', 'type_inference', 'structure', 'generalize', 'enforce', 'perturb', 'serialize',
+          'publish', 'db_query', 'storage_upload', 'storage_download')
+METHODS = ('analysis', 'k-anonymity', 'l-diversity', 'differential-privacy')
+LANES = ('small', 'large')
+OTHER = 'other'
+# From sub-millisecond DB queries to multi-minute anonymizations of the large lane
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 3600)
+
+STAGE_SECONDS = Histogram('anonimadata_stage_seconds', 'Duration of an internal processing stage',
+                          ['stage', 'outcome'], buckets=LATENCY_BUCKETS)
+ROWS_PROCESSED = Counter('anonimadata_rows_processed_total', 'Dataset rows processed (rate() gives rows/sec)', ['method'])
+BYTES_PROCESSED = Counter('anonimadata_bytes_processed_total', 'Dataset bytes processed (rate() gives bytes/sec)', ['method'])
+QUEUE_TO_START_SECONDS = Histogram('anonimadata_queue_to_start_seconds',
+                                   'Delay between the publication of a message and the start of its processing',
+                                   ['lane'], buckets=LATENCY_BUCKETS)
+# livesum: the RSS of all the live worker processes of the instance
+PROCESS_RSS_BYTES = Gauge('anonimadata_process_resident_memory_bytes', 'Resident memory of the service processes',
+                          multiprocess_mode='livesum')
+# Orchestrator only: hit rate = rate(hits) / (rate(hits) + rate(misses)); requests that cannot be cached are neither
+ANONYMIZATION_CACHE_HITS = Counter('anonimadata_anonymization_cache_hits_total',
+                                   'Anonymization requests served with the result of an identical earlier request')
+ANONYMIZATION_CACHE_MISSES = Counter('anonimadata_anonymization_cache_misses_total',
+                                     'Cacheable anonymization requests that had to be computed')
+
+def _bounded(value: Optional[str], allowed) -> str:
+    return value if value in allowed else OTHER
+
+@contextmanager
+def timed(stage: str):
+    """Times the enclosed block as one observation of stage, with outcome 'error' when it raises."""
+    if stage not in STAGES:
+        raise ValueError(f"Unknown metrics stage: {stage}")
+    started = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except BaseException:
+        outcome = 'error'
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage=stage, outcome=outcome).observe(time.perf_counter() - started)
+
+def observe_stage(stage: str, seconds: float, outcome: str = 'ok'):
+    """For durations measured elsewhere (e.g. database cursor events)."""
+    STAGE_SECONDS.labels(stage=stage, outcome=outcome).observe(seconds)
+
+def record_processed(method: Optional[str], rows: int, size_bytes: int):
+    method = _bounded(method, METHODS)
+    ROWS_PROCESSED.labels(method=method).inc(rows)
+    BYTES_PROCESSED.labels(method=method).inc(size_bytes)
+
+def payload_stage(data: Dict[str, Any], name: str) -> str:
+    """Reading a payload is a storage download when it was passed by reference, a base64 decode otherwise."""
+    return 'storage_download' if f"{name}_ref" in data else 'decode'
+
+def payload_size(data: Dict[str, Any], name: str) -> int:
+    """Size in bytes of a payload attached by publish, without decoding it."""
+    reference = data.get(f"{name}_ref")
+    if reference is not None:
+        return int(reference.get('size', 0))
+    inline = data.get(f"{name}_content_base64") or ''
+    return len(inline) * 3 // 4 - inline[-2:].count('=')
+
+def queue_delay_seconds(pubsub_message: Dict[str, Any], message_data: Dict[str, Any]) -> Optional[float]:
+    """
+    Time between the publication of a push message and now: from the Pub/Sub publish time (RFC 3339, UTC,
+    up to nanoseconds) or else from the 'timestamp' publish adds to every message (local time, UTC on Cloud Run).
+    """
+    try:
+        publish_time = pubsub_message.get('publish_time') or pubsub_message.get('publishTime')
+        if publish_time:
+            seconds, _, fraction = publish_time.rstrip('Z').partition('.')
+            published = datetime.fromisoformat(f"{seconds}.{fraction[:6].ljust(6, '0')}").replace(tzinfo=timezone.utc)
+        elif message_data.get('timestamp'):
+            published = datetime.fromisoformat(message_data['timestamp']).replace(tzinfo=timezone.utc)
+        else:
+            return None
+    except (TypeError, ValueError):
+        return None
+    return max((datetime.now(timezone.utc) - published).total_seconds(), 0.0)
+
+def observe_queue_delay(lane: Optional[str], seconds: Optional[float]):
+    if seconds is not None:
+        QUEUE_TO_START_SECONDS.labels(lane=_bounded(lane or 'small', LANES)).observe(seconds)
+
+def update_process_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            resident_pages = int(statm.read().split()[1])
+        PROCESS_RSS_BYTES.set(resident_pages * os.sysconf('SC_PAGE_SIZE'))
+    except (OSError, ValueError, IndexError):
+        pass
+
+def metrics_response() -> Response:
+    update_process_rss()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
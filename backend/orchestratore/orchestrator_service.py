@@ -1,65 +1,244 @@
-from flask import Flask, request, jsonify, send_file
-import pandas as pd
+from flask import Flask, request, jsonify, Response
 import os
-from io import BytesIO, StringIO
+import re
+import zlib
+from urllib.parse import quote
 import logging
-import uuid
 import json
 import base64
-from datetime import datetime
+import hashlib
+from datetime import datetime, timezone
 from typing import Any, Dict
 from flask_cors import CORS
 import firebase_admin
-from firebase_admin import auth
-from google.cloud import storage
-from sqlalchemy import create_engine, text
-import threading
+from token_cache import FirebaseCertificates, VerifiedTokenCache, make_firebase_verifier
+from sqlalchemy import create_engine, event, text
+from storage_backend import get_storage_backend
+from status_cache import StatusCache, CachedStatus
+from response_encoding import compact_json, json_with_fragments, encode_body, conditional_json_response
+from job_events import JobEventHub, start_listener
+from db_migrations import run_migrations
+from job_state import JobStore, new_job_id, NOT_FOUND, FORBIDDEN
+from reaper import StorageReaper
+from anonymization_cache import AnonymizationCache, anonymization_cache_key
+from lanes import anonymization_lane, lane_topic, QueueWaitStats, SMALL_LANE
+from admission import AdmissionController, get_bucket_store, plan_named, retry_after_header, ANALYSIS, ANONYMIZATION, NOAUTH_PLAN
+from message_store import SQLMessageStore
+from metrics import timed, observe_stage, payload_size, metrics_response
+import time
 
 # Configurations (environment variables)
 DB_HOST = os.environ.get("DB_HOST")
 DB_NAME = os.environ.get("DB_NAME")
 DB_USER = os.environ.get("DB_USER")
 DB_PASSWORD = os.environ.get("DB_PASSWORD")
-BUCKET_NAME = os.environ.get("BUCKET_NAME")
 FIREBASE_PROJECT_ID = os.environ.get("FIREBASE_PROJECT_ID")
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
-get_status_lock = threading.Lock()
-
-
-# SQLAlchemy engine with connection pool
-DATABASE_URL = f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
-engine = create_engine(
-    DATABASE_URL,
-    pool_size=10,
-    max_overflow=8,
-    pool_timeout=30,
-    pool_recycle=1800
-)
-
-def init_db():
-    with engine.connect() as conn:
-        conn.execute(text('''
-            CREATE TABLE IF NOT EXISTS jobs (
-                job_id TEXT PRIMARY KEY,
-                user_id TEXT,
-                filename TEXT,
-                rows INTEGER,
-                metadata TEXT,
-                path_file_analyzed TEXT,
-                method TEXT,
-                anonymized_preview TEXT,
-                path_file_anonymized TEXT,
-                upload_at TEXT,
-                completed_at TEXT,
-                status TEXT,
-                error_message TEXT
-            )
-        '''))
-        conn.commit()
-
-init_db()
+# Serialized get_status responses, invalidated whenever a job changes
+status_cache = StatusCache()
+# Long-poll and SSE clients wait on job changes instead of polling the database
+job_events = JobEventHub()
+job_events.add_listener(status_cache.invalidate)
+STATUS_WAIT_MAX_SECONDS = 30
+STATUS_STREAM_KEEPALIVE_SECONDS = 15
+STATUS_STREAM_MAX_SECONDS = int(os.environ.get('STATUS_STREAM_MAX_SECONDS', 300))
+TERMINAL_JOB_STATUSES = ('anonymized', 'error')
+ACTIVE_JOB_STATUSES = ('uploading', 'uploaded', 'analyzed', 'anonymization_requested')
+FILES_PAGE_DEFAULT_SIZE = 100
+FILES_PAGE_MAX_SIZE = 500
+JOBS_DELETE_MAX_IDS = 500
+# On-demand job profiling (see profiling.py in the formatter and the anonymizer): every job of the users
+# in PROFILE_USER_IDS, or the jobs created by a request with ?profile=1 from a user of PROFILING_PLANS
+PROFILE_USER_IDS = {user_id for user_id in os.environ.get('PROFILE_USER_IDS', '').split(',') if user_id}
+PROFILING_PLANS = {'internal'}
+# Plans of the operators allowed to read /internal/stats (counters shared by every user of the instance)
+STATS_PLANS = {'internal'}
+
+# Storage name and content type of the analyzed dataset for each intermediate format.
+# Jobs analyzed before the Parquet intermediate carry no format tag and are CSV.
+PROCESSED_DATA_FORMATS = {
+    'parquet': ('processed_data.parquet', 'application/vnd.apache.parquet'),
+    'csv': ('processed_data.csv', 'text/csv')
+}
+
+def processed_data_format_from_path(gcp_path: str) -> str:
+    """The format of a stored analyzed file is encoded in its extension."""
+    return 'parquet' if gcp_path.endswith('.parquet') else 'csv'
+
+# Upload formats the formatter can read, optionally compressed (the compressed bytes are forwarded as they are)
+SUPPORTED_UPLOAD_EXTENSIONS = ('.csv', '.txt', '.xlsx', '.xls', '.json', '.jsonl', '.ndjson')
+SUPPORTED_COMPRESSION_EXTENSIONS = ('.gz', '.gzip', '.zst', '.zstd')
+
+def strip_compression_extension(filename: str) -> str:
+    """'data.csv.gz' -> 'data.csv': the name shown to the user and used for downloads."""
+    for compression_extension in SUPPORTED_COMPRESSION_EXTENSIONS:
+        if filename.lower().endswith(compression_extension):
+            return filename[:-len(compression_extension)]
+    return filename
+
+def is_supported_upload(filename: str) -> bool:
+    name = filename.lower()
+    if name.endswith('.zip'):
+        # The dataset format of a zip is only known once opened by the formatter
+        return True
+    return strip_compression_extension(name).endswith(SUPPORTED_UPLOAD_EXTENSIONS)
+
+# Uploads are streamed into the job prefix; large files can also be sent as numbered parts and composed server-side
+UPLOADED_FILE_NAME = 'uploaded_file'
+UPLOAD_PARTS_FOLDER = 'upload_parts'
+UPLOAD_PART_MAX_BYTES = int(os.environ.get('UPLOAD_PART_MAX_BYTES', 64 * 1024 * 1024))
+UPLOAD_MAX_PARTS = 10000
+
+# JSON columns are read back as text so they can be passed through without being parsed
+JOB_COLUMNS = '''job_id, user_id, filename, rows, CAST(metadata AS TEXT) AS metadata, path_file_analyzed, method,
+    CAST(anonymized_preview AS TEXT) AS anonymized_preview, path_file_anonymized, upload_at, completed_at, status, error_message, version'''
+
+def stored_json(json_text):
+    """
+    JSON read from the metadata and anonymized_preview columns, as compact text ready to be spliced into a
+    response. SQLite returns it as it was written (already compact); Postgres renders JSONB with spaces.
+    """
+    return compact_json(json_text) if engine.dialect.name == 'postgresql' else json_text
+
+def to_isoformat(value):
+    """Timestamps come back as datetimes from Postgres and as text from SQLite."""
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def processed_data_keys(job_id: str):
+    """Every key the analyzed dataset of a job can be stored under, one per intermediate format."""
+    return [f"{job_id}/{stored_name}" for stored_name, _ in PROCESSED_DATA_FORMATS.values()]
+
+def payload_sha256(data: Dict[str, Any], name: str):
+    """SHA-256 of a message payload: referenced payloads carry it, inline ones are hashed here."""
+    reference = data.get(f"{name}_ref")
+    if reference is not None:
+        return reference.get('sha256')
+    inline = data.get(f"{name}_content_base64")
+    return hashlib.sha256(base64.b64decode(inline)).hexdigest() if inline is not None else None
+
+def upload_key(job_id: str) -> str:
+    return f"{job_id}/{UPLOADED_FILE_NAME}"
+
+def upload_part_key(job_id: str, part_number: int) -> str:
+    return f"{job_id}/{UPLOAD_PARTS_FOLDER}/{part_number:05d}"
+
+# Downloads are streamed from storage in chunks, optionally gzip encoded on the fly when the client accepts it
+DOWNLOAD_CHUNK_BYTES = int(os.environ.get('DOWNLOAD_CHUNK_BYTES', 256 * 1024))
+DOWNLOAD_GZIP = os.environ.get('DOWNLOAD_GZIP', 'true').lower() == 'true'
+BYTE_RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def parse_byte_range(range_header: str, size: int):
+    """
+    Parses a single 'bytes=' range into an inclusive (start, end) pair.
+    Returns None when the header should be ignored (absent, malformed or multi-range) and raises ValueError when unsatisfiable.
+    """
+    match = BYTE_RANGE_PATTERN.match(range_header.strip()) if range_header else None
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError("Unsatisfiable range")
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("Unsatisfiable range")
+    return start, end
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # 31 = gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def stream_storage_file(key: str, download_name: str, mimetype: str):
+    """Streams a stored artifact as an attachment, with Range, ETag and optional gzip support."""
+    info = storage_backend.stat(key)
+    if info is None:
+        return jsonify({"error": "Anonymized file not found in storage"}), 404
+
+    ascii_name = download_name.encode('ascii', 'ignore').decode('ascii').replace('"', '')
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(download_name)}",
+        'Vary': 'Accept-Encoding'
+    }
+    use_gzip = DOWNLOAD_GZIP and 'gzip' in request.headers.get('Accept-Encoding', '') and 'Range' not in request.headers
+    etag = f"{info.etag}-gzip" if use_gzip else info.etag
+    headers['ETag'] = f'"{etag}"'
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    if not if_range or if_range.strip('"') == info.etag:
+        try:
+            byte_range = parse_byte_range(request.headers.get('Range'), info.size)
+        except ValueError:
+            headers['Content-Range'] = f"bytes */{info.size}"
+            return Response(status=416, headers=headers)
+
+    if byte_range:
+        start, end = byte_range
+        headers['Content-Range'] = f"bytes {start}-{end}/{info.size}"
+        headers['Content-Length'] = str(end - start + 1)
+        body = storage_backend.iter_range(key, start, end, chunk_size=DOWNLOAD_CHUNK_BYTES)
+        return Response(body, status=206, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+    body = storage_backend.iter_range(key, chunk_size=DOWNLOAD_CHUNK_BYTES)
+    if use_gzip:
+        # The compressed length is unknown up front, the response is sent chunked
+        headers['Content-Encoding'] = 'gzip'
+        body = gzip_chunks(body)
+    else:
+        headers['Content-Length'] = str(info.size)
+    return Response(body, status=200, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+# SQLAlchemy engine with connection pool. DATABASE_URL overrides the Cloud SQL settings (e.g. a local Postgres or sqlite:///jobs.db for tests)
+DATABASE_URL = os.environ.get("DATABASE_URL") or f"postgresql+psycopg2://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
+if DATABASE_URL.startswith('sqlite'):
+    engine = create_engine(DATABASE_URL, connect_args={'check_same_thread': False})
+else:
+    engine = create_engine(
+        DATABASE_URL,
+        pool_size=10,
+        max_overflow=8,
+        pool_timeout=30,
+        pool_recycle=1800
+    )
+
+# Every statement is timed as a 'db_query' stage of the metrics
+@event.listens_for(engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context.query_started = time.perf_counter()
+
+@event.listens_for(engine, 'after_cursor_execute')
+def observe_query(conn, cursor, statement, parameters, context, executemany):
+    observe_stage('db_query', time.perf_counter() - context.query_started)
+
+@event.listens_for(engine, 'handle_error')
+def observe_failed_query(exception_context):
+    context = exception_context.execution_context
+    if context is not None and hasattr(context, 'query_started'):
+        observe_stage('db_query', time.perf_counter() - context.query_started, outcome='error')
+
+run_migrations(engine)
+start_listener(engine, job_events)
+# Job reads and conditional status transitions, one statement each
+job_store = JobStore(engine, JOB_COLUMNS, on_change=job_events.notify)
+# Results of identical anonymization requests are reused instead of recomputed
+anonymization_cache = AnonymizationCache(engine)
+# Per user token buckets, a cap on the jobs waiting for a worker and the plan quotas
+admission = AdmissionController(engine, get_bucket_store(engine))
+# Queue wait of the anonymization jobs per size lane, reported back by the anonymizer
+queue_waits = QueueWaitStats()
 
 app = Flask(__name__)
 CORS(app)
@@ -67,8 +246,18 @@ CORS(app)
 # Initialize Firebase Admin SDK
 firebase_admin.initialize_app()
 
-# Initialize Google Cloud Storage client
-storage_client = storage.Client()
+# Verified ID tokens are cached until they expire, the signing certificates are refreshed in the background
+firebase_certificates = FirebaseCertificates()
+firebase_certificates.start()
+token_cache = VerifiedTokenCache(make_firebase_verifier(FIREBASE_PROJECT_ID, firebase_certificates),
+                                 max_entries=int(os.environ.get('TOKEN_CACHE_MAX_ENTRIES', 10000)))
+
+# Initialize the object storage backend (GCS bucket in production, local directory for tests)
+storage_backend = get_storage_backend()
+
+# Artifacts of deleted and expired jobs are removed in the background
+reaper = StorageReaper(engine, storage_backend, on_change=job_events.notify)
+reaper.start()
 
 def firebase_auth_required(f):
     from functools import wraps
@@ -79,80 +268,175 @@ def firebase_auth_required(f):
             return jsonify({"error": "Missing or invalid Authorization header"}), 401
         id_token = auth_header.split(" ")[1]
         try:
-            decoded_token = auth.verify_id_token(id_token)
-            request.user_id = decoded_token["uid"]
-            return f(*args, **kwargs)
+            request.user_id, request.user_plan = token_cache.get_user(id_token)
         except Exception as e:
             logging.warning(f"Firebase Auth failed: {e}")
             return jsonify({"error": "Invalid auth token"}), 401
+        return f(*args, **kwargs)
     return decorated_function
 
 # Initialize PubSub Manager
 try:
-    from google_pubsub_manager import get_pubsub_manager, Topics
+    from google_pubsub_manager import (get_pubsub_manager, Topics, has_payload, read_payload, store_payload, payload_reference, MessageDeduplicator,
+                                       DUPLICATE_DONE, DUPLICATE_IN_PROGRESS)
     pubsub_manager = get_pubsub_manager()
+    # Redelivered pushes are recognized across instances through the processed_messages table
+    deduplicator = MessageDeduplicator(SQLMessageStore(engine))
     logger.info("PubSub Manager initialized for publishing.")
 except ImportError:
     logger.warning("google_pubsub_manager not found. Publishing capabilities might be disabled.")
     pubsub_manager = None
+    deduplicator = None
+
+def deduplicated_push(f):
+    """
+    Acks a redelivery of a message already handled instead of handling it again. A redelivery of a message
+    still being handled is refused, Pub/Sub retries it and takes it over if the lease expires.
+    """
+    from functools import wraps
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        envelope = request.get_json(silent=True) or {}
+        try:
+            message_data = json.loads(base64.b64decode(envelope['message']['data']))
+            message_id = message_data.get('message_id')
+            job_id = (message_data.get('data') or {}).get('job_id')
+        except Exception:
+            # Malformed envelopes are reported by the handler itself
+            return f(*args, **kwargs)
+        if deduplicator is None:
+            return f(*args, **kwargs)
+        claim = deduplicator.claim(message_id, job_id)
+        if claim == DUPLICATE_DONE:
+            logger.info(f"Duplicate message {message_id} for job {job_id} acked without processing")
+            return jsonify({"message": "Duplicate message ignored"}), 200
+        if claim == DUPLICATE_IN_PROGRESS:
+            logger.info(f"Message {message_id} for job {job_id} is being processed, redelivery refused")
+            return jsonify({"error": "Message is being processed"}), 409, {'Retry-After': str(int(deduplicator.lease_seconds))}
+        try:
+            return f(*args, **kwargs)
+        finally:
+            deduplicator.complete(message_id, job_id)
+    return decorated_function
+
+def rejection_response(rejection):
+    return jsonify({"error": rejection.error}), rejection.status, retry_after_header(rejection.retry_after)
+
+def request_plan():
+    if hasattr(request, 'user_plan'):
+        return plan_named(request.user_plan)
+    # The noauth routes, used by the stress tests
+    return plan_named(NOAUTH_PLAN)
+
+def profile_flag(user_id: str, plan) -> Dict[str, bool]:
+    """Message field asking the worker to profile the job, only set when an operator requested it."""
+    requested = plan.name in PROFILING_PLANS and request.args.get('profile', '').lower() in ('1', 'true', 'yes')
+    return {'profile': True} if requested or user_id in PROFILE_USER_IDS else {}
+
+def store_profile(data: Dict[str, Any], job_id: str, stage: str) -> Dict[str, str]:
+    """Stores the profile a worker attached to its result or error next to the job's outputs, returns the column to record it in."""
+    if not has_payload(data, 'profile'):
+        return {}
+    key = f"{job_id}/profile_{stage}.txt"
+    with timed('storage_upload'):
+        store_payload(data, 'profile', key, content_type='text/plain')
+    return {"path_profile": key}
+
+def job_error_response(error: str, conflict_message: str, conflict_status: int = 400, not_found_message: str = "Job not found"):
+    """HTTP response for a failed job lookup or transition."""
+    if error == NOT_FOUND:
+        return jsonify({"error": not_found_message}), 404
+    if error == FORBIDDEN:
+        return jsonify({"error": "Unauthorized access to this job"}), 403
+    return jsonify({"error": conflict_message}), conflict_status
+
+def upload_and_analyze_response(user_id: str):
+    plan = request_plan()
+    # Checked before request.files is touched, which parses (and spools) the whole multipart body: the
+    # declared length (the stored size once the file is copied), saturation and the user's rate limit.
+    # The rate limit token is only taken once the request is known to be valid.
+    rejection = admission.check_upload_size(plan, request.content_length) or admission.precheck(user_id, plan, ANALYSIS)
+    if rejection:
+        return rejection_response(rejection)
 
-# ==== NEW FILE FLOW ====
-@app.route('/upload_and_analyze', methods=['POST'])
-@firebase_auth_required
-def upload_and_analyze():
     if 'file' not in request.files:
         return jsonify({"error": "No file part"}), 400
 
     file = request.files['file']
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
-
-    if file:
-        job_id = str(uuid.uuid4()) + '-' + datetime.now().strftime("%Y%m%d%H%M%S")
-        original_filename = file.filename
-
-        file_content_bytes = file.read()
-        encoded_file_content = base64.b64encode(file_content_bytes).decode('utf-8')
-
-        upload_at = datetime.now().isoformat()
-        
-        with engine.connect() as conn:
-            conn.execute(text('''
-                INSERT INTO jobs (job_id, user_id, filename, rows, metadata, path_file_analyzed, method, anonymized_preview, path_file_anonymized, upload_at, completed_at, status)
-                VALUES (:job_id, :user_id, :filename, :rows, :metadata, :path_file_analyzed, :method, :anonymized_preview, :path_file_anonymized, :upload_at, :completed_at, :status)
-            '''), {
-                "job_id": job_id,
-                "user_id": request.user_id,
-                "filename": original_filename,
-                "rows": 0,
-                "metadata": None,
-                "path_file_analyzed": None,
-                "method": None,
-                "anonymized_preview": None,
-                "path_file_anonymized": None,
-                "upload_at": upload_at,
-                "completed_at": None,
-                "status": 'uploaded',
-                "error_message": None
-            })
-            conn.commit()
-
-        if pubsub_manager:
+    if not is_supported_upload(file.filename):
+        return jsonify({"error": "Unsupported file format"}), 415
+    rejection = admission.admit(user_id, plan, ANALYSIS)
+    if rejection:
+        return rejection_response(rejection)
+
+    job_id = new_job_id()
+    original_filename = file.filename
+
+    # The multipart body is copied to storage chunk by chunk, only a reference is published
+    with timed('storage_upload'):
+        stored_upload = storage_backend.put_stream(upload_key(job_id), file.stream)
+    rejection = admission.check_upload_size(plan, stored_upload.size)
+    if rejection:
+        storage_backend.delete(upload_key(job_id))
+        return rejection_response(rejection)
+
+    uploaded_at = datetime.now(timezone.utc)
+    job_store.create({
+        "job_id": job_id,
+        "user_id": user_id,
+        "filename": strip_compression_extension(original_filename),
+        "rows": 0,
+        "upload_at": uploaded_at,
+        "analysis_requested_at": uploaded_at,
+        "status": 'uploaded'
+    })
+
+    if pubsub_manager:
+        with timed('publish'):
             pubsub_manager.publish(Topics.DATA_UPLOAD_REQUESTS, {
                 'job_id': job_id,
                 'filename': original_filename,
-                'file_content_base64': encoded_file_content
+                **payload_reference('file', upload_key(job_id), stored_upload.size, stored_upload.sha256),
+                **profile_flag(user_id, plan)
             }, attributes={'job_id': job_id})
 
-        return jsonify({
-            "message": "File uploaded and analysis initiated",
-            "job_id": job_id,
-            "filename": original_filename
-        }), 202
-
-@app.route('/request_anonymization', methods=['POST'])
-@firebase_auth_required
-def request_anonymization():
+    return jsonify({
+        "message": "File uploaded and analysis initiated",
+        "job_id": job_id,
+        "filename": strip_compression_extension(original_filename)
+    }), 202
+
+def link_cached_anonymization(job_id: str, cache_key) -> bool:
+    """Completes a claimed job with the result of an identical earlier request, if there is one."""
+    cached = anonymization_cache.lookup(cache_key)
+    if cached is None:
+        return False
+    gcp_path = f"{job_id}/anonymized_data.csv"
+    try:
+        # Server-side copy: each job owns its artifacts, deleting the earlier job must not break this one
+        storage_backend.compose([cached.path_file_anonymized], gcp_path, content_type='text/csv')
+    except Exception as e:
+        logger.warning(f"Cached anonymization result of job {cached.job_id} is not usable: {e}")
+        anonymization_cache.invalidate(cache_key)
+        return False
+    anonymization_cache.linked()
+
+    anonymized = job_store.transition(job_id, 'anonymized', ('anonymization_requested',), values={
+        "path_file_analyzed": None,
+        "anonymized_preview": cached.anonymized_preview,
+        "path_file_anonymized": gcp_path,
+        "completed_at": datetime.now(timezone.utc)
+    })
+    if anonymized.error:
+        # The job was deleted meanwhile, its prefix is reaped with the copy
+        return True
+    logger.info(f"Job {job_id}: anonymization result reused from job {cached.job_id}")
+    reaper.delete_later(processed_data_keys(job_id))
+    return True
+
+def anonymization_request_response(user_id: str):
     data = request.json
     job_id = data.get('job_id')
     method = data.get('method')
@@ -162,186 +446,456 @@ def request_anonymization():
     if not all([job_id, method, user_selections is not None]):
         return jsonify({"error": "Missing job_id, method, or user_selections"}), 400
 
-    with engine.connect() as conn:
-        result = conn.execute(text('SELECT * FROM jobs WHERE job_id = :job_id'), {"job_id": job_id})
-        job = result.mappings().first()
-    
-    if not job:
-        return jsonify({"error": "Job not found"}), 404
-    if job['user_id'] != request.user_id:
-        return jsonify({"error": "Unauthorized access to this job"}), 403
-    if job['status'] != 'analyzed':
-        return jsonify({"error": "Job is not ready for anonymization"}), 400
-
-    # Download processed file from GCP bucket
-    gcp_path = job['path_file_analyzed']
+    plan = request_plan()
+    rejection = admission.admit(user_id, plan, ANONYMIZATION)
+    if rejection:
+        return rejection_response(rejection)
+
+    # Claiming the job first means a repeated or concurrent request gets a conflict instead of publishing twice
+    claimed = job_store.transition(job_id, 'anonymization_requested', ('analyzed',), user_id=user_id,
+                                   values={"method": method, "anonymization_requested_at": datetime.now(timezone.utc)},
+                                   returning='path_file_analyzed, CAST(metadata AS TEXT) AS metadata, analyzed_sha256, analyzed_size, rows')
+    if claimed.error:
+        return job_error_response(claimed.error, "Job is not ready for anonymization")
+    rejection = admission.check_rows(plan, claimed.job['rows'])
+    if rejection:
+        job_store.transition(job_id, 'analyzed', ('anonymization_requested',))
+        return rejection_response(rejection)
+
+    gcp_path = claimed.job['path_file_analyzed']
     if not gcp_path:
+        job_store.transition(job_id, 'analyzed', ('anonymization_requested',))
         return jsonify({"error": "No analyzed file path found for this job"}), 400
 
     try:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(gcp_path)
-        processed_csv_content = blob.download_as_text()
-        encoded_processed_csv = base64.b64encode(processed_csv_content.encode('utf-8')).decode('utf-8')
-
-        metadata_json_content = job['metadata']
-        encoded_metadata_json = base64.b64encode(metadata_json_content.encode('utf-8')).decode('utf-8')
+        cache_key = anonymization_cache_key(user_id, claimed.job['analyzed_sha256'], claimed.job['metadata'],
+                                            method, params, user_selections)
+        if link_cached_anonymization(job_id, cache_key):
+            return jsonify({"message": "Anonymization result reused", "job_id": job_id, "cached": True}), 202
+        if cache_key:
+            anonymization_cache.remember(cache_key, job_id)
+
+        # The analyzed file is never read here: the anonymizer fetches it from storage by reference.
+        # Its size comes with the analysis results, only jobs analyzed before it was recorded need a stat.
+        processed_data_size = claimed.job['analyzed_size']
+        if processed_data_size is None:
+            processed_data_info = storage_backend.stat(gcp_path)
+            if processed_data_info is None:
+                raise FileNotFoundError(f"Analyzed file {gcp_path} not found")
+            processed_data_size = processed_data_info.size
+        metadata_json_content = claimed.job['metadata']
+        # Large jobs go to their own topic and worker pool, so they do not queue ahead of small ones
+        lane = anonymization_lane(claimed.job['rows'], processed_data_size)
 
         if pubsub_manager:
-            pubsub_manager.publish(Topics.ANONYMIZATION_REQUESTS, {
-                'job_id': job_id,
-                'method': method,
-                'params': params,
-                'user_selections': user_selections,
-                'processed_data_content_base64': encoded_processed_csv,
-                'metadata_content_base64': encoded_metadata_json
-            }, attributes={'job_id': job_id})
-
-        with engine.connect() as conn:
-            conn.execute(text('UPDATE jobs SET status = :status, method = :method WHERE job_id = :job_id'), 
-                       {"status": 'anonymization_requested', "method": method, "job_id": job_id})
-            conn.commit()
+            with timed('publish'):
+                pubsub_manager.publish(lane_topic(Topics, lane), {
+                    'job_id': job_id,
+                    'lane': lane,
+                    'method': method,
+                    'params': params,
+                    'user_selections': user_selections,
+                    'processed_data_format': processed_data_format_from_path(gcp_path),
+                    # Checked by the anonymizer against the hash recorded when the analysis results arrived
+                    **payload_reference('processed_data', gcp_path, processed_data_size, claimed.job['analyzed_sha256']),
+                    **profile_flag(user_id, plan)
+                }, attributes={'job_id': job_id}, payloads={
+                    'metadata': metadata_json_content.encode('utf-8')
+                })
 
         return jsonify({"message": "Anonymization request published", "job_id": job_id}), 202
-    
+
     except Exception as e:
         logger.error(f"Error in request_anonymization: {e}")
+        # Nothing was published: give the job back so the request can be retried
+        job_store.transition(job_id, 'analyzed', ('anonymization_requested',))
         return jsonify({"error": "Internal server error"}), 500
 
+# ==== NEW FILE FLOW ====
+@app.route('/upload_and_analyze', methods=['POST'])
+@firebase_auth_required
+def upload_and_analyze():
+    return upload_and_analyze_response(request.user_id)
+
+@app.route('/request_anonymization', methods=['POST'])
+@firebase_auth_required
+def request_anonymization():
+    return anonymization_request_response(request.user_id)
+
+def load_job_status(job_id: str):
+    """Reads a job and serializes its status response (compressed once per version), None when there is no such job."""
+    with engine.connect() as conn:
+        result = conn.execute(text(f'SELECT {JOB_COLUMNS} FROM jobs WHERE job_id = :job_id'), {"job_id": job_id})
+        job = result.mappings().first()
+    if not job or job['status'] == 'deleted':
+        return None
+
+    # metadata and anonymized_preview are spliced in as compact JSON, re-serialized at most once per job version
+    body = json_with_fragments({
+        "job_id": job['job_id'],
+        "filename": job['filename'],
+        "status": job['status'],
+        "upload_at": to_isoformat(job['upload_at']),
+        "completed_at": to_isoformat(job['completed_at']),
+        "rows": job['rows'],
+        "method": job['method'],
+        "error_message": job['error_message'] if job.get('error_message') else None,
+        "version": job['version']
+    }, {"metadata": stored_json(job['metadata']), "anonymized_preview": stored_json(job['anonymized_preview'])})
+    return CachedStatus(job['user_id'], job['version'], job['status'], body, encode_body(body))
+
+def get_cached_status(job_id: str):
+    # No global lock: concurrent polls of the same job are coalesced by the cache
+    return status_cache.get(job_id, lambda: load_job_status(job_id))
+
+def job_status_response(job_id: str, user_id: str):
+    """
+    Status of a job. With ?since=<version> the request is a long-poll: it returns as soon as the
+    job version is greater than since, or with the unchanged status after ?wait seconds.
+    The ETag is the job version, a poll sending it back gets 304 while the job is unchanged.
+    """
+    cached_status = get_cached_status(job_id)
+    if not cached_status:
+        return jsonify({'error': 'not_found', 'details': 'Job ID not found'}), 404
+    if cached_status.user_id != user_id:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    since = request.args.get('since', type=int)
+    if since is not None and cached_status.version <= since:
+        deadline = time.monotonic() + min(request.args.get('wait', STATUS_WAIT_MAX_SECONDS, type=float), STATUS_WAIT_MAX_SECONDS)
+        while time.monotonic() < deadline:
+            # Subscribed before re-reading the status, so a change made in between still ends the wait
+            with job_events.subscribe(job_id) as changed:
+                cached_status = get_cached_status(job_id)
+                if not cached_status:
+                    return jsonify({'error': 'not_found', 'details': 'Job ID not found'}), 404
+                if cached_status.version > since:
+                    break
+                changed.wait(deadline - time.monotonic())
+    return conditional_json_response(cached_status.encodings, etag=f"{job_id}-{cached_status.version}")
+
+def job_status_stream(job_id: str, user_id: str):
+    """Server-Sent Events: one 'status' event per job version, until the job is done or the stream times out."""
+    cached_status = get_cached_status(job_id)
+    if not cached_status:
+        return jsonify({'error': 'not_found', 'details': 'Job ID not found'}), 404
+    if cached_status.user_id != user_id:
+        return jsonify({'error': 'Unauthorized'}), 403
+    # Reconnecting EventSource clients resume from the last version they received
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('since', ''))
+    last_version = int(last_event_id) if last_event_id.lstrip('-').isdigit() else -1
+
+    def events(last_version):
+        deadline = time.monotonic() + STATUS_STREAM_MAX_SECONDS
+        yield "retry: 1000\n\n"
+        while True:
+            changed_in_time = True
+            # Subscribed before reading the status, so a change made in between still ends the wait
+            with job_events.subscribe(job_id) as changed:
+                cached_status = get_cached_status(job_id)
+                if cached_status and cached_status.version <= last_version and time.monotonic() < deadline:
+                    changed_in_time = changed.wait(min(STATUS_STREAM_KEEPALIVE_SECONDS, deadline - time.monotonic()))
+            if not cached_status:
+                yield "event: deleted\ndata: {}\n\n"
+                return
+            if cached_status.version > last_version:
+                last_version = cached_status.version
+                yield f"id: {last_version}\nevent: status\ndata: {cached_status.body}\n\n"
+                if cached_status.status in TERMINAL_JOB_STATUSES:
+                    return
+            if time.monotonic() >= deadline:
+                return
+            if not changed_in_time:
+                yield ": keepalive\n\n"
+
+    return Response(events(last_version), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/get_status/<job_id>', methods=['GET'])
 @firebase_auth_required
 def get_status(job_id):
-    acquired = get_status_lock.acquire(timeout=10)  # Timeout 10 seconds
-    if not acquired:
-        return jsonify({'error': 'busy', 'details': 'Too many clients fetching status, please retry.'}), 429  # Too Many Requests
-
-    try:
-        with engine.connect() as conn:
-            result = conn.execute(text('SELECT * FROM jobs WHERE job_id = :job_id'), {"job_id": job_id})
-            job = result.mappings().first()
-        
-        if not job:
-            return jsonify({'error': 'not_found', 'details': 'Job ID not found'}), 404
-        if job['user_id'] != request.user_id:
-            return jsonify({'error': 'Unauthorized'}), 403
-
-        response_status = {
-            "job_id": job['job_id'],
-            "filename": job['filename'],
-            "status": job['status'],
-            "upload_at": job['upload_at'],
-            "completed_at": job['completed_at'],
-            "rows": job['rows'],
-            "method": job['method'],
-            "metadata": json.loads(job['metadata']) if job['metadata'] else None,        
-            "anonymized_preview": json.loads(job['anonymized_preview']) if job['anonymized_preview'] else None,
-            "error_message": job['error_message'] if job.get('error_message') else None
-        }
-        return jsonify(response_status), 200
-    finally:
-        get_status_lock.release()
+    return job_status_response(job_id, request.user_id)
 
-@app.route('/get_files', methods=['GET'])
+@app.route('/status_stream/<job_id>', methods=['GET'])
 @firebase_auth_required
-def get_files():
+def status_stream(job_id):
+    return job_status_stream(job_id, request.user_id)
+
+def encode_files_cursor(upload_at: str, job_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([upload_at, job_id]).encode('utf-8')).decode('ascii')
+
+def decode_files_cursor(cursor: str):
+    upload_at, job_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return datetime.fromisoformat(upload_at), job_id
+
+def files_page_response(user_id: str):
+    """
+    One page of the user's jobs, newest upload first. ?limit (max FILES_PAGE_MAX_SIZE) and the opaque
+    ?cursor from the previous page select the page; previews are only read with ?include_preview=true.
+    The stats are computed in SQL and sent with the first page only. The ETag covers the versions of
+    the jobs listed, an unchanged page is answered with 304 before any of it is serialized.
+    """
+    limit = min(max(request.args.get('limit', FILES_PAGE_DEFAULT_SIZE, type=int), 1), FILES_PAGE_MAX_SIZE)
+    include_preview = request.args.get('include_preview', 'false').lower() == 'true'
+    cursor = request.args.get('cursor')
+    params = {"user_id": user_id, "limit": limit + 1}
+    cursor_filter = ''
+    if cursor:
+        try:
+            params["cursor_upload_at"], params["cursor_job_id"] = decode_files_cursor(cursor)
+        except Exception:
+            return jsonify({"error": "Invalid cursor"}), 400
+        cursor_filter = 'AND (upload_at, job_id) < (:cursor_upload_at, :cursor_job_id)'
+
+    columns = 'job_id, filename, status, method, rows, completed_at, upload_at, version'
+    if include_preview:
+        columns += ', CAST(anonymized_preview AS TEXT) AS anonymized_preview'
     with engine.connect() as conn:
-        result = conn.execute(text('SELECT * FROM jobs WHERE user_id = :user_id'), {"user_id": request.user_id})
+        result = conn.execute(text(f'''
+            SELECT {columns} FROM jobs
+            WHERE user_id = :user_id AND status <> 'deleted' {cursor_filter}
+            ORDER BY upload_at DESC, job_id DESC
+            LIMIT :limit
+        '''), params)
         jobs = list(result.mappings())
-    files_info = []
+        stats = None
+        if not cursor:
+            stats_row = conn.execute(text('''
+                SELECT COUNT(*) AS datasets,
+                       COALESCE(SUM(CASE WHEN status = 'anonymized' THEN rows ELSE 0 END), 0) AS total_rows
+                FROM jobs WHERE user_id = :user_id AND status <> 'deleted'
+            '''), {"user_id": user_id}).mappings().first()
+            stats = [{'datasets': stats_row['datasets'], 'total_rows': stats_row['total_rows']}]
+
+    next_cursor = None
+    if len(jobs) > limit:
+        jobs = jobs[:limit]
+        next_cursor = encode_files_cursor(to_isoformat(jobs[-1]['upload_at']), jobs[-1]['job_id'])
+
+    etag = hashlib.sha256(json.dumps([
+        request.query_string.decode('utf-8'), stats, next_cursor, [(job['job_id'], job['version']) for job in jobs]
+    ]).encode('utf-8')).hexdigest()[:32]
+    if request.if_none_match.contains_weak(etag):
+        # Unchanged page: answered with 304 without serializing anything
+        return conditional_json_response({}, etag)
+
+    file_fragments = []
     for job in jobs:
         if job['status'] == 'anonymized':
-            files_info.append({
+            # The stored preview (ten rows) is spliced in as compact JSON
+            preview = {'anonymized_preview': stored_json(job['anonymized_preview'])} if include_preview else {}
+            file_json = json_with_fragments({
                 'job_id': job['job_id'],
-                'anonymized_preview': json.loads(job['anonymized_preview']) if job['anonymized_preview'] else None,
                 'filename': job['filename'],
                 'status': job['status'],
                 'method': job['method'],
                 'rows': job['rows'],
                 'download_url': f"/download/{job['job_id']}",
                 'delete_url': f"/delete/{job['job_id']}",
-                'datetime_completition':job['completed_at'],
-                'datetime_upload': job['upload_at']
-            })
+                'datetime_completition': to_isoformat(job['completed_at']),
+                'datetime_upload': to_isoformat(job['upload_at'])
+            }, preview)
         else:
-            files_info.append({
+            file_json = json.dumps({
                 'job_id': job['job_id'],
                 'filename': job['filename'],
                 'status': job['status']
-            })
-    
-    total_datasets = len(files_info)
-    total_rows = sum(file.get('rows', 0) for file in files_info if file.get('rows'))
-    stats = [{'datasets': total_datasets, 'total_rows': total_rows}]
-    result = [{'stats': stats}, {'files': files_info}]
-    return jsonify(result), 200
+            }, separators=(',', ':'))
+        file_fragments.append(file_json)
 
-@app.route('/download/<job_id>', methods=['GET'])
+    body = '[{},{{"files":[{}]}},{}]'.format(json.dumps({'stats': stats}, separators=(',', ':')), ','.join(file_fragments),
+                                              json.dumps({'next_cursor': next_cursor}, separators=(',', ':')))
+    return conditional_json_response(encode_body(body), etag)
+
+@app.route('/get_files', methods=['GET'])
 @firebase_auth_required
-def download_full_file(job_id):
-    with engine.connect() as conn:
-        result = conn.execute(text('SELECT * FROM jobs WHERE job_id = :job_id'), {"job_id": job_id})
-        job = result.mappings().first()
-    
-    if not job:
-        return jsonify({"error": "Job not found"}), 404
-    if job['user_id'] != request.user_id:
-        return jsonify({"error": "Unauthorized access to this job"}), 403
-    if job['status'] != 'anonymized':
-        return jsonify({"error": "File not ready. Still processing."}), 400
-    
+def get_files():
+    return files_page_response(request.user_id)
+
+def download_response(job_id: str, user_id: str):
+    found = job_store.get(job_id, user_id, statuses=('anonymized',))
+    if found.error:
+        return job_error_response(found.error, "File not ready. Still processing.")
+    job = found.job
+
     try:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(job['path_file_anonymized'])
-        if not blob.exists():
-            return jsonify({"error": "Anonymized file not found in GCP bucket"}), 404
-        
-        file_content = blob.download_as_text()
         download_name = job['filename'] if job['filename'] else f"anonymized_file_{job_id}.csv"
-        
-        return send_file(
-            BytesIO(file_content.encode("utf-8")),
-            as_attachment=True,
-            download_name=download_name,
-            mimetype='text/csv'
-        )
+        return stream_storage_file(job['path_file_anonymized'], download_name, 'text/csv')
     except Exception as e:
         logger.error(f"Error downloading file: {e}")
         return jsonify({"error": "Error downloading file"}), 500
 
+@app.route('/download/<job_id>', methods=['GET'])
+@firebase_auth_required
+def download_full_file(job_id):
+    return download_response(job_id, request.user_id)
+
 @app.route('/delete/<job_id>', methods=['DELETE'])
 @firebase_auth_required
 def delete_job(job_id):
-    with engine.connect() as conn:
-        result = conn.execute(text('SELECT * FROM jobs WHERE job_id = :job_id'), {"job_id": job_id})
-        job = result.mappings().first()
-    
-    if not job:
-        return jsonify({"error": "Job not found"}), 404
-    if job['user_id'] != request.user_id:
-        return jsonify({"error": "Unauthorized access to this job"}), 403
+    if not job_store.mark_deleted([job_id], request.user_id):
+        found = job_store.get(job_id, request.user_id, columns='job_id, user_id, status')
+        return job_error_response(found.error or NOT_FOUND, "Job not found", conflict_status=404)
+    # The artifacts are removed by the reaper, off the request path
+    reaper.wake()
+    return jsonify({"message": "File deleted successfully"}), 200
+
+def delete_jobs_response(user_id: str):
+    """Bulk delete: marks the user's jobs deleted and returns at once, the reaper removes their artifacts."""
+    job_ids = (request.get_json(silent=True) or {}).get('job_ids')
+    if not isinstance(job_ids, list) or not job_ids or not all(isinstance(job_id, str) for job_id in job_ids):
+        return jsonify({"error": "job_ids must be a non-empty list of job ids"}), 400
+    if len(job_ids) > JOBS_DELETE_MAX_IDS:
+        return jsonify({"error": f"At most {JOBS_DELETE_MAX_IDS} jobs can be deleted at once"}), 400
+
+    deleted = job_store.mark_deleted(job_ids, user_id)
+    if deleted:
+        reaper.wake()
+    deleted_ids = set(deleted)
+    # Unknown jobs, jobs of other users and jobs already deleted are reported together
+    return jsonify({"deleted": deleted, "not_deleted": [job_id for job_id in job_ids if job_id not in deleted_ids]}), 202
+
+@app.route('/jobs', methods=['DELETE'])
+@firebase_auth_required
+def delete_jobs():
+    return delete_jobs_response(request.user_id)
+
+# ==== CHUNKED UPLOADS ====
+def get_upload_job(job_id: str, user_id: str):
+    """Returns (job, error_response) for an upload session owned by user_id that is still receiving parts."""
+    found = job_store.get(job_id, user_id, statuses=('uploading',))
+    if found.error:
+        return None, job_error_response(found.error, "Upload already completed", conflict_status=409, not_found_message="Upload not found")
+    return found.job, None
+
+def create_upload(user_id: str):
+    data = request.json or {}
+    filename = data.get('filename')
+    if not filename:
+        return jsonify({"error": "Missing filename"}), 400
+    if not is_supported_upload(filename):
+        return jsonify({"error": "Unsupported file format"}), 415
+    if data.get('size') is not None and not isinstance(data.get('size'), int):
+        return jsonify({"error": "size must be a number of bytes"}), 400
+    plan = request_plan()
+    # The optional declared size lets an oversized upload be refused before any part is sent.
+    # Admitting takes the rate limit token, so it comes after every other check.
+    rejection = admission.check_upload_size(plan, data.get('size'))
+    if rejection:
+        return rejection_response(rejection)
+    rejection = admission.admit(user_id, plan, ANALYSIS)
+    if rejection:
+        return rejection_response(rejection)
+
+    job_id = new_job_id()
+    job_store.create({
+        "job_id": job_id,
+        "user_id": user_id,
+        # The original name (with its compression extension) is kept until the upload is completed
+        "filename": filename,
+        "rows": 0,
+        "upload_at": datetime.now(timezone.utc),
+        "status": 'uploading'
+    })
+    return jsonify({"job_id": job_id, "max_part_bytes": UPLOAD_PART_MAX_BYTES, "max_parts": UPLOAD_MAX_PARTS}), 201
+
+def upload_part(job_id: str, part_number: int, user_id: str):
+    if not 1 <= part_number <= UPLOAD_MAX_PARTS:
+        return jsonify({"error": f"Part number must be between 1 and {UPLOAD_MAX_PARTS}"}), 400
+    if request.content_length is None or request.content_length > UPLOAD_PART_MAX_BYTES:
+        return jsonify({"error": f"Parts need a Content-Length of at most {UPLOAD_PART_MAX_BYTES} bytes"}), 413
+    _, error_response = get_upload_job(job_id, user_id)
+    if error_response:
+        return error_response
+
+    # Re-sending a part overwrites it, so an interrupted part can simply be retried
+    with timed('storage_upload'):
+        stored_part = storage_backend.put_stream(upload_part_key(job_id, part_number), request.stream)
+    return jsonify({"part_number": part_number, "size": stored_part.size, "sha256": stored_part.sha256}), 200
+
+def get_upload(job_id: str, user_id: str):
+    _, error_response = get_upload_job(job_id, user_id)
+    if error_response:
+        return error_response
+    parts_prefix = f"{job_id}/{UPLOAD_PARTS_FOLDER}/"
+    part_numbers = [int(key[len(parts_prefix):]) for key in storage_backend.list_keys(parts_prefix)]
+    return jsonify({"job_id": job_id, "parts": part_numbers}), 200
+
+def complete_upload(job_id: str, user_id: str):
+    job, error_response = get_upload_job(job_id, user_id)
+    if error_response:
+        return error_response
+    parts_count = (request.json or {}).get('parts')
+    parts_prefix = f"{job_id}/{UPLOAD_PARTS_FOLDER}/"
+    part_keys = storage_backend.list_keys(parts_prefix)
+    expected_keys = [upload_part_key(job_id, part_number) for part_number in range(1, len(part_keys) + 1)]
+    if not part_keys or part_keys != expected_keys or (parts_count is not None and parts_count != len(part_keys)):
+        return jsonify({"error": "Missing upload parts", "parts": len(part_keys)}), 400
 
     try:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        if job['path_file_anonymized']:
-            blobAnonymized = bucket.blob(job['path_file_anonymized'])
-            if blobAnonymized.exists():
-                blobAnonymized.delete()
-        if job['path_file_analyzed']:
-            blobAnalyzed = bucket.blob(job['path_file_analyzed'])
-            if blobAnalyzed.exists():
-                blobAnalyzed.delete()
-
-        with engine.connect() as conn:
-            conn.execute(text('DELETE FROM jobs WHERE job_id = :job_id'), {"job_id": job_id})
-            conn.commit()
-
-        return jsonify({"message": "File deleted successfully"}), 200
+        storage_backend.compose(part_keys, upload_key(job_id))
+        stored_upload = storage_backend.stat(upload_key(job_id))
+        storage_backend.delete_prefix(parts_prefix)
+        plan = request_plan()
+        rejection = admission.check_upload_size(plan, stored_upload.size)
+        if rejection:
+            # Nothing was published: the upload is dropped and the job reported as failed
+            storage_backend.delete(upload_key(job_id))
+            job_store.transition(job_id, 'error', ('uploading',), user_id=user_id, values={"error_message": rejection.error})
+            return rejection_response(rejection)
+
+        original_filename = job['filename']
+        completed = job_store.transition(job_id, 'uploaded', ('uploading',), user_id=user_id,
+                                         values={"filename": strip_compression_extension(original_filename),
+                                                 # upload_at is when the upload session started, possibly long before
+                                                 "analysis_requested_at": datetime.now(timezone.utc)})
+        if completed.error:
+            # Another request completed this upload meanwhile and published it
+            return job_error_response(completed.error, "Upload already completed", conflict_status=409, not_found_message="Upload not found")
+
+        if pubsub_manager:
+            with timed('publish'):
+                pubsub_manager.publish(Topics.DATA_UPLOAD_REQUESTS, {
+                    'job_id': job_id,
+                    'filename': original_filename,
+                    **payload_reference('file', upload_key(job_id), stored_upload.size),
+                    **profile_flag(user_id, plan)
+                }, attributes={'job_id': job_id})
+
+        return jsonify({
+            "message": "File uploaded and analysis initiated",
+            "job_id": job_id,
+            "filename": strip_compression_extension(original_filename)
+        }), 202
     except Exception as e:
-        logger.error(f"Error deleting file: {e}")
-        return jsonify({"error": "Error deleting file"}), 500
+        logger.error(f"Error completing upload {job_id}: {e}")
+        return jsonify({"error": "Error completing upload"}), 500
+
+@app.route('/uploads', methods=['POST'])
+@firebase_auth_required
+def start_chunked_upload():
+    return create_upload(request.user_id)
+
+@app.route('/uploads/<job_id>', methods=['GET'])
+@firebase_auth_required
+def get_chunked_upload(job_id):
+    return get_upload(job_id, request.user_id)
+
+@app.route('/uploads/<job_id>/parts/<int:part_number>', methods=['PUT'])
+@firebase_auth_required
+def put_chunked_upload_part(job_id, part_number):
+    return upload_part(job_id, part_number, request.user_id)
+
+@app.route('/uploads/<job_id>/complete', methods=['POST'])
+@firebase_auth_required
+def complete_chunked_upload(job_id):
+    return complete_upload(job_id, request.user_id)
 
 # === PUB/SUB ENDPOINTS ===
 @app.route('/receive_analysis_results', methods=['POST'])
+@deduplicated_push
 def receive_analysis_results():
     envelope = request.get_json()
     if not envelope or 'message' not in envelope:
@@ -350,54 +904,58 @@ def receive_analysis_results():
     
     pubsub_message = envelope['message']
     try:
-        payload = base64.b64decode(pubsub_message['data']).decode('utf-8')
-        message_data = json.loads(payload)
+        with timed('decode'):
+            payload = base64.b64decode(pubsub_message['data']).decode('utf-8')
+            message_data = json.loads(payload)
         logger.info(f"Received analysis results: {message_data}")
         
         data = message_data.get('data')
         job_id = data.get('job_id')
-        processed_data_content_base64 = data.get('processed_data_content_base64')
-        metadata_content_base64 = data.get('metadata_content_base64')
-
-        with engine.connect() as conn:
-            result = conn.execute(text('SELECT * FROM jobs WHERE job_id = :job_id'), {"job_id": job_id})
-            job = result.mappings().first()
-        
-        if not job:
-            logger.warning(f"Received analysis results for unknown job {job_id}")
-            return jsonify({"error": "Job ID not found"}), 200
+        processed_data_format = data.get('processed_data_format', 'csv')
 
         try:
-            processed_csv = base64.b64decode(processed_data_content_base64).decode('utf-8')
-            processed_df = pd.read_csv(StringIO(processed_csv))
-            metadata_json = base64.b64decode(metadata_content_base64).decode('utf-8')
-
-            gcp_path = f"{job_id}/processed_data.csv"
-            bucket = storage_client.bucket(BUCKET_NAME)
-            blob = bucket.blob(gcp_path)
-            blob.upload_from_string(processed_df.to_csv(index=False), content_type='text/csv')
-            
-            with engine.connect() as conn:
-                conn.execute(text('''
-                    UPDATE jobs
-                    SET status = :status, path_file_analyzed = :path_file_analyzed, metadata = :metadata, rows = :rows
-                    WHERE job_id = :job_id
-                '''), {
-                    "status": 'analyzed',
-                    "path_file_analyzed": gcp_path,
-                    "metadata": metadata_json,
-                    "rows": len(processed_df),
-                    "job_id": job_id
-                })
-                conn.commit()
-            
+            if processed_data_format not in PROCESSED_DATA_FORMATS:
+                raise ValueError(f"Unsupported processed data format: {processed_data_format}")
+            # Stored compact, status responses splice it in as is
+            metadata_json = compact_json(read_payload(data, 'metadata').decode('utf-8'))
+
+            stored_name, content_type = PROCESSED_DATA_FORMATS[processed_data_format]
+            gcp_path = f"{job_id}/{stored_name}"
+            # The artifact is stored as produced by the formatter, the orchestrator never parses it
+            with timed('storage_upload'):
+                store_payload(data, 'processed_data', gcp_path, content_type=content_type)
+            rows = data.get('dataset_info', {}).get('rows', 0)
+
+            analyzed = job_store.transition(job_id, 'analyzed', ('uploaded',), values={
+                "path_file_analyzed": gcp_path,
+                "metadata": metadata_json,
+                "rows": rows,
+                # Part of the anonymization cache key of the requests made on this job
+                "analyzed_sha256": payload_sha256(data, 'processed_data'),
+                # Picks the anonymization lane without a storage round trip
+                "analyzed_size": payload_size(data, 'processed_data'),
+                **store_profile(data, job_id, 'analysis')
+            })
+            if analyzed.error == NOT_FOUND:
+                logger.warning(f"Received analysis results for unknown job {job_id}")
+                storage_backend.delete(gcp_path)
+                return jsonify({"error": "Job ID not found"}), 200
+            if analyzed.error:
+                logger.info(f"Ignoring analysis results for job {job_id} in status {analyzed.job['status']}")
+                if analyzed.job['status'] not in ('analyzed', 'anonymization_requested'):
+                    # The job is past the analyzed file, the redelivered copy is not needed
+                    storage_backend.delete(gcp_path)
+                return jsonify({"message": "Analysis results already received"}), 200
+
+            # The raw upload is not needed anymore once it has been structured
+            reaper.delete_later([upload_key(job_id)])
+
             return jsonify({"message": "Analysis results received successfully"}), 200
-            
+
         except Exception as e:
             logger.error(f"Error processing analysis results for job {job_id}: {e}")
-            with engine.connect() as conn:
-                conn.execute(text('UPDATE jobs SET status = :status WHERE job_id = :job_id'), {"status": "error", "job_id": job_id})
-                conn.commit()
+            # Only a job still waiting for its analysis is failed, a redelivery cannot undo a processed one
+            job_store.transition(job_id, 'error', ('uploaded',))
             return jsonify({"error": str(e)}), 200
             
     except Exception as e:
@@ -405,6 +963,7 @@ def receive_analysis_results():
         return 'Bad Request', 200
 
 @app.route('/receive_anonymization_results', methods=['POST'])
+@deduplicated_push
 def receive_anonymization_results():
     envelope = request.get_json()
     if not envelope or 'message' not in envelope:
@@ -413,52 +972,38 @@ def receive_anonymization_results():
     
     pubsub_message = envelope['message']
     try:
-        payload = base64.b64decode(pubsub_message['data']).decode('utf-8')
-        message_data = json.loads(payload)
+        with timed('decode'):
+            payload = base64.b64decode(pubsub_message['data']).decode('utf-8')
+            message_data = json.loads(payload)
         logger.info(f"Received anonymization results: {message_data}")
         
         data = message_data.get('data')
         job_id = data.get('job_id')
-        anonymized_file_content_base64 = data.get('anonymized_file_content_base64')
-        anonymized_sample_content_base64 = data.get('anonymized_sample_content_base64')
-        completed_at = datetime.now().isoformat()
-
-        anonymized_csv = base64.b64decode(anonymized_file_content_base64).decode('utf-8')
-        anonymized_df = pd.read_csv(StringIO(anonymized_csv))
-
-        anonymized_sample_csv = base64.b64decode(anonymized_sample_content_base64).decode('utf-8')
-        anonymized_sample_df = pd.read_csv(StringIO(anonymized_sample_csv))
+        # The preview arrives already serialized as JSON records, it is stored compact
+        anonymized_preview_json = compact_json(data.get('anonymized_preview'))
+        completed_at = datetime.now(timezone.utc)
 
         gcp_path = f"{job_id}/anonymized_data.csv"
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(gcp_path)
-        blob.upload_from_string(anonymized_df.to_csv(index=False), content_type='text/csv')
-
-        with engine.connect() as conn:
-            result = conn.execute(text('SELECT path_file_analyzed FROM jobs WHERE job_id = :job_id'), {"job_id": job_id})
-            job = result.mappings().first()
-        analyzed_file_path = job['path_file_analyzed']
-        if analyzed_file_path:
-            analyzed_blob = bucket.blob(analyzed_file_path)
-            if analyzed_blob.exists():
-                analyzed_blob.delete()
-
-        anonymized_preview_json = anonymized_sample_df.to_json(orient='records', indent=4)
-
-        with engine.connect() as conn:
-            conn.execute(text('''
-                UPDATE jobs
-                SET path_file_analyzed = :path_file_analyzed, status = :status, anonymized_preview = :anonymized_preview, path_file_anonymized = :path_file_anonymized, completed_at = :completed_at
-                WHERE job_id = :job_id
-            '''), {
-                "path_file_analyzed": None,
-                "status": "anonymized",
-                "anonymized_preview": anonymized_preview_json,
-                "path_file_anonymized": gcp_path,
-                "completed_at": completed_at,
-                "job_id": job_id
-            })
-            conn.commit()
+        with timed('storage_upload'):
+            store_payload(data, 'anonymized_file', gcp_path, content_type='text/csv')
+
+        anonymized = job_store.transition(job_id, 'anonymized', ('anonymization_requested',), values={
+            "path_file_analyzed": None,
+            "anonymized_preview": anonymized_preview_json,
+            "path_file_anonymized": gcp_path,
+            "completed_at": completed_at,
+            **store_profile(data, job_id, 'anonymization')
+        })
+        if anonymized.error:
+            logger.warning(f"Ignoring anonymization results for job {job_id}: {anonymized.error}")
+            if anonymized.error == NOT_FOUND:
+                storage_backend.delete(gcp_path)
+            return jsonify({"message": "Anonymization results ignored"}), 200
+
+        # The analyzed file is only needed until the job is anonymized
+        reaper.delete_later(processed_data_keys(job_id))
+        if data.get('queue_wait_seconds') is not None:
+            queue_waits.record(data.get('lane') or SMALL_LANE, float(data['queue_wait_seconds']))
 
         logger.info(f"Anonymization results received for job {job_id}")
         return jsonify({"message": "Anonymization results received successfully"}), 200
@@ -468,6 +1013,7 @@ def receive_anonymization_results():
         return 'Bad Request', 200
 
 @app.route('/receive_error_notifications', methods=['POST'])
+@deduplicated_push
 def receive_error_notifications():
     envelope = request.get_json()
     if not envelope or 'message' not in envelope:
@@ -476,8 +1022,9 @@ def receive_error_notifications():
     
     pubsub_message = envelope['message']
     try:
-        payload = base64.b64decode(pubsub_message['data']).decode('utf-8')
-        message_data = json.loads(payload)
+        with timed('decode'):
+            payload = base64.b64decode(pubsub_message['data']).decode('utf-8')
+            message_data = json.loads(payload)
         logger.info(f"Received Pub/Sub push: {message_data}")
         data = message_data.get('data')
         job_id = data.get('job_id')
@@ -488,19 +1035,21 @@ def receive_error_notifications():
             logger.error("Missing job_id, stage or error message in Pub/Sub notification")
             return jsonify({"error": "Missing job_id, stage or error message"}), 200
 
-        with engine.connect() as conn:
-            result = conn.execute(text('SELECT job_id FROM jobs WHERE job_id = :job_id'), {"job_id": job_id})
-            job = result.mappings().first()
-            
-            if job:
-                conn.execute(text('UPDATE jobs SET status = :status, completed_at = :completed_at, error_message = :error_message WHERE job_id = :job_id'), 
-                           {"status": 'error', "completed_at": datetime.now().isoformat(), "error_message":error_message, "job_id": job_id})
-                conn.commit()
-                logger.error(f"Error notification received for job {job_id} in stage {stage}: {error_message}")
-                return jsonify({"message": "Error notification received successfully"}), 200
-            else:
-                logger.warning(f"Received error for unknown job {job_id} in stage {stage}")
-                return jsonify({"error": "Job ID not found"}), 200
+        # A completed (or already failed) job is left as it is
+        failed = job_store.transition(job_id, 'error', ACTIVE_JOB_STATUSES, values={
+            "completed_at": datetime.now(timezone.utc),
+            "error_message": error_message,
+            # The profile of a failing job is often the one wanted most
+            **store_profile(data, job_id, stage if stage in ('analysis', 'anonymization') else 'error')
+        })
+        if failed.error == NOT_FOUND:
+            logger.warning(f"Received error for unknown job {job_id} in stage {stage}")
+            return jsonify({"error": "Job ID not found"}), 200
+        if failed.error:
+            logger.warning(f"Ignoring error for job {job_id} in status {failed.job['status']}, stage {stage}: {error_message}")
+            return jsonify({"message": "Error notification ignored"}), 200
+        logger.error(f"Error notification received for job {job_id} in stage {stage}: {error_message}")
+        return jsonify({"message": "Error notification received successfully"}), 200
                     
     except Exception as e:
         logger.error(f"Failed to process incoming Pub/Sub push: {e}", exc_info=True)
@@ -511,178 +1060,64 @@ MOCK_USER_ID = "mocked-user"
 
 @app.route('/noauth_upload_and_analyze', methods=['POST'])
 def noauth_upload_and_analyze():
-    request.user_id = MOCK_USER_ID
-    if 'file' not in request.files:
-        return jsonify({"error": "No file part"}), 400
-
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({"error": "No selected file"}), 400
-
-    if file:
-        job_id = str(uuid.uuid4()) + '-' + datetime.now().strftime("%Y%m%d%H%M%S")
-        original_filename = file.filename
+    return upload_and_analyze_response(MOCK_USER_ID)
 
-        file_content_bytes = file.read()
-        encoded_file_content = base64.b64encode(file_content_bytes).decode('utf-8')
+@app.route('/noauth_uploads', methods=['POST'])
+def noauth_start_chunked_upload():
+    return create_upload(MOCK_USER_ID)
 
-        upload_at = datetime.now().isoformat()
-        
-        with engine.connect() as conn:
-            conn.execute(text('''
-                INSERT INTO jobs (job_id, user_id, filename, rows, metadata, path_file_analyzed, method, anonymized_preview, path_file_anonymized, upload_at, completed_at, status)
-                VALUES (:job_id, :user_id, :filename, :rows, :metadata, :path_file_analyzed, :method, :anonymized_preview, :path_file_anonymized, :upload_at, :completed_at, :status)
-            '''), {
-                "job_id": job_id,
-                "user_id": request.user_id,
-                "filename": original_filename,
-                "rows": 0,
-                "metadata": None,
-                "path_file_analyzed": None,
-                "method": None,
-                "anonymized_preview": None,
-                "path_file_anonymized": None,
-                "upload_at": upload_at,
-                "completed_at": None,
-                "status": 'uploaded'
-            })
-            conn.commit()
+@app.route('/noauth_uploads/<job_id>', methods=['GET'])
+def noauth_get_chunked_upload(job_id):
+    return get_upload(job_id, MOCK_USER_ID)
 
-        if pubsub_manager:
-            pubsub_manager.publish(Topics.DATA_UPLOAD_REQUESTS, {
-                'job_id': job_id,
-                'filename': original_filename,
-                'file_content_base64': encoded_file_content
-            }, attributes={'job_id': job_id})
+@app.route('/noauth_uploads/<job_id>/parts/<int:part_number>', methods=['PUT'])
+def noauth_put_chunked_upload_part(job_id, part_number):
+    return upload_part(job_id, part_number, MOCK_USER_ID)
 
-        return jsonify({
-            "message": "File uploaded and analysis initiated",
-            "job_id": job_id,
-            "filename": original_filename
-        }), 202
+@app.route('/noauth_uploads/<job_id>/complete', methods=['POST'])
+def noauth_complete_chunked_upload(job_id):
+    return complete_upload(job_id, MOCK_USER_ID)
 
 @app.route('/noauth_request_anonymization', methods=['POST'])
 def noauth_request_anonymization():
-    request.user_id = MOCK_USER_ID
-    data = request.json
-    job_id = data.get('job_id')
-    method = data.get('method')
-    params = data.get('params')
-    user_selections = data.get('user_selections')
-
-    if not all([job_id, method, user_selections is not None]):
-        return jsonify({"error": "Missing job_id, method, or user_selections"}), 400
+    return anonymization_request_response(MOCK_USER_ID)
 
-    with engine.connect() as conn:
-        result = conn.execute(text('SELECT * FROM jobs WHERE job_id = :job_id'), {"job_id": job_id})
-        job = result.mappings().first()
-    
-    if not job:
-        return jsonify({"error": "Job not found"}), 404
-    if job['user_id'] != request.user_id:
-        return jsonify({"error": "Unauthorized access to this job"}), 403
-    if job['status'] != 'analyzed':
-        return jsonify({"error": "Job is not ready for anonymization"}), 400
-
-    gcp_path = job['path_file_analyzed']
-    if not gcp_path:
-        return jsonify({"error": "No analyzed file path found for this job"}), 400
-
-    try:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(gcp_path)
-        processed_csv_content = blob.download_as_text()
-        encoded_processed_csv = base64.b64encode(processed_csv_content.encode('utf-8')).decode('utf-8')
-
-        metadata_json_content = job['metadata']
-        encoded_metadata_json = base64.b64encode(metadata_json_content.encode('utf-8')).decode('utf-8')
-
-        if pubsub_manager:
-            pubsub_manager.publish(Topics.ANONYMIZATION_REQUESTS, {
-                'job_id': job_id,
-                'method': method,
-                'params': params,
-                'user_selections': user_selections,
-                'processed_data_content_base64': encoded_processed_csv,
-                'metadata_content_base64': encoded_metadata_json
-            }, attributes={'job_id': job_id})
-
-        with engine.connect() as conn:
-            conn.execute(text('UPDATE jobs SET status = :status, method = :method WHERE job_id = :job_id'), 
-                       {"status": 'anonymization_requested', "method": method, "job_id": job_id})
-            conn.commit()
-
-        return jsonify({"message": "Anonymization request published", "job_id": job_id}), 202
-    
-    except Exception as e:
-        logger.error(f"Error in request_anonymization: {e}")
-        return jsonify({"error": "Internal server error"}), 500
+@app.route('/noauth_jobs', methods=['DELETE'])
+def noauth_delete_jobs():
+    return delete_jobs_response(MOCK_USER_ID)
 
 @app.route('/noauth_get_status/<job_id>', methods=['GET'])
 def noauth_get_status(job_id):
     request.user_id = MOCK_USER_ID
-    acquired = get_status_lock.acquire(timeout=10)  # Timeout 10 seconds
-    if not acquired:
-        return jsonify({'error': 'busy', 'details': 'Too many clients fetching status, please retry.'}), 429  # Too Many Requests
+    return job_status_response(job_id, request.user_id)
 
-    try:
-        with engine.connect() as conn:
-            result = conn.execute(text('SELECT * FROM jobs WHERE job_id = :job_id'), {"job_id": job_id})
-            job = result.mappings().first()
-        
-        if not job:
-            return jsonify({'error': 'not_found', 'details': 'Job ID not found'}), 404
-        if job['user_id'] != request.user_id:
-            return jsonify({'error': 'Unauthorized'}), 403
-
-        response_status = {
-            "job_id": job['job_id'],
-            "filename": job['filename'],
-            "status": job['status'],
-            "upload_at": job['upload_at'],
-            "completed_at": job['completed_at'],
-            "rows": job['rows'],
-            "method": job['method'],
-            "metadata": json.loads(job['metadata']) if job['metadata'] else None,        
-            "anonymized_preview": json.loads(job['anonymized_preview']) if job['anonymized_preview'] else None,
-            "error_message": job['error_message'] if job.get('error_message') else None
-        }
-        return jsonify(response_status), 200
-    finally:
-        get_status_lock.release()
+@app.route('/noauth_status_stream/<job_id>', methods=['GET'])
+def noauth_status_stream(job_id):
+    return job_status_stream(job_id, MOCK_USER_ID)
 
 @app.route('/noauth_download/<job_id>', methods=['GET'])
 def noauth_download(job_id):
-    request.user_id = MOCK_USER_ID
-    with engine.connect() as conn:
-        result = conn.execute(text('SELECT * FROM jobs WHERE job_id = :job_id'), {"job_id": job_id})
-        job = result.mappings().first()
-    
-    if not job:
-        return jsonify({"error": "Job not found"}), 404
-    if job['user_id'] != request.user_id:
-        return jsonify({"error": "Unauthorized access to this job"}), 403
-    if job['status'] != 'anonymized':
-        return jsonify({"error": "File not ready. Still processing."}), 400
-    
-    try:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(job['path_file_anonymized'])
-        if not blob.exists():
-            return jsonify({"error": "Anonymized file not found in GCP bucket"}), 404
-        
-        file_content = blob.download_as_text()
-        download_name = job['filename'] if job['filename'] else f"anonymized_file_{job_id}.csv"
-        
-        return send_file(
-            BytesIO(file_content.encode("utf-8")),
-            as_attachment=True,
-            download_name=download_name,
-            mimetype='text/csv'
-        )
-    except Exception as e:
-        logger.error(f"Error downloading file: {e}")
-        return jsonify({"error": "Error downloading file"}), 500
+    return download_response(job_id, MOCK_USER_ID)
+
+# Internal counters, e.g. to check the token cache hit rate or how many redeliveries were skipped
+@app.route('/internal/stats', methods=['GET'])
+@firebase_auth_required
+def internal_stats():
+    if request_plan().name not in STATS_PLANS:
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify({
+        "token_cache": token_cache.stats(),
+        "reaper": reaper.stats(),
+        "anonymization_cache": anonymization_cache.stats(),
+        "admission": admission.stats(),
+        "queue_wait": queue_waits.stats(),
+        "duplicate_messages": deduplicator.duplicates if deduplicator else None
+    }), 200
+
+# Prometheus metrics: per-stage latency histograms, rows/bytes processed, queue delays, memory
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return metrics_response()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=False)
\ No newline at end of file
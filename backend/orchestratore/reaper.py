@@ -0,0 +1,201 @@
+# reaper.py
+# Storage garbage collection, off the request path. Deleted jobs are only marked ('deleted' status) by
+# the API; this background thread removes their artifacts by job prefix, with retries, and then their
+# rows. On a slower schedule it also expires abandoned jobs and sweeps storage prefixes left without a job.
+# On Postgres an advisory lock lets a single orchestrator instance run each pass.
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Iterable, List, Optional
+from sqlalchemy import bindparam, text
+from job_state import job_id_created_at
+
+logger = logging.getLogger(__name__)
+
+REAPER_LOCK_ID = 7204062
+REAPER_INTERVAL_SECONDS = int(os.environ.get('REAPER_INTERVAL_SECONDS', 60))
+REAPER_SWEEP_INTERVAL_SECONDS = int(os.environ.get('REAPER_SWEEP_INTERVAL_SECONDS', 3600))
+REAPER_BATCH_SIZE = 100
+REAPER_MAX_BACKOFF_SECONDS = 3600
+# Uploads never completed, and jobs the formatter or the anonymizer never answered for, are given up after
+# these delays; the timeouts run from when the analysis or the anonymization was requested
+UPLOAD_EXPIRY = timedelta(hours=int(os.environ.get('UPLOAD_EXPIRY_HOURS', 24)))
+ANALYSIS_TIMEOUT = timedelta(hours=int(os.environ.get('ANALYSIS_TIMEOUT_HOURS', 1)))
+# Longer than the one hour request timeout of the large anonymizer lane
+ANONYMIZATION_TIMEOUT = timedelta(hours=int(os.environ.get('ANONYMIZATION_TIMEOUT_HOURS', 3)))
+# Failed jobs stay visible to their owner for this long, then they are deleted
+ERROR_RETENTION = timedelta(hours=int(os.environ.get('JOB_ERROR_RETENTION_HOURS', 7 * 24)))
+# A prefix without a job row is only an orphan once it is older than this (the upload is stored before the row is inserted)
+ORPHAN_GRACE = timedelta(hours=1)
+
+class StorageReaper:
+    def __init__(self, engine, storage, on_change: Callable[[str], None] = lambda job_id: None):
+        self.engine = engine
+        self.storage = storage
+        self.on_change = on_change
+        self._wake = threading.Event()
+        self._pending_keys = deque()
+        self._retry_at = {}
+        self._attempts = {}
+        self._last_sweep = 0.0
+        self._thread = None
+        self.reaped_jobs = 0
+        self.orphan_prefixes = 0
+        self.expired_jobs = 0
+        self.failures = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run_forever, name='storage-reaper', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        """Runs a pass right away, e.g. after jobs were marked deleted."""
+        self._wake.set()
+
+    def delete_later(self, keys: Iterable[str]):
+        """Single objects no longer needed (e.g. an analyzed file once the job is anonymized)."""
+        self._pending_keys.extend(keys)
+        self._wake.set()
+
+    def stats(self) -> dict:
+        return {
+            'reaped_jobs': self.reaped_jobs,
+            'expired_jobs': self.expired_jobs,
+            'orphan_prefixes': self.orphan_prefixes,
+            'pending_keys': len(self._pending_keys),
+            'retrying_jobs': len(self._retry_at),
+            'failures': self.failures
+        }
+
+    def _run_forever(self):
+        while True:
+            self._wake.wait(REAPER_INTERVAL_SECONDS)
+            self._wake.clear()
+            try:
+                self.run_once(sweep=time.monotonic() - self._last_sweep >= REAPER_SWEEP_INTERVAL_SECONDS)
+            except Exception as e:
+                logger.error(f"Storage reaper pass failed: {e}", exc_info=True)
+
+    def run_once(self, sweep: bool = False):
+        self._delete_pending_keys()
+        with self.engine.connect() as conn:
+            if not self._try_lock(conn):
+                return
+            try:
+                if sweep:
+                    self._last_sweep = time.monotonic()
+                    self._expire_jobs(conn)
+                    self._sweep_orphans(conn)
+                self._reap_deleted_jobs(conn)
+            finally:
+                self._unlock(conn)
+
+    def _try_lock(self, conn) -> bool:
+        if self.engine.dialect.name != 'postgresql':
+            return True
+        # Another instance already running a pass is fine: this one skips it
+        return conn.execute(text('SELECT pg_try_advisory_lock(:lock_id)'), {"lock_id": REAPER_LOCK_ID}).scalar()
+
+    def _unlock(self, conn):
+        if self.engine.dialect.name == 'postgresql':
+            conn.rollback()
+            conn.execute(text('SELECT pg_advisory_unlock(:lock_id)'), {"lock_id": REAPER_LOCK_ID})
+            conn.commit()
+
+    def _delete_pending_keys(self):
+        for _ in range(len(self._pending_keys)):
+            key = self._pending_keys.popleft()
+            try:
+                self.storage.delete(key)
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"Could not delete {key}, retrying on the next pass: {e}")
+                self._pending_keys.append(key)
+
+    def _reap_deleted_jobs(self, conn):
+        job_ids = [row[0] for row in conn.execute(text('''
+            SELECT job_id FROM jobs WHERE status = 'deleted' ORDER BY deleted_at LIMIT :limit
+        '''), {"limit": REAPER_BATCH_SIZE})]
+        conn.commit()
+        now = time.monotonic()
+        reaped = []
+        for job_id in job_ids:
+            if self._retry_at.get(job_id, 0) > now:
+                continue
+            try:
+                self.storage.delete_prefix(f"{job_id}/")
+                reaped.append(job_id)
+                self._retry_at.pop(job_id, None)
+                self._attempts.pop(job_id, None)
+            except Exception as e:
+                # Exponential backoff per job, the row stays until its artifacts are gone
+                attempts = self._attempts.get(job_id, 0) + 1
+                self._attempts[job_id] = attempts
+                self._retry_at[job_id] = now + min(REAPER_INTERVAL_SECONDS * 2 ** attempts, REAPER_MAX_BACKOFF_SECONDS)
+                self.failures += 1
+                logger.warning(f"Could not delete the artifacts of job {job_id} (attempt {attempts}): {e}")
+        if reaped:
+            conn.execute(text("DELETE FROM jobs WHERE job_id IN :job_ids AND status = 'deleted'")
+                         .bindparams(bindparam('job_ids', expanding=True)), {"job_ids": reaped})
+            # Cached anonymization results pointing at these jobs are gone with them
+            conn.execute(text('DELETE FROM anonymization_cache WHERE job_id IN :job_ids')
+                         .bindparams(bindparam('job_ids', expanding=True)), {"job_ids": reaped})
+            conn.commit()
+            self.reaped_jobs += len(reaped)
+            logger.info(f"Reaped {len(reaped)} deleted jobs")
+        if len(job_ids) == REAPER_BATCH_SIZE and reaped:
+            # More deleted jobs are waiting, do not wait for the next interval
+            self._wake.set()
+
+    def _expire_jobs(self, conn):
+        now = datetime.now(timezone.utc)
+        # Jobs created before the request times were recorded fall back to their upload time
+        timed_out = conn.execute(text('''
+            UPDATE jobs SET status = 'error', completed_at = :now, error_message = 'Analysis timed out'
+            WHERE status = 'uploaded' AND COALESCE(analysis_requested_at, upload_at) < :analysis_cutoff
+            RETURNING job_id
+        '''), {"now": now, "analysis_cutoff": now - ANALYSIS_TIMEOUT}).fetchall()
+        timed_out += conn.execute(text('''
+            UPDATE jobs SET status = 'error', completed_at = :now, error_message = 'Anonymization timed out'
+            WHERE status = 'anonymization_requested' AND COALESCE(anonymization_requested_at, upload_at) < :anonymization_cutoff
+            RETURNING job_id
+        '''), {"now": now, "anonymization_cutoff": now - ANONYMIZATION_TIMEOUT}).fetchall()
+        expired = conn.execute(text('''
+            UPDATE jobs SET status = 'deleted', deleted_at = :now
+            WHERE (status = 'uploading' AND upload_at < :upload_cutoff)
+               OR (status = 'error' AND COALESCE(completed_at, upload_at) < :error_cutoff)
+            RETURNING job_id
+        '''), {"now": now, "upload_cutoff": now - UPLOAD_EXPIRY, "error_cutoff": now - ERROR_RETENTION}).fetchall()
+        conn.commit()
+        for row in timed_out + expired:
+            self.on_change(row[0])
+        if timed_out or expired:
+            self.expired_jobs += len(expired)
+            logger.info(f"Timed out {len(timed_out)} jobs waiting for their analysis or anonymization, expired {len(expired)} jobs")
+
+    def _sweep_orphans(self, conn):
+        cutoff = datetime.now(timezone.utc) - ORPHAN_GRACE
+        # Prefixes whose id cannot be dated (not a job) are never touched
+        candidates = [prefix for prefix in self.storage.list_prefixes()
+                      if (job_id_created_at(prefix) or cutoff) < cutoff]
+        orphans: List[str] = []
+        for offset in range(0, len(candidates), REAPER_BATCH_SIZE):
+            batch = candidates[offset:offset + REAPER_BATCH_SIZE]
+            known = {row[0] for row in conn.execute(text('SELECT job_id FROM jobs WHERE job_id IN :job_ids')
+                                                    .bindparams(bindparam('job_ids', expanding=True)), {"job_ids": batch})}
+            orphans.extend(job_id for job_id in batch if job_id not in known)
+        conn.commit()
+        for job_id in orphans:
+            try:
+                self.storage.delete_prefix(f"{job_id}/")
+                self.orphan_prefixes += 1
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"Could not delete orphaned prefix {job_id}/: {e}")
+        if orphans:
+            logger.info(f"Swept {len(orphans)} orphaned storage prefixes")
@@ -0,0 +1,82 @@
+# response_encoding.py
+# Polled JSON responses (job status, file list) are assembled from compact JSON fragments that were
+# serialized once, when the job was written, instead of being parsed and re-serialized per request
+# (on Postgres, which renders JSONB with spaces, they are compacted when read, see stored_json).
+# Bodies are compressed once per version (gzip, and brotli when the module is installed) and carry a
+# weak ETag, so an unchanged poll is answered with 304 Not Modified and no body at all.
+
+import os
+import gzip
+import json
+from typing import Any, Dict, Mapping, Optional
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller bodies are sent as they are, compressing them costs more than it saves
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Preferred first when the client accepts several
+CONTENT_ENCODINGS = ('br', 'gzip')
+
+def compact_json(json_text: Optional[str]) -> Optional[str]:
+    """Re-serializes stored JSON without whitespace (e.g. previews produced with indent=4)."""
+    if not json_text:
+        return None
+    return json.dumps(json.loads(json_text), separators=(',', ':'))
+
+def json_with_fragments(fields: Mapping[str, Any], fragments: Mapping[str, Optional[str]]) -> str:
+    """A JSON object of fields plus fragments, already serialized JSON values spliced in without being parsed."""
+    body = json.dumps(fields, separators=(',', ':'))
+    if not fragments:
+        return body
+    spliced = ','.join(f'{json.dumps(name)}:{fragment or "null"}' for name, fragment in fragments.items())
+    return f"{body[:-1]},{spliced}}}" if fields else f"{{{spliced}}}"
+
+def encode_body(body: str) -> Dict[str, bytes]:
+    """The body in every content coding worth sending, keyed by coding ('identity' is always there)."""
+    raw = body.encode('utf-8')
+    encodings = {'identity': raw}
+    if len(raw) >= COMPRESS_MIN_BYTES:
+        encodings['gzip'] = gzip.compress(raw, compresslevel=GZIP_LEVEL, mtime=0)
+        if brotli is not None:
+            encodings['br'] = brotli.compress(raw, quality=BROTLI_QUALITY)
+    return encodings
+
+def accepted_encoding(available: Mapping[str, bytes]) -> str:
+    accepted = {}
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        accepted[name.strip().lower()] = quality
+    for coding in CONTENT_ENCODINGS:
+        if coding in available and accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+    return 'identity'
+
+def conditional_json_response(encodings: Mapping[str, bytes], etag: str, status: int = 200) -> Response:
+    """
+    200 with the best encoding the client accepts, or 304 when If-None-Match has the etag.
+    The ETag is weak: it names the job version, not the bytes of one encoding.
+    """
+    headers = {
+        'ETag': f'W/"{etag}"',
+        # Per user data: never shared by proxies, always revalidated by the client
+        'Cache-Control': 'private, no-cache',
+        'Vary': 'Accept-Encoding, Authorization'
+    }
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    coding = accepted_encoding(encodings)
+    if coding != 'identity':
+        headers['Content-Encoding'] = coding
+    return Response(encodings[coding], status=status, headers=headers, mimetype='application/json')
@@ -0,0 +1,78 @@
+# status_cache.py
+# In-process cache of serialized job status responses. Polls for the same job share one DB query
+# (single-flight) and the entry is dropped as soon as this instance changes the job; writes made by
+# other instances become visible after at most the TTL.
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+STATUS_CACHE_TTL_SECONDS = float(os.environ.get('STATUS_CACHE_TTL_SECONDS', 2.0))
+STATUS_CACHE_MAX_ENTRIES = int(os.environ.get('STATUS_CACHE_MAX_ENTRIES', 10000))
+
+class CachedStatus(NamedTuple):
+    user_id: str  # Owner of the job
+    version: int
+    status: str
+    body: str  # Serialized JSON response
+    encodings: Dict[str, bytes]  # body in each content coding, see response_encoding.encode_body
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Optional[CachedStatus] = None
+        self.error: Optional[BaseException] = None
+
+class StatusCache:
+    def __init__(self, ttl_seconds: float = STATUS_CACHE_TTL_SECONDS, max_entries: int = STATUS_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[str, Tuple[float, CachedStatus]]' = OrderedDict()
+        self._in_flight = {}
+        # Bumped by invalidate: a load that started before an invalidation must not be cached
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, job_id: str, loader: Callable[[], Optional[CachedStatus]]) -> Optional[CachedStatus]:
+        """Returns the cached status of a job, calling loader at most once for concurrent misses. None results are not cached."""
+        with self._lock:
+            entry = self._entries.get(job_id)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(job_id)
+                return entry[1]
+            in_flight = self._in_flight.get(job_id)
+            is_leader = in_flight is None
+            if is_leader:
+                in_flight = self._in_flight[job_id] = _InFlight()
+                generation = self._generations.get(job_id, 0)
+
+        if not is_leader:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.value
+
+        try:
+            in_flight.value = loader()
+        except BaseException as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[job_id]
+                invalidated = self._generations.pop(job_id, 0) != generation
+                if in_flight.value is not None and not invalidated:
+                    self._entries[job_id] = (time.monotonic() + self.ttl_seconds, in_flight.value)
+                    self._entries.move_to_end(job_id)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            in_flight.done.set()
+        return in_flight.value
+
+    def invalidate(self, job_id: str):
+        with self._lock:
+            self._entries.pop(job_id, None)
+            if job_id in self._in_flight:
+                self._generations[job_id] = self._generations.get(job_id, 0) + 1
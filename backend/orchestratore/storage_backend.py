@@ -0,0 +1,371 @@
+# storage_backend.py
+# This library is general purpose for all of the backend services, it hides where job artifacts and claim-check payloads are stored.
+# STORAGE_BACKEND selects the implementation: 'gcs' (default, bucket from BUCKET_NAME) or 'local' (directory from LOCAL_STORAGE_ROOT, for tests and local runs)
+
+import os
+import shutil
+import uuid
+import hashlib
+import logging
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'gcs')
+BUCKET_NAME = os.environ.get('BUCKET_NAME')
+LOCAL_STORAGE_ROOT = os.environ.get('LOCAL_STORAGE_ROOT', 'local_storage')
+STREAM_CHUNK_BYTES = 256 * 1024
+
+class ObjectInfo(NamedTuple):
+    size: int
+    etag: str
+
+class StoredObject(NamedTuple):
+    size: int
+    sha256: str
+
+class StorageBackend(ABC):
+    """
+    Key/value object store; keys are '/' separated paths, job artifacts live under '<job_id>/'.
+    Implementations must provide every abstract method (they cannot be instantiated otherwise).
+    """
+
+    @abstractmethod
+    def uri(self, key: str) -> str:
+        ...
+
+    @abstractmethod
+    def key_from_uri(self, uri: str) -> str:
+        ...
+
+    @abstractmethod
+    def put_bytes(self, key: str, data: bytes, content_type: Optional[str] = None):
+        ...
+
+    @abstractmethod
+    def create_if_absent(self, key: str, data: bytes) -> bool:
+        """Writes the object only if it does not exist yet, atomically; returns whether it was created."""
+        ...
+
+    def put_stream(self, key: str, stream: BinaryIO, content_type: Optional[str] = None,
+                   chunk_size: int = STREAM_CHUNK_BYTES) -> StoredObject:
+        """Copies a binary stream into an object chunk by chunk, computing its size and SHA-256 on the way."""
+        digest = hashlib.sha256()
+        size = 0
+        with self.open_write(key, content_type) as destination:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                destination.write(chunk)
+        return StoredObject(size=size, sha256=digest.hexdigest())
+
+    @abstractmethod
+    def get_bytes(self, key: str) -> bytes:
+        ...
+
+    @abstractmethod
+    def open_read(self, key: str) -> BinaryIO:
+        ...
+
+    @abstractmethod
+    def open_write(self, key: str, content_type: Optional[str] = None) -> BinaryIO:
+        """Writable file object, the object becomes visible once it is closed."""
+        ...
+
+    @abstractmethod
+    def list_keys(self, prefix: str) -> List[str]:
+        ...
+
+    @abstractmethod
+    def list_prefixes(self) -> List[str]:
+        """Top level prefixes, without the trailing '/': one per job."""
+        ...
+
+    @abstractmethod
+    def compose(self, source_keys: List[str], destination_key: str, content_type: Optional[str] = None):
+        """Concatenates source objects, in order, into destination_key."""
+        ...
+
+    @abstractmethod
+    def stat(self, key: str) -> Optional[ObjectInfo]:
+        """Size and entity tag of an object, None when it does not exist."""
+        ...
+
+    def iter_range(self, key: str, start: int = 0, end: Optional[int] = None,
+                   chunk_size: int = STREAM_CHUNK_BYTES) -> Iterator[bytes]:
+        """Yields the bytes start..end (inclusive, end=None means up to the end) in chunks of at most chunk_size."""
+        with self.open_read(key) as stream:
+            if start:
+                stream.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                chunk = stream.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    def move(self, source_key: str, destination_key: str):
+        """Rename an object without moving its bytes through the caller."""
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Delete an object, missing objects are ignored."""
+        ...
+
+    @abstractmethod
+    def delete_prefix(self, prefix: str) -> int:
+        """Delete every object whose key starts with prefix, returns how many were deleted."""
+        ...
+
+GCS_COMPOSE_MAX_SOURCES = 32
+GCS_BATCH_MAX_CALLS = 100
+
+class GCSStorageBackend(StorageBackend):
+    def __init__(self, bucket_name: str):
+        from google.cloud import storage
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+        if not bucket_name:
+            raise ValueError("BUCKET_NAME environment variable not set.")
+        self._not_found = NotFound
+        self._precondition_failed = PreconditionFailed
+        self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+        logger.info(f"Initialized GCS storage backend on bucket: {bucket_name}")
+
+    def uri(self, key: str) -> str:
+        return f"gs://{self.bucket.name}/{key}"
+
+    def key_from_uri(self, uri: str) -> str:
+        prefix = f"gs://{self.bucket.name}/"
+        if not uri.startswith(prefix):
+            raise ValueError(f"URI {uri} does not belong to bucket {self.bucket.name}")
+        return uri[len(prefix):]
+
+    def put_bytes(self, key: str, data: bytes, content_type: Optional[str] = None):
+        self.bucket.blob(key).upload_from_string(data, content_type=content_type or 'application/octet-stream')
+
+    def create_if_absent(self, key: str, data: bytes) -> bool:
+        # Generation 0 matches only an object that does not exist
+        try:
+            self.bucket.blob(key).upload_from_string(data, if_generation_match=0)
+            return True
+        except self._precondition_failed:
+            return False
+
+    def get_bytes(self, key: str) -> bytes:
+        return self.bucket.blob(key).download_as_bytes()
+
+    def open_read(self, key: str) -> BinaryIO:
+        return self.bucket.blob(key).open('rb', chunk_size=STREAM_CHUNK_BYTES)
+
+    def open_write(self, key: str, content_type: Optional[str] = None) -> BinaryIO:
+        # Resumable upload session, chunk_size must be a multiple of 256 KiB
+        return self.bucket.blob(key).open('wb', chunk_size=STREAM_CHUNK_BYTES * 32,
+                                          content_type=content_type or 'application/octet-stream')
+
+    def list_keys(self, prefix: str) -> List[str]:
+        return [blob.name for blob in self.client.list_blobs(self.bucket, prefix=prefix)]
+
+    def list_prefixes(self) -> List[str]:
+        # With a delimiter the listing returns the "directories" instead of every object
+        prefixes = set()
+        for page in self.client.list_blobs(self.bucket, delimiter='/').pages:
+            prefixes.update(prefix.rstrip('/') for prefix in page.prefixes)
+        return sorted(prefixes)
+
+    def compose(self, source_keys: List[str], destination_key: str, content_type: Optional[str] = None):
+        # A compose call accepts at most 32 sources, larger lists are folded into the destination
+        destination = self.bucket.blob(destination_key)
+        destination.content_type = content_type or 'application/octet-stream'
+        sources = [self.bucket.blob(key) for key in source_keys]
+        destination.compose(sources[:GCS_COMPOSE_MAX_SOURCES])
+        for offset in range(GCS_COMPOSE_MAX_SOURCES, len(sources), GCS_COMPOSE_MAX_SOURCES - 1):
+            destination.compose([destination] + sources[offset:offset + GCS_COMPOSE_MAX_SOURCES - 1])
+
+    def stat(self, key: str) -> Optional[ObjectInfo]:
+        blob = self.bucket.get_blob(key)
+        if blob is None:
+            return None
+        return ObjectInfo(size=blob.size, etag=blob.etag.strip('"'))
+
+    def exists(self, key: str) -> bool:
+        return self.bucket.blob(key).exists()
+
+    def move(self, source_key: str, destination_key: str):
+        # Server-side copy followed by a delete of the source
+        self.bucket.rename_blob(self.bucket.blob(source_key), destination_key)
+
+    def delete(self, key: str):
+        try:
+            self.bucket.blob(key).delete()
+        except self._not_found:
+            pass
+
+    def delete_prefix(self, prefix: str) -> int:
+        blobs = list(self.client.list_blobs(self.bucket, prefix=prefix))
+        # The deletes are sent as batch requests instead of one HTTP call per object
+        for offset in range(0, len(blobs), GCS_BATCH_MAX_CALLS):
+            try:
+                with self.client.batch():
+                    for blob in blobs[offset:offset + GCS_BATCH_MAX_CALLS]:
+                        blob.delete()
+            except self._not_found:
+                # Objects deleted meanwhile by someone else, other failures are raised to the caller
+                pass
+        return len(blobs)
+
+class _AtomicFileWriter:
+    """Writes to a temporary file next to the target and renames it into place on a clean close."""
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.temporary_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        self._file = open(self.temporary_path, 'wb')
+
+    def write(self, data: bytes) -> int:
+        return self._file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._file.close()
+        if exc_type is None:
+            os.replace(self.temporary_path, self.path)
+        else:
+            self.temporary_path.unlink(missing_ok=True)
+
+class LocalStorageBackend(StorageBackend):
+    """Filesystem stand-in for GCS: every key is a file below the root directory."""
+
+    def __init__(self, root: str):
+        self.root = Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Initialized local storage backend in: {self.root}")
+
+    def _path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if self.root not in path.parents:
+            raise ValueError(f"Key {key} escapes the storage root")
+        return path
+
+    def uri(self, key: str) -> str:
+        return self._path(key).as_uri()
+
+    def key_from_uri(self, uri: str) -> str:
+        prefix = self.root.as_uri() + '/'
+        if not uri.startswith(prefix):
+            raise ValueError(f"URI {uri} does not belong to {self.root}")
+        return uri[len(prefix):]
+
+    def put_bytes(self, key: str, data: bytes, content_type: Optional[str] = None):
+        with self.open_write(key, content_type) as destination:
+            destination.write(data)
+
+    def create_if_absent(self, key: str, data: bytes) -> bool:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(path, 'xb') as destination:
+                destination.write(data)
+            return True
+        except FileExistsError:
+            return False
+
+    def get_bytes(self, key: str) -> bytes:
+        return self._path(key).read_bytes()
+
+    def open_read(self, key: str) -> BinaryIO:
+        return open(self._path(key), 'rb')
+
+    def open_write(self, key: str, content_type: Optional[str] = None) -> BinaryIO:
+        return _AtomicFileWriter(self._path(key))
+
+    def list_keys(self, prefix: str) -> List[str]:
+        parent = prefix.rpartition('/')[0]
+        base = self._path(parent) if parent else self.root
+        if not base.is_dir():
+            return []
+        keys = (path.relative_to(self.root).as_posix() for path in base.rglob('*') if path.is_file())
+        return sorted(key for key in keys if key.startswith(prefix) and not key.endswith('.tmp'))
+
+    def list_prefixes(self) -> List[str]:
+        return sorted(path.name for path in self.root.iterdir() if path.is_dir())
+
+    def compose(self, source_keys: List[str], destination_key: str, content_type: Optional[str] = None):
+        with self.open_write(destination_key) as destination:
+            for key in source_keys:
+                with self.open_read(key) as source:
+                    shutil.copyfileobj(source, destination, STREAM_CHUNK_BYTES)
+
+    def stat(self, key: str) -> Optional[ObjectInfo]:
+        try:
+            stat_result = self._path(key).stat()
+        except FileNotFoundError:
+            return None
+        return ObjectInfo(size=stat_result.st_size, etag=f"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}")
+
+    def exists(self, key: str) -> bool:
+        return self._path(key).is_file()
+
+    def move(self, source_key: str, destination_key: str):
+        destination = self._path(destination_key)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(self._path(source_key), destination)
+
+    def delete(self, key: str):
+        self._path(key).unlink(missing_ok=True)
+
+    def delete_prefix(self, prefix: str) -> int:
+        # Only the directory holding the prefix needs to be walked
+        parent = prefix.rpartition('/')[0]
+        base = self._path(parent) if parent else self.root
+        if not base.is_dir():
+            return 0
+        deleted = 0
+        # Children come before their parents, so emptied directories can be removed too
+        paths = sorted(base.rglob('*'), reverse=True) + ([base] if base != self.root else [])
+        for path in paths:
+            key = path.relative_to(self.root).as_posix()
+            if path.is_file() and key.startswith(prefix):
+                path.unlink(missing_ok=True)
+                deleted += 1
+            elif path.is_dir() and (key + '/').startswith(prefix) and not any(path.iterdir()):
+                path.rmdir()
+        return deleted
+
+# Singleton instance for the backend
+_storage_backend_instance = None
+
+def get_storage_backend() -> StorageBackend:
+    global _storage_backend_instance
+    if _storage_backend_instance is None:
+        if STORAGE_BACKEND == 'local':
+            _storage_backend_instance = LocalStorageBackend(LOCAL_STORAGE_ROOT)
+        elif STORAGE_BACKEND == 'gcs':
+            _storage_backend_instance = GCSStorageBackend(BUCKET_NAME)
+        else:
+            raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return _storage_backend_instance
+
+def _reset_after_fork():
+    # HTTP sessions must not be shared with a forked child, it creates its own client on first use
+    global _storage_backend_instance
+    _storage_backend_instance = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,135 @@
+# token_cache.py
+# Keeps firebase ID token verification off the hot path: verified tokens are cached (keyed on their
+# SHA-256, never the token itself) until their own 'exp', and the Google signing certificates are
+# refreshed by a background thread instead of being fetched during a request.
+
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+import requests
+from google.auth import jwt
+from firebase_admin import auth
+
+logger = logging.getLogger(__name__)
+
+ID_TOKEN_CERT_URI = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+ID_TOKEN_ISSUER_PREFIX = 'https://securetoken.google.com/'
+CERTS_REFRESH_SECONDS = 3600
+CERTS_RETRY_SECONDS = 60
+CLOCK_SKEW_SECONDS = 10
+
+class FirebaseCertificates:
+    """Google's current token signing certificates, refreshed in the background."""
+
+    def __init__(self, refresh_seconds: int = CERTS_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._certs: Dict[str, str] = {}
+        self._refresh_now = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresh_forever, name='firebase-certs-refresh', daemon=True)
+            self._thread.start()
+
+    def _refresh_forever(self):
+        while True:
+            wait_seconds = self.refresh_seconds
+            try:
+                response = requests.get(ID_TOKEN_CERT_URI, timeout=10)
+                response.raise_for_status()
+                self._certs = response.json()
+                # Google rotates the keys well before max-age expires, refreshing at half of it is enough
+                cache_control = response.headers.get('Cache-Control', '')
+                for directive in cache_control.split(','):
+                    name, _, value = directive.strip().partition('=')
+                    if name == 'max-age' and value.isdigit():
+                        wait_seconds = max(min(int(value) // 2, self.refresh_seconds), CERTS_RETRY_SECONDS)
+            except Exception as e:
+                logger.warning(f"Could not refresh firebase signing certificates: {e}")
+                wait_seconds = CERTS_RETRY_SECONDS
+            self._refresh_now.wait(wait_seconds)
+            self._refresh_now.clear()
+
+    def get(self, key_id: str) -> Optional[str]:
+        cert = self._certs.get(key_id)
+        if cert is None:
+            # Unknown key id: probably a rotation, ask for an early refresh
+            self._refresh_now.set()
+        return cert
+
+def make_firebase_verifier(project_id: Optional[str], certificates: FirebaseCertificates) -> Callable[[str], dict]:
+    """
+    Verifies ID tokens locally against the cached certificates (signature, exp/iat, aud, iss, sub),
+    the same checks auth.verify_id_token does without revocation checking. Falls back to
+    auth.verify_id_token when the project id or the signing certificate is not known.
+    """
+    def verify(id_token: str) -> dict:
+        if project_id:
+            header = jwt.decode_header(id_token)
+            cert = certificates.get(header.get('kid')) if header.get('alg') == 'RS256' else None
+            if cert is not None:
+                claims = jwt.decode(id_token, certs=cert, audience=project_id, clock_skew_in_seconds=CLOCK_SKEW_SECONDS)
+                subject = claims.get('sub')
+                if claims.get('iss') != ID_TOKEN_ISSUER_PREFIX + project_id:
+                    raise ValueError("ID token has an incorrect issuer")
+                if not isinstance(subject, str) or not subject or len(subject) > 128:
+                    raise ValueError("ID token has an invalid subject")
+                claims['uid'] = subject
+                return claims
+        return auth.verify_id_token(id_token)
+    return verify
+
+class VerifiedTokenCache:
+    """Bounded, thread-safe LRU of token hash -> (uid, plan, exp)."""
+
+    def __init__(self, verify: Callable[[str], dict], max_entries: int = 10000):
+        self.verify = verify
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[bytes, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_user(self, id_token: str) -> Tuple[str, Optional[str]]:
+        """
+        Returns the uid and the 'plan' custom claim (None when unset) of a valid token,
+        raises like the verifier for invalid ones (which are never cached).
+        """
+        key = hashlib.sha256(id_token.encode('utf-8')).digest()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                uid, plan, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return uid, plan
+                del self._entries[key]
+            self.misses += 1
+
+        claims = self.verify(id_token)
+        with self._lock:
+            self._entries[key] = (claims['uid'], claims.get('plan'), float(claims['exp']))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return claims['uid'], claims.get('plan')
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None
+            }
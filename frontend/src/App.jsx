@@ -2,8 +2,9 @@
 import React, { useState, useEffect, useCallback } from 'react';
 import { LogOut, Lock, User } from 'lucide-react';
 import useAuth from './hooks/useAuth';
-import { uploadFile, getFiles, anonymizeData, downloadFile, checkJobStatus, deleteFile } from './services/api';
+import { uploadFile, uploadFileInParts, CHUNKED_UPLOAD_THRESHOLD, getFiles, anonymizeData, downloadFile, watchJobStatus, deleteFile } from './services/api';
 import { objectsToRows } from './utils/dataTransformers';
+import { compressForUpload } from './utils/compression';
 import Dashboard from './components/Dashboard';
 import UploadData from './components/UploadData';
 import ConfigureAnonymization from './components/ConfigureAnonymization';
@@ -30,7 +31,7 @@ const AnonimaData = () => {
     dataProtected: 0
   });
   const [jobId, setJobId] = useState(null);
-  const [pollingInterval, setPollingInterval] = useState(null);
+  const [statusWatcher, setStatusWatcher] = useState(null);
   const [processingMessage, setProcessingMessage] = useState('');
   const [showDeleteModal, setShowDeleteModal] = useState(false);
   const [currentPreviewFilename, setCurrentPreviewFilename] = useState('');
@@ -101,63 +102,66 @@ const AnonimaData = () => {
     }
   }, [user, loadStats]);
 
-  // Poll job status for processing and anonymization
+  // Watch job status for processing and anonymization (long-poll, the server answers when the job changes)
   const startPolling = useCallback((jobId) => {
     setJobId(jobId);
     setProcessingStatus('processing');
     setProcessingMessage('Analyzing your dataset...');
 
-    const interval = setInterval(async () => {
-      try {
-        const response = await checkJobStatus(jobId);
-        setErrorMessage(null);
-        setCurrentPreviewFilename(null);
-        if (response.status === 'analyzed') {
-          setProcessingStatus('completed');
-          setProcessingMessage('Analysis completed successfully!');
-          const columns = response.processed_data_info?.columns || response.columns || [];
-          const rows = objectsToRows(response.processed_data_preview || response.sample || [], columns);
-          setDataPreview({ columns, rows });
-          clearInterval(interval);
-          setPollingInterval(null);
-          setCurrentView('configure');
-        } else if (response.status === 'anonymized' || response.status === 'completed') {
-          setProcessingStatus('completed');
-          setProcessingMessage('Anonymization completed successfully!');
-          const columns = response.columns || [];
-          const anonymizedData = response.anonymized_preview || [];
-          const rows = objectsToRows(anonymizedData, columns);
-          setAnonymizedPreview({ columns, rows });
-          setCurrentPreviewFilename(response.fileName);
-          clearInterval(interval);
-          setPollingInterval(null);
-          loadStats();
-          setCurrentView('preview');
-        } else if (response.status === 'error') {
-          setProcessingStatus('error');
-          setProcessingMessage(response.details || 'An error occurred during processing');
-          setErrorMessage(response.error_message || 'An error occurred');
-          clearInterval(interval);
-          setPollingInterval(null);
-        } else {
-          setProcessingMessage(response.details || 'Processing your data...');
-        }
-      } catch (error) {
-        console.error('Polling error:', error);
-        setProcessingMessage('Checking status...');
+    const watcher = watchJobStatus(jobId, (response) => {
+      setErrorMessage(null);
+      setCurrentPreviewFilename(null);
+      if (response.status === 'analyzed') {
+        setProcessingStatus('completed');
+        setProcessingMessage('Analysis completed successfully!');
+        const columns = response.processed_data_info?.columns || response.columns || [];
+        const rows = objectsToRows(response.processed_data_preview || response.sample || [], columns);
+        // Per-column stats from the analysis, used as cardinality hints for QI selection
+        const columnStats = Object.fromEntries(
+          (Array.isArray(response.metadata) ? response.metadata : [])
+            .filter(col => col.stats)
+            .map(col => [col.column_name, col.stats])
+        );
+        setDataPreview({ columns, rows, columnStats });
+        watcher.close();
+        setStatusWatcher(null);
+        setCurrentView('configure');
+      } else if (response.status === 'anonymized' || response.status === 'completed') {
+        setProcessingStatus('completed');
+        setProcessingMessage('Anonymization completed successfully!');
+        const columns = response.columns || [];
+        const anonymizedData = response.anonymized_preview || [];
+        const rows = objectsToRows(anonymizedData, columns);
+        setAnonymizedPreview({ columns, rows });
+        setCurrentPreviewFilename(response.fileName);
+        watcher.close();
+        setStatusWatcher(null);
+        loadStats();
+        setCurrentView('preview');
+      } else if (response.status === 'error') {
+        setProcessingStatus('error');
+        setProcessingMessage(response.details || 'An error occurred during processing');
+        setErrorMessage(response.error_message || 'An error occurred');
+        watcher.close();
+        setStatusWatcher(null);
+      } else {
+        setProcessingMessage(response.details || 'Processing your data...');
       }
-    }, 1000);
+    }, (error) => {
+      console.error('Polling error:', error);
+      setProcessingMessage('Checking status...');
+    });
 
-    setPollingInterval(interval);
+    setStatusWatcher(watcher);
   }, [loadStats]);
 
   useEffect(() => {
     return () => {
-      if (pollingInterval) {
-        clearInterval(pollingInterval);
+      if (statusWatcher) {
+        statusWatcher.close();
       }
     };
-  }, [pollingInterval]);
+  }, [statusWatcher]);
 
   // Reset state when switching to upload view
   useEffect(() => {
@@ -170,19 +174,22 @@ const AnonimaData = () => {
       setAnonymizedPreview(null);
       setJobId(null);
       setProcessingStatus('idle');
-      if (pollingInterval) {
-        clearInterval(pollingInterval);
-        setPollingInterval(null);
+      if (statusWatcher) {
+        statusWatcher.close();
+        setStatusWatcher(null);
       }
     }
-  }, [currentView, pollingInterval]);
+  }, [currentView, statusWatcher]);
 
   // Handle file upload
 const handleFileUpload = async (event) => {
   const file = event.target.files[0];
   if (file) {
     const validTypes = ['text/csv', 'application/json'];
-    const validExtensions = ['.csv', '.json'];
+    const validExtensions = [
+      '.csv', '.txt', '.xlsx', '.xls', '.json', '.jsonl', '.ndjson',
+      '.gz', '.zst', '.zip'
+    ];
     const fileType = file.type;
     const fileName = file.name.toLowerCase();
     const hasValidType = validTypes.includes(fileType);
@@ -191,11 +198,16 @@ const handleFileUpload = async (event) => {
     if (hasValidType || hasValidExtension) {
       setUploadedFile(file);
 
-      const formData = new FormData();
-      formData.append('file', file);
-
       try {
-        const response = await uploadFile(formData);
+        const uploadBody = await compressForUpload(file);
+        let response;
+        if (uploadBody.size > CHUNKED_UPLOAD_THRESHOLD) {
+          response = await uploadFileInParts(uploadBody);
+        } else {
+          const formData = new FormData();
+          formData.append('file', uploadBody);
+          response = await uploadFile(formData);
+        }
         if (response.job_id) {
           startPolling(response.job_id);
           setCurrentView('processing');
@@ -386,8 +398,8 @@ const handleFileUpload = async (event) => {
             processingMessage={processingMessage}
             errorMessage={errorMessage}
             jobId={jobId}
-            pollingInterval={pollingInterval}
-            setPollingInterval={setPollingInterval}
+            statusWatcher={statusWatcher}
+            setStatusWatcher={setStatusWatcher}
             setCurrentView={setCurrentView}
             setProcessingStatus={setProcessingStatus}
           />
@@ -34,6 +34,12 @@ const ConfigureAnonymization = ({
                 <tr key={column} className="border-b border-gray-100 hover:bg-gray-50">
                   <td className="py-4 px-4">
                     <div className="font-medium text-gray-900">{column}</div>
+                    {dataPreview.columnStats?.[column] && (
+                      <div className="text-xs text-gray-500">
+                        ~{dataPreview.columnStats[column].distinct_estimate} distinct values
+                        {dataPreview.columnStats[column].null_count > 0 && `, ${dataPreview.columnStats[column].null_count} empty`}
+                      </div>
+                    )}
                   </td>
                   <td className="py-4 px-4 text-center">
                     <input
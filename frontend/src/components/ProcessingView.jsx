@@ -7,15 +7,15 @@ const ProcessingView = ({
   errorMessage,
   uploadProgress,
   jobId,
-  pollingInterval,
-  setPollingInterval,
+  statusWatcher,
+  setStatusWatcher,
   setCurrentView,
   setProcessingStatus 
 }) => {
   const handleCancel = () => {
-    if (pollingInterval) {
-      clearInterval(pollingInterval);
-      setPollingInterval(null);
+    if (statusWatcher) {
+      statusWatcher.close();
+      setStatusWatcher(null);
     }
     setCurrentView('dashboard');
     setProcessingStatus('idle');
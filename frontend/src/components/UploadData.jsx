@@ -10,11 +10,11 @@ const UploadData = ({ handleFileUpload, uploadedFile }) => {
         <div className="border-2 border-dashed border-gray-300 rounded-lg p-12 text-center hover:border-blue-400 transition-colors">
           <Upload className="w-12 h-12 text-gray-400 mx-auto mb-4" />
           <h3 className="text-lg font-medium text-gray-900 mb-2">Upload your dataset</h3>
-          <p className="text-gray-500 mb-4">Support for CSV and JSON files up to 100MB</p>
+          <p className="text-gray-500 mb-4">Support for CSV, Excel, JSON and NDJSON files up to 100MB, also gzip, zstd or zip compressed</p>
 
           <input
             type="file"
-            accept=".csv,.json"
+            accept=".csv,.txt,.xlsx,.xls,.json,.jsonl,.ndjson,.gz,.zst,.zip"
             onChange={handleFileUpload}
             className="hidden"
             id="file-upload"
@@ -18,10 +18,12 @@ const getAuthHeader = async () => {
   };
 }
 
-// Check job status (analysis and anonymization)
-export const checkJobStatus = async (jobId) => {
+// Check job status (analysis and anonymization).
+// With `since` (a job version) the server holds the request until the job changes or a timeout expires.
+export const checkJobStatus = async (jobId, since = null) => {
   try {
-    const analysisResponse = await fetch(`${API_BASE_URL}/get_status/${jobId}`, {
+    const query = since !== null && since !== undefined ? `?since=${since}&wait=25` : '';
+    const analysisResponse = await fetch(`${API_BASE_URL}/get_status/${jobId}${query}`, {
       method: 'GET',
       headers: {
         'Content-Type': 'application/json',
@@ -44,6 +46,7 @@ export const checkJobStatus = async (jobId) => {
         }
         return {
           status: 'analyzed',
+          version: analysisData.version,
           job_id: jobId,
           columns,
           sample: analysisData.processed_data_preview || [],
@@ -57,6 +60,7 @@ export const checkJobStatus = async (jobId) => {
 
         return {
           status: 'anonymized',
+          version: analysisData.version,
           job_id: jobId,
           columns: column,
           anonymized_preview: analysisData.anonymized_preview,
@@ -67,6 +71,7 @@ export const checkJobStatus = async (jobId) => {
       // If analysis is still in progress
       return {
         status: analysisData.status,
+        version: analysisData.version,
         job_id: jobId,
         progress: analysisData.progress,
         details: analysisData.details,
@@ -79,6 +84,36 @@ export const checkJobStatus = async (jobId) => {
   }
 };
 
+// Follow a job until the caller closes the watcher: every status is passed to onStatus,
+// each request waits server-side for a version newer than the last one seen
+export const watchJobStatus = (jobId, onStatus, onError) => {
+  let closed = false;
+  let version = null;
+
+  const loop = async () => {
+    while (!closed) {
+      try {
+        const response = await checkJobStatus(jobId, version);
+        if (closed) break;
+        if (!response) throw new Error('Empty status response');
+        onStatus(response);
+        if (response.version === undefined) {
+          // Server without long-poll support: fall back to polling every second
+          await new Promise(resolve => setTimeout(resolve, 1000));
+        }
+        version = response.version ?? version;
+      } catch (error) {
+        if (closed) break;
+        if (onError) onError(error);
+        await new Promise(resolve => setTimeout(resolve, 1000));
+      }
+    }
+  };
+  loop();
+
+  return { close: () => { closed = true; } };
+};
+
 // File upload function
 export const uploadFile = async (formData) => {
   const headers = await getAuthHeader();
@@ -95,6 +130,60 @@ export const uploadFile = async (formData) => {
   return response.json();
 };
 
+// Files above this size are sent as numbered parts, so a failed part can be retried without restarting the upload
+export const CHUNKED_UPLOAD_THRESHOLD = 32 * 1024 * 1024;
+const UPLOAD_PART_SIZE = 16 * 1024 * 1024;
+const UPLOAD_PART_RETRIES = 3;
+
+// Chunked upload: open a session, send the missing parts, then ask the server to assemble them
+export const uploadFileInParts = async (file) => {
+  const startResponse = await fetch(`${API_BASE_URL}/uploads`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      ...(await getAuthHeader()),
+    },
+    body: JSON.stringify({ filename: file.name })
+  });
+  if (!startResponse.ok) {
+    throw new Error(`Upload failed: ${startResponse.status}`);
+  }
+  const { job_id: jobId, max_part_bytes: maxPartBytes } = await startResponse.json();
+  const partSize = Math.min(UPLOAD_PART_SIZE, maxPartBytes || UPLOAD_PART_SIZE);
+  const partsCount = Math.ceil(file.size / partSize);
+
+  for (let partNumber = 1; partNumber <= partsCount; partNumber++) {
+    const part = file.slice((partNumber - 1) * partSize, partNumber * partSize);
+    for (let attempt = 1; ; attempt++) {
+      const partResponse = await fetch(`${API_BASE_URL}/uploads/${jobId}/parts/${partNumber}`, {
+        method: 'PUT',
+        headers: {
+          'Content-Type': 'application/octet-stream',
+          ...(await getAuthHeader()),
+        },
+        body: part
+      }).catch(() => null);
+      if (partResponse && partResponse.ok) break;
+      if (attempt >= UPLOAD_PART_RETRIES) {
+        throw new Error(`Upload of part ${partNumber} failed`);
+      }
+    }
+  }
+
+  const completeResponse = await fetch(`${API_BASE_URL}/uploads/${jobId}/complete`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      ...(await getAuthHeader()),
+    },
+    body: JSON.stringify({ parts: partsCount })
+  });
+  if (!completeResponse.ok) {
+    throw new Error(`Upload failed: ${completeResponse.status}`);
+  }
+  return completeResponse.json();
+};
+
 // Data anonymization function
 export const anonymizeData = async (params) => {
   const headers = {
@@ -149,19 +238,34 @@ export const downloadFile = async (jobId) => {
   return response.blob();
 };
 
-// Get files function
+// Get files function: pages are fetched with the cursor returned by the previous one (previews are not needed here)
+const FILES_PAGE_SIZE = 200;
+
 export const getFiles = async () => {
   const headers = await getAuthHeader();
-  const response = await fetch(`${API_BASE_URL}/get_files`, {
-    method: 'GET',
-    headers,
-  });
+  let data = null;
+  let cursor = null;
+  do {
+    const query = `limit=${FILES_PAGE_SIZE}` + (cursor ? `&cursor=${encodeURIComponent(cursor)}` : '');
+    const response = await fetch(`${API_BASE_URL}/get_files?${query}`, {
+      method: 'GET',
+      headers,
+    });
 
-  if (!response.ok) {
-    throw new Error(`Get files failed: ${response.status}`);
-  }
+    if (!response.ok) {
+      throw new Error(`Get files failed: ${response.status}`);
+    }
 
-  const data = await response.json();
+    const page = await response.json();
+    if (data === null || !Array.isArray(page)) {
+      // The first page carries the stats
+      data = page;
+    } else {
+      const filesObj = data.find(item => item.files);
+      filesObj.files.push(...(page.find(item => item.files)?.files || []));
+    }
+    cursor = Array.isArray(page) ? page.find(item => item.next_cursor)?.next_cursor : null;
+  } while (cursor);
   console.log('Get files response:', data);
 
   // New structure: array with two objects, one with stats, one with files
@@ -0,0 +1,14 @@
+// Plain text datasets compress very well: gzip them in the browser before uploading
+const COMPRESSIBLE_EXTENSIONS = ['.csv', '.txt', '.json', '.jsonl', '.ndjson'];
+
+export const compressForUpload = async (file) => {
+  const fileName = file.name.toLowerCase();
+  const isCompressible = COMPRESSIBLE_EXTENSIONS.some(ext => fileName.endsWith(ext));
+  if (!isCompressible || typeof CompressionStream === 'undefined') {
+    return file;
+  }
+
+  const compressedStream = file.stream().pipeThrough(new CompressionStream('gzip'));
+  const compressedBlob = await new Response(compressedStream).blob();
+  return new File([compressedBlob], `${file.name}.gz`, { type: 'application/gzip' });
+};
@@ -164,7 +164,7 @@ resource "google_project_iam_member" "orchestratore_run_invoker" {
   member  = "serviceAccount:${google_service_account.orchestratore_service_account.email}"
 }
 
-# IAM per formatter (pubsub)
+# IAM per formatter (pubsub, storage)
 resource "google_project_iam_member" "formatter_pubsub_publisher" {
   project = var.project
   role    = "roles/pubsub.publisher"
@@ -177,7 +177,14 @@ resource "google_project_iam_member" "formatter_pubsub_subscriber" {
   member  = "serviceAccount:${google_service_account.formatter_service_account.email}"
 }
 
-# IAM per anonymizer (pubsub)
+# Claim-check payloads are written and read directly on the bucket
+resource "google_project_iam_member" "formatter_storage" {
+  project = var.project
+  role    = "roles/storage.objectAdmin"
+  member  = "serviceAccount:${google_service_account.formatter_service_account.email}"
+}
+
+# IAM per anonymizer (pubsub, storage)
 resource "google_project_iam_member" "anonymizer_pubsub_publisher" {
   project = var.project
   role    = "roles/pubsub.publisher"
@@ -190,6 +197,12 @@ resource "google_project_iam_member" "anonymizer_pubsub_subscriber" {
   member  = "serviceAccount:${google_service_account.anonymizer_service_account.email}"
 }
 
+resource "google_project_iam_member" "anonymizer_storage" {
+  project = var.project
+  role    = "roles/storage.objectAdmin"
+  member  = "serviceAccount:${google_service_account.anonymizer_service_account.email}"
+}
+
 # IAM per frontend (solo invocazione orchestratore)
 resource "google_project_iam_member" "frontend_run_invoker" {
   project = var.project
@@ -211,6 +224,13 @@ resource "google_cloud_run_service_iam_member" "anonymizer_invoker" {
   member   = "serviceAccount:${google_service_account.anonymizer_service_account.email}"
 }
 
+resource "google_cloud_run_service_iam_member" "anonymizer_large_invoker" {
+  service  = google_cloud_run_v2_service.anonymizer_large.name
+  location = var.region
+  role     = "roles/run.invoker"
+  member   = "serviceAccount:${google_service_account.anonymizer_service_account.email}"
+}
+
 # === Pub/Sub Topics e Subscription per orchestrazione servizi ===
 
 # Orchestratore -> Formatter
@@ -223,6 +243,9 @@ resource "google_pubsub_subscription" "formatter_input_sub" {
   name  = "formatter-input-sub"
   topic = google_pubsub_topic.formatter_input.name
 
+  # Push requests run the whole job: without a long ack deadline Pub/Sub redelivers them while they are still processed
+  ack_deadline_seconds = 600
+
   push_config {
     push_endpoint = google_cloud_run_v2_service.formatter.uri
     oidc_token {
@@ -240,6 +263,7 @@ resource "google_pubsub_topic" "formatter_output" {
 resource "google_pubsub_subscription" "formatter_output_sub" {
   name  = "formatter-output-sub"
   topic = google_pubsub_topic.formatter_output.name
+  ack_deadline_seconds = 60
   push_config {
     push_endpoint = "${google_cloud_run_v2_service.orchestratore.uri}/receive_analysis_results"
     oidc_token {
@@ -258,6 +282,9 @@ resource "google_pubsub_subscription" "anonymizer_input_sub" {
   name  = "anonymizer-input-sub"
   topic = google_pubsub_topic.anonymizer_input.name
 
+  # Push requests run the whole job: without a long ack deadline Pub/Sub redelivers them while they are still processed
+  ack_deadline_seconds = 600
+
   push_config {
     push_endpoint = google_cloud_run_v2_service.anonymizer.uri
     oidc_token {
@@ -266,6 +293,27 @@ resource "google_pubsub_subscription" "anonymizer_input_sub" {
   }
 }
 
+# Orchestratore -> Anonymizer, large lane: jobs over var.large_job_rows or var.large_job_bytes,
+# processed by their own throughput-oriented instances so they never queue ahead of small jobs
+resource "google_pubsub_topic" "anonymizer_input_large" {
+  name = "anonymizer-input-large-topic"
+  depends_on = [google_project_service.pubsub]
+}
+
+resource "google_pubsub_subscription" "anonymizer_input_large_sub" {
+  name  = "anonymizer-input-large-sub"
+  topic = google_pubsub_topic.anonymizer_input_large.name
+
+  ack_deadline_seconds = 600
+
+  push_config {
+    push_endpoint = google_cloud_run_v2_service.anonymizer_large.uri
+    oidc_token {
+      service_account_email = google_service_account.anonymizer_service_account.email
+    }
+  }
+}
+
 # Anonymizer -> Orchestratore
 resource "google_pubsub_topic" "anonymizer_output" {
   name = "anonymizer-output-topic"
@@ -276,6 +324,7 @@ resource "google_pubsub_subscription" "anonymizer_output_sub" {
   name  = "anonymizer-output-sub"
   topic = google_pubsub_topic.anonymizer_output.name
 
+  ack_deadline_seconds = 60
   push_config {
     push_endpoint = "${google_cloud_run_v2_service.orchestratore.uri}/receive_anonymization_results"
     oidc_token {
@@ -294,6 +343,7 @@ resource "google_pubsub_subscription" "error_informations_sub" {
   name = "error-information-sub"
   topic = google_pubsub_topic.error_informations.name
 
+  ack_deadline_seconds = 60
   push_config {
     push_endpoint = "${google_cloud_run_v2_service.orchestratore.uri}/receive_error_notifications"
     oidc_token {
@@ -302,6 +352,14 @@ resource "google_pubsub_subscription" "error_informations_sub" {
   }
 }
 
+# Requests each instance can actually process at once (see gunicorn.conf.py in each service):
+# the CPU-bound formatter and anonymizer run one sync worker per CPU, the I/O-bound orchestrator
+# runs a single gthread worker with orchestrator_threads threads
+locals {
+  worker_cpus          = 1
+  orchestrator_threads = 80
+}
+
 resource "google_cloud_run_v2_service" "anonymizer" {
   name     = "anonymizer"
   location = var.region
@@ -329,15 +387,82 @@ resource "google_cloud_run_v2_service" "anonymizer" {
         name  = "ERROR_INFORMATIONS_TOPIC"
         value = google_pubsub_topic.error_informations.name
       }
+      env {
+        name  = "BUCKET_NAME"
+        value = google_storage_bucket.csv_bucket.name
+      }
       resources {
         limits = {
           memory = "1Gi"
-          cpu    = "1"
+          cpu    = tostring(local.worker_cpus)
         }
       }
     }
+    # Small lane: warm instances keep its queue wait within var.small_lane_queue_wait_slo_seconds
+    scaling {
+      min_instance_count = var.anonymizer_small_min_instances
+    }
     timeout = "300s"
-    max_instance_request_concurrency = 1000
+    max_instance_request_concurrency = local.worker_cpus
+    execution_environment = "EXECUTION_ENVIRONMENT_GEN2"
+  }
+
+  traffic {
+    percent = 100
+    type    = "TRAFFIC_TARGET_ALLOCATION_TYPE_LATEST"
+  }
+
+  depends_on = [google_project_service.run]
+}
+
+# Same image as the anonymizer, sized for throughput: more CPU and memory per instance, long requests
+resource "google_cloud_run_v2_service" "anonymizer_large" {
+  name     = "anonymizer-large"
+  location = var.region
+
+  template {
+    service_account = google_service_account.anonymizer_service_account.email
+    vpc_access {
+      connector = google_vpc_access_connector.connector.id
+      egress    = "ALL_TRAFFIC"
+    }
+    containers {
+      image = "gcr.io/${var.project}/anonymizer:latest"
+      ports {
+        container_port = 8080
+      }
+      env {
+        name  = "GOOGLE_CLOUD_PROJECT_ID"
+        value = var.project
+      }
+      env {
+        name  = "ANONYMIZER_OUTPUT_TOPIC"
+        value = google_pubsub_topic.anonymizer_output.name
+      }
+      env {
+        name  = "ERROR_INFORMATIONS_TOPIC"
+        value = google_pubsub_topic.error_informations.name
+      }
+      env {
+        name  = "BUCKET_NAME"
+        value = google_storage_bucket.csv_bucket.name
+      }
+      env {
+        name  = "GUNICORN_TIMEOUT"
+        value = "3600"
+      }
+      resources {
+        limits = {
+          memory = var.anonymizer_large_memory
+          cpu    = tostring(var.anonymizer_large_cpus)
+        }
+      }
+    }
+    scaling {
+      max_instance_count = var.anonymizer_large_max_instances
+    }
+    timeout = "3600s"
+    max_instance_request_concurrency = var.anonymizer_large_cpus
     execution_environment = "EXECUTION_ENVIRONMENT_GEN2"
   }
 
@@ -376,15 +501,19 @@ resource "google_cloud_run_v2_service" "formatter" {
         name  = "ERROR_INFORMATIONS_TOPIC"
         value = google_pubsub_topic.error_informations.name
       }
+      env {
+        name  = "BUCKET_NAME"
+        value = google_storage_bucket.csv_bucket.name
+      }
       resources {
         limits = {
           memory = "1Gi"
-          cpu    = "1"
+          cpu    = tostring(local.worker_cpus)
         }
       }
     }
     timeout = "300s"
-    max_instance_request_concurrency = 1000
+    max_instance_request_concurrency = local.worker_cpus
     execution_environment = "EXECUTION_ENVIRONMENT_GEN2"
   }
 
@@ -480,6 +609,22 @@ resource "google_cloud_run_v2_service" "orchestratore" {
         name  = "ANONYMIZER_INPUT_TOPIC"
         value = google_pubsub_topic.anonymizer_input.name
       }
+      env {
+        name  = "ANONYMIZER_INPUT_LARGE_TOPIC"
+        value = google_pubsub_topic.anonymizer_input_large.name
+      }
+      env {
+        name  = "LARGE_JOB_ROWS"
+        value = tostring(var.large_job_rows)
+      }
+      env {
+        name  = "LARGE_JOB_BYTES"
+        value = tostring(var.large_job_bytes)
+      }
+      env {
+        name  = "SMALL_LANE_QUEUE_WAIT_SLO_SECONDS"
+        value = tostring(var.small_lane_queue_wait_slo_seconds)
+      }
       env {
         name  = "GOOGLE_CLOUD_PROJECT_ID"
         value = var.project
@@ -488,6 +633,10 @@ resource "google_cloud_run_v2_service" "orchestratore" {
         name  = "GOOGLE_CLOUD_REGION"
         value = var.region
       }
+      env {
+        name  = "GUNICORN_THREADS"
+        value = tostring(local.orchestrator_threads)
+      }
       resources {
         limits = {
           memory = "1Gi"
@@ -499,7 +648,7 @@ resource "google_cloud_run_v2_service" "orchestratore" {
       max_instance_count = 5
     }
     timeout = "300s"
-    max_instance_request_concurrency = 1000
+    max_instance_request_concurrency = local.orchestrator_threads
     execution_environment = "EXECUTION_ENVIRONMENT_GEN2"
   }
 
@@ -557,6 +706,11 @@ output "anonymizer_input_topic" {
   value = google_pubsub_topic.anonymizer_input.name
 }
 
+output "anonymizer_input_large_topic" {
+  description = "Nome del topic input per l'anonymizer, lane dei job grandi"
+  value = google_pubsub_topic.anonymizer_input_large.name
+}
+
 output "anonymizer_output_topic" {
   description = "Nome del topic output per l'anonymizer"
   value = google_pubsub_topic.anonymizer_output.name
@@ -0,0 +1,566 @@
+# local_harness.py
+# End-to-end run of the whole pipeline on one machine, without GCP: the orchestrator, the formatter and
+# the anonymizer are loaded in this process (their shared modules are identical, so one copy serves all
+# three), Pub/Sub push subscriptions are replaced by an in-memory bus that POSTs push envelopes to the
+# Flask apps from per-topic thread pools, storage is a local directory, the database SQLite (or a local
+# Postgres via --database-url) and the client uses the noauth routes. N synthetic jobs are driven
+# concurrently through upload, analysis, anonymization and download, then the end-to-end and per-stage
+# throughput and latency percentiles are reported. Per-stage timings come from the services' own
+# Prometheus instrumentation (metrics.py).
+#
+# The services share one interpreter, so CPU-bound stages contend for the GIL: absolute numbers are lower
+# than on Cloud Run, the harness is meant to compare runs of the same machine (before/after a change).
+#
+# Usage: python stressTests/local_harness.py --jobs 50 --concurrency 10 --rows 5000 [--json report.json] [--max-p95 30]
+
+import os
+import io
+import sys
+import csv
+import json
+import time
+import uuid
+import base64
+import random
+import shutil
+import filecmp
+import logging
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+# Orchestrator first: its modules are the only ones not shared with the workers
+SERVICE_DIRS = ('orchestratore', 'formatter', 'anonymizer')
+SHARED_MODULES = ('google_pubsub_manager.py', 'storage_backend.py', 'metrics.py')
+TOPICS = {
+    'FORMATTER_INPUT_TOPIC': 'data-upload-requests',
+    'FORMATTER_OUTPUT_TOPIC': 'analysis-results',
+    'ANONYMIZER_INPUT_TOPIC': 'anonymization-requests',
+    'ANONYMIZER_INPUT_LARGE_TOPIC': 'anonymization-requests-large',
+    'ANONYMIZER_OUTPUT_TOPIC': 'anonymization-results',
+    'ERROR_INFORMATIONS_TOPIC': 'error-notifications'
+}
+# Same payloads as the k6 stress tests, on the columns of the synthetic dataset
+ANONYMIZATION_REQUESTS = [
+    {"method": "differential-privacy", "params": {"epsilon": 0.5}},
+    {"method": "l-diversity", "params": {"k": 4, "l": 2}},
+    {"method": "k-anonymity", "params": {"k": 5}}
+]
+USER_SELECTIONS = [
+    {"column_name": "birth", "is_quasi_identifier": True, "should_anonymize": True},
+    {"column_name": "email", "is_quasi_identifier": True, "should_anonymize": True},
+    {"column_name": "age", "is_quasi_identifier": True, "should_anonymize": True},
+    {"column_name": "alias", "is_quasi_identifier": False, "should_anonymize": False}
+]
+NAMES = ['Laura', 'Alberto', 'Giulia', 'Marco', 'Sara', 'Luca', 'Chiara', 'Paolo', 'Elena', 'Davide']
+ALIASES = ['RedOtter', 'FirePanther', 'BlueFox', 'SilentOwl', 'IronWolf', 'GreenLynx']
+DOMAINS = ['gmail.com', 'yahoo.it', 'libero.it', 'outlook.com']
+PUSH_MAX_ATTEMPTS = 5
+STATUS_WAIT_SECONDS = 30
+MAX_RETRY_AFTER_SECONDS = 30
+
+logger = logging.getLogger('local_harness')
+
+def percentile(ordered, fraction):
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def summarize(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0}
+    return {
+        'count': len(ordered),
+        'total_seconds': round(sum(ordered), 3),
+        'p50_seconds': round(percentile(ordered, 0.50), 4),
+        'p95_seconds': round(percentile(ordered, 0.95), 4),
+        'p99_seconds': round(percentile(ordered, 0.99), 4),
+        'max_seconds': round(ordered[-1], 4)
+    }
+
+def synthetic_csv(rows: int, seed: int) -> bytes:
+    """Rows shaped like stressTests/testFile.csv; a different seed per job keeps the anonymization cache out of the measure."""
+    rng = random.Random(seed)
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['id', 'name', 'birth', 'cellphone', 'email', 'alias', 'age'])
+    for row_id in range(1, rows + 1):
+        name = rng.choice(NAMES)
+        birth_year = rng.randint(1950, 2006)
+        writer.writerow([
+            row_id, name, f"{birth_year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            f"{rng.randint(3000000000, 3999999999)}", f"{name.lower()}.{rng.randint(1, 9999)}@{rng.choice(DOMAINS)}",
+            rng.choice(ALIASES), 2025 - birth_year
+        ])
+    return out.getvalue().encode('utf-8')
+
+def excel_bytes(columns: dict) -> bytes:
+    import pandas as pd
+    out = io.BytesIO()
+    pd.DataFrame(columns).to_excel(out, index=False)
+    return out.getvalue()
+
+# Chunk size of the structuring check: the datasets below span several chunks
+CHECK_CHUNK_ROWS = 4
+# (filename, content, expected dtypes once read back from the Parquet file, expected rows)
+STRUCTURING_CASES = [
+    # The first chunk holds only integers, the float column must not be written as int64
+    ('integers_then_floats.csv', lambda: b'v\n1\n2\n3\n4\n0.5\n', {'v': 'float64'}, 5),
+    # Integer columns read as int64 in the first chunk and as float64 (a null) in the next one
+    ('null_in_a_later_chunk.csv', lambda: b'id,v\n1,1\n2,2\n3,3\n4,4\n5,\n', {'id': 'Int64', 'v': 'Int64'}, 5),
+    ('datetime_gap_in_a_later_chunk.xlsx', lambda: excel_bytes({
+        'day': ['2020-01-0%d' % day for day in range(1, 6)] + [None], 'n': list(range(6))
+    }), {'day': 'object', 'n': 'Int64'}, 6),
+    ('datetimes.xlsx', lambda: excel_bytes({
+        'at': [datetime(2020, 1, day, 12) for day in range(1, 6)] + [None]
+    }), {'at': 'datetime64[ns]'}, 6),
+    # A JSON array whose length is a multiple of the chunk size ends exactly at a chunk boundary
+    ('chunk_multiple.json', lambda: json.dumps([{'id': i, 'name': f'n{i}'} for i in range(2 * CHECK_CHUNK_ROWS)]).encode('utf-8'),
+     {'id': 'Int64', 'name': 'object'}, 2 * CHECK_CHUNK_ROWS),
+    # Records with different keys: a key only in a later chunk and one missing from a later chunk
+    ('mixed_keys.json', lambda: json.dumps([{'id': i, 'name': f'n{i}'} for i in range(CHECK_CHUNK_ROWS)]
+                                           + [{'id': 4, 'score': 1.5}, {'id': 5, 'name': 'n5', 'score': 2}]).encode('utf-8'),
+     {'id': 'Int64', 'name': 'object', 'score': 'float64'}, CHECK_CHUNK_ROWS + 2),
+    ('mixed_keys.ndjson', lambda: b''.join(json.dumps(record).encode('utf-8') + b'\n' for record in
+                                           [{'id': i} for i in range(CHECK_CHUNK_ROWS)] + [{'id': 4, 'score': 0.5}]),
+     {'id': 'Int64', 'score': 'float64'}, CHECK_CHUNK_ROWS + 1),
+]
+
+def check_chunked_structuring() -> Optional[str]:
+    """
+    Structures small datasets whose chunks get different dtypes from the readers and reads the Parquet
+    file back (formatter's dataAnalyzer, loaded by load_services). Returns what went wrong, None when
+    every case gave the expected dtypes and rows.
+    """
+    import pandas as pd
+    import dataAnalyzer
+    problems = []
+    for filename, content, dtypes, rows in STRUCTURING_CASES:
+        try:
+            data = content()
+            sink = io.BytesIO()
+            _, structured_rows = dataAnalyzer.structure_dataset_chunks(lambda encoding: dataAnalyzer.iter_dataset_chunks(
+                io.BytesIO(data), filename, chunk_rows=CHECK_CHUNK_ROWS, encoding=encoding), sink)
+            df = pd.read_parquet(io.BytesIO(sink.getvalue()))
+            read_dtypes = {column: str(dtype) for column, dtype in df.dtypes.items()}
+            if read_dtypes != dtypes or structured_rows != rows or len(df) != rows:
+                problems.append(f"{filename}: {len(df)} rows {read_dtypes}, expected {rows} rows {dtypes}")
+        except Exception as e:
+            problems.append(f"{filename}: {type(e).__name__}: {e}")
+    return '; '.join(problems) or None
+
+def configure_environment(work_dir: Path, database_url: str):
+    """Local stand-ins for the cloud services; variables already set in the environment win."""
+    os.environ.setdefault('GOOGLE_CLOUD_PROJECT_ID', 'local-harness')
+    for name, topic in TOPICS.items():
+        os.environ.setdefault(name, topic)
+    os.environ.setdefault('STORAGE_BACKEND', 'local')
+    os.environ.setdefault('LOCAL_STORAGE_ROOT', str(work_dir / 'storage'))
+    os.environ.setdefault('DATABASE_URL', database_url or f"sqlite:///{work_dir / 'jobs.db'}")
+    # Job changes are notified in process, there is no other orchestrator instance to LISTEN for
+    os.environ.setdefault('JOB_EVENTS_LISTENER', 'false')
+    # One process: samples go to the default registry
+    os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+
+def check_shared_modules():
+    """The services are loaded side by side, which is only correct while their shared modules are identical."""
+    for name in SHARED_MODULES:
+        copies = [BACKEND_DIR / service / name for service in SERVICE_DIRS]
+        if not all(filecmp.cmp(copies[0], copy, shallow=False) for copy in copies[1:]):
+            raise RuntimeError(f"{name} differs between the services, copy it again to all of them")
+
+class StageRecorder:
+    """
+    Stands in for a labelled histogram of metrics.py, keeping every observation for exact percentiles.
+    Observations are still forwarded to the real histogram, so /metrics keeps working.
+    """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        recorder = self
+        key = tuple(sorted(labels.items()))
+        real = self.histogram.labels(**labels)
+
+        class Observer:
+            def observe(self, value):
+                real.observe(value)
+                with recorder._lock:
+                    recorder.samples[key].append(value)
+        return Observer()
+
+    def snapshot(self):
+        with self._lock:
+            return {key: list(values) for key, values in self.samples.items()}
+
+class PushBus:
+    """
+    In-memory Pub/Sub with push subscriptions. publish() has the signature of GooglePubSubManager.publish
+    (payloads are attached the same way, large ones through storage) and every message is POSTed as a push
+    envelope to the endpoint subscribed to its topic, from that topic's pool of delivery threads. Like
+    Pub/Sub, a delivery answered with an error status is retried.
+    """
+
+    def __init__(self, attach_payload):
+        self.attach_payload = attach_payload
+        self.subscriptions = {}
+        self.published = defaultdict(int)
+        self.redeliveries = 0
+        self.failed_deliveries = 0
+        self._pending = 0
+        self._idle = threading.Condition()
+
+    def subscribe(self, topic_id: str, app, path: str, concurrency: int):
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"push-{topic_id}")
+        self.subscriptions[topic_id] = (app, path, executor)
+
+    def publish(self, topic_id, data, attributes=None, payloads=None):
+        if topic_id not in self.subscriptions:
+            raise ValueError(f"No subscription for topic {topic_id}")
+        message_id = str(uuid.uuid4())
+        if payloads:
+            data = dict(data)
+            for name, content in payloads.items():
+                data.update(self.attach_payload(name, content, data.get('job_id'), message_id))
+        message = json.dumps({"message_id": message_id, "timestamp": datetime.now().isoformat(), "data": data})
+        envelope = {
+            "message": {
+                "data": base64.b64encode(message.encode('utf-8')).decode('ascii'),
+                "attributes": attributes or {},
+                "messageId": message_id,
+                "publish_time": datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            },
+            "subscription": f"projects/local-harness/subscriptions/{topic_id}-push"
+        }
+        with self._idle:
+            self.published[topic_id] += 1
+            self._pending += 1
+        app, path, executor = self.subscriptions[topic_id]
+        executor.submit(self._deliver, app, path, envelope)
+        return message_id
+
+    def _deliver(self, app, path, envelope):
+        try:
+            for attempt in range(1, PUSH_MAX_ATTEMPTS + 1):
+                try:
+                    status = app.test_client().post(path, json=envelope).status_code
+                except Exception as e:
+                    logger.error(f"Push to {path} raised: {e}", exc_info=True)
+                    status = 500
+                if 200 <= status < 300:
+                    return
+                with self._idle:
+                    self.redeliveries += 1
+                time.sleep(min(2 ** attempt * 0.1, 5))
+            with self._idle:
+                self.failed_deliveries += 1
+        finally:
+            with self._idle:
+                self._pending -= 1
+                self._idle.notify_all()
+
+    def wait_idle(self, timeout: float) -> bool:
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def shutdown(self):
+        for _, _, executor in self.subscriptions.values():
+            executor.shutdown(wait=True)
+
+def load_services(worker_concurrency: int):
+    """Imports the three services wired to the in-memory bus, returns (bus, orchestrator, stage recorders)."""
+    for service in reversed(SERVICE_DIRS):
+        sys.path.insert(0, str(BACKEND_DIR / service))
+
+    # Auth bypass: the client uses the noauth routes, Firebase is never contacted
+    import firebase_admin
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    import token_cache
+    token_cache.FirebaseCertificates.start = lambda self: None
+
+    import google_pubsub_manager
+    bus = PushBus(google_pubsub_manager.attach_payload)
+    google_pubsub_manager.get_pubsub_manager = lambda: bus
+
+    import metrics
+    recorders = {
+        'stages': StageRecorder(metrics.STAGE_SECONDS),
+        'queue': StageRecorder(metrics.QUEUE_TO_START_SECONDS)
+    }
+    metrics.STAGE_SECONDS = recorders['stages']
+    metrics.QUEUE_TO_START_SECONDS = recorders['queue']
+
+    import orchestrator_service
+    import analysis_service
+    import anonymization_service
+
+    topics = google_pubsub_manager.Topics
+    bus.subscribe(topics.DATA_UPLOAD_REQUESTS, analysis_service.app, '/', worker_concurrency)
+    bus.subscribe(topics.ANONYMIZATION_REQUESTS, anonymization_service.app, '/', worker_concurrency)
+    bus.subscribe(topics.ANONYMIZATION_REQUESTS_LARGE, anonymization_service.app, '/', worker_concurrency)
+    # The orchestrator endpoints only update the database and move artifacts, they get a wider pool
+    for topic, path in ((topics.ANALYSIS_RESULTS, '/receive_analysis_results'),
+                        (topics.ANONYMIZATION_RESULTS, '/receive_anonymization_results'),
+                        (topics.ERROR_NOTIFICATIONS, '/receive_error_notifications')):
+        bus.subscribe(topic, orchestrator_service.app, path, worker_concurrency * 4)
+    return bus, orchestrator_service.app, recorders
+
+class JobDriver:
+    """One synthetic user: uploads a dataset, waits for its analysis, anonymizes it and downloads the result."""
+
+    def __init__(self, app, rows: int, timeout: float, download: bool):
+        self.app = app
+        self.rows = rows
+        self.timeout = timeout
+        self.download = download
+        self.rejections = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def _admitted(self, send):
+        """Sends a request until it is admitted, waiting the Retry-After of each 429/503 like a well-behaved client."""
+        while True:
+            response = send()
+            if response.status_code not in (429, 503):
+                return response
+            with self._lock:
+                self.rejections[response.status_code] += 1
+            time.sleep(min(float(response.headers.get('Retry-After', 1)), MAX_RETRY_AFTER_SECONDS))
+
+    def _wait_for(self, client, job_id: str, statuses, deadline: float) -> dict:
+        version = -1
+        while time.monotonic() < deadline:
+            response = client.get(f'/noauth_get_status/{job_id}?since={version}&wait={STATUS_WAIT_SECONDS}')
+            if response.status_code != 200:
+                raise RuntimeError(f"Status of job {job_id}: HTTP {response.status_code}")
+            status = response.json
+            if status['status'] == 'error':
+                raise RuntimeError(f"Job {job_id} failed: {status.get('error_message')}")
+            if status['status'] in statuses:
+                return status
+            version = status['version']
+        raise TimeoutError(f"Job {job_id} not {'/'.join(statuses)} after {self.timeout}s")
+
+    def run(self, index: int) -> dict:
+        client = self.app.test_client()
+        timings = {}
+        started = time.monotonic()
+        deadline = started + self.timeout
+        dataset = synthetic_csv(self.rows, seed=index)
+        request = ANONYMIZATION_REQUESTS[index % len(ANONYMIZATION_REQUESTS)]
+        try:
+            response = self._admitted(lambda: client.post('/noauth_upload_and_analyze', data={
+                'file': (io.BytesIO(dataset), f'harness_{index}.csv')
+            }))
+            if response.status_code != 202:
+                raise RuntimeError(f"Upload: HTTP {response.status_code} {response.get_data(as_text=True)}")
+            job_id = response.json['job_id']
+            uploaded = time.monotonic()
+            timings['upload'] = uploaded - started
+
+            self._wait_for(client, job_id, ('analyzed',), deadline)
+            analyzed = time.monotonic()
+            timings['analysis'] = analyzed - uploaded
+
+            response = self._admitted(lambda: client.post('/noauth_request_anonymization', json={
+                'job_id': job_id, 'user_selections': USER_SELECTIONS, **request
+            }))
+            if response.status_code != 202:
+                raise RuntimeError(f"Anonymization request: HTTP {response.status_code} {response.get_data(as_text=True)}")
+            self._wait_for(client, job_id, ('anonymized',), deadline)
+            anonymized = time.monotonic()
+            timings['anonymization'] = anonymized - analyzed
+
+            if self.download:
+                response = client.get(f'/noauth_download/{job_id}')
+                if response.status_code != 200:
+                    raise RuntimeError(f"Download: HTTP {response.status_code}")
+                response.get_data()
+                response.close()
+                timings['download'] = time.monotonic() - anonymized
+            timings['end_to_end'] = time.monotonic() - started
+            return {'job_id': job_id, 'method': request['method'], 'timings': timings, 'error': None}
+        except Exception as e:
+            return {'job_id': None, 'method': request['method'], 'timings': timings, 'error': str(e)}
+
+    def check_cache_reuse(self) -> Optional[str]:
+        """
+        Uploads the same dataset twice and sends the same k-anonymity request for both: the second one
+        must be served from the anonymization cache and counted as a hit on /metrics. Returns what went
+        wrong, None when it was reused.
+        """
+        client = self.app.test_client()
+        deadline = time.monotonic() + self.timeout
+        dataset = synthetic_csv(self.rows, seed=-1)
+        request = {'job_id': None, 'user_selections': USER_SELECTIONS, **ANONYMIZATION_REQUESTS[2]}
+        try:
+            hits_before = self._metric_value(client, 'anonimadata_anonymization_cache_hits_total')
+            job_ids = []
+            for copy in range(2):
+                response = self._admitted(lambda: client.post('/noauth_upload_and_analyze', data={
+                    'file': (io.BytesIO(dataset), f'harness_cache_{copy}.csv')
+                }))
+                job_ids.append(response.json['job_id'])
+            for job_id in job_ids:
+                self._wait_for(client, job_id, ('analyzed',), deadline)
+            first, second = job_ids
+            self._admitted(lambda: client.post('/noauth_request_anonymization', json=dict(request, job_id=first)))
+            self._wait_for(client, first, ('anonymized',), deadline)
+            response = self._admitted(lambda: client.post('/noauth_request_anonymization', json=dict(request, job_id=second)))
+            if not response.json.get('cached'):
+                return f"The repeated request was not served from the cache: {response.get_data(as_text=True)}"
+            self._wait_for(client, second, ('anonymized',), deadline)
+            hits = self._metric_value(client, 'anonimadata_anonymization_cache_hits_total') - hits_before
+            if hits != 1:
+                return f"/metrics counted {hits:g} anonymization cache hits instead of 1"
+            return None
+        except Exception as e:
+            return str(e)
+
+    @staticmethod
+    def _metric_value(client, name: str) -> float:
+        for line in client.get('/metrics').get_data(as_text=True).splitlines():
+            if line.startswith(f"{name} "):
+                return float(line.split()[1])
+        return 0.0
+
+def build_report(results, wall_seconds: float, rows: int, bus: PushBus, driver: JobDriver, recorders) -> dict:
+    completed = [result for result in results if result['error'] is None]
+    phases = defaultdict(list)
+    for result in completed:
+        for phase, seconds in result['timings'].items():
+            phases[phase].append(seconds)
+
+    stages = {}
+    for key, samples in sorted(recorders['stages'].snapshot().items()):
+        labels = dict(key)
+        stage = stages.setdefault(labels['stage'], {'samples': [], 'errors': 0})
+        stage['samples'].extend(samples)
+        if labels['outcome'] != 'ok':
+            stage['errors'] += len(samples)
+    return {
+        'jobs': len(results),
+        'completed': len(completed),
+        'failed': len(results) - len(completed),
+        'errors': sorted({result['error'] for result in results if result['error']})[:20],
+        'wall_seconds': round(wall_seconds, 3),
+        'jobs_per_second': round(len(completed) / wall_seconds, 3),
+        'rows_per_second': round(len(completed) * rows / wall_seconds, 1),
+        'phases': {phase: summarize(samples) for phase, samples in phases.items()},
+        'stages': {
+            name: dict(summarize(stage['samples']), errors=stage['errors'],
+                       per_second=round(len(stage['samples']) / wall_seconds, 3))
+            for name, stage in stages.items()
+        },
+        'queue_to_start': {dict(key)['lane']: summarize(samples) for key, samples in recorders['queue'].snapshot().items()},
+        'messages': {
+            'published': dict(bus.published),
+            'redeliveries': bus.redeliveries,
+            'failed_deliveries': bus.failed_deliveries
+        },
+        'admission_rejections': {str(status): count for status, count in driver.rejections.items()}
+    }
+
+def print_report(report: dict):
+    print(f"\nJobs: {report['completed']}/{report['jobs']} completed, {report['failed']} failed in {report['wall_seconds']}s "
+          f"({report['jobs_per_second']} jobs/s, {report['rows_per_second']} rows/s)")
+    for error in report['errors']:
+        print(f"  error: {error}")
+
+    header = f"{'':<20}{'count':>8}{'per sec':>10}{'p50 s':>10}{'p95 s':>10}{'p99 s':>10}{'max s':>10}"
+    def row(name, summary, per_second=''):
+        if not summary['count']:
+            return f"{name:<20}{0:>8}"
+        return (f"{name:<20}{summary['count']:>8}{per_second:>10}{summary['p50_seconds']:>10}{summary['p95_seconds']:>10}"
+                f"{summary['p99_seconds']:>10}{summary['max_seconds']:>10}")
+
+    print("\nPhases (client side)")
+    print(header)
+    for phase in ('upload', 'analysis', 'anonymization', 'download', 'end_to_end'):
+        if phase in report['phases']:
+            print(row(phase, report['phases'][phase]))
+
+    print("\nStages (services' metrics)")
+    print(header + f"{'errors':>8}")
+    for name, summary in sorted(report['stages'].items(), key=lambda item: -item[1]['total_seconds']):
+        print(row(name, summary, summary['per_second']) + f"{summary['errors']:>8}")
+
+    if report['queue_to_start']:
+        print("\nQueue to start, per lane (analyses count in the small one)")
+        print(header)
+        for lane, summary in report['queue_to_start'].items():
+            print(row(lane, summary))
+
+    print(f"\nMessages: {report['messages']}")
+    print(f"Admission rejections: {report['admission_rejections'] or 'none'}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the AnonimaData pipeline locally and measure its throughput and latency.')
+    parser.add_argument('--jobs', type=int, default=20, help='Synthetic jobs to run')
+    parser.add_argument('--concurrency', type=int, default=5, help='Jobs in flight at the same time')
+    parser.add_argument('--rows', type=int, default=1000, help='Rows of each synthetic dataset')
+    parser.add_argument('--worker-concurrency', type=int, default=os.cpu_count() or 1,
+                        help='Concurrent push deliveries to the formatter and to each anonymizer lane (their instance concurrency)')
+    parser.add_argument('--database-url', help='e.g. a local Postgres; default SQLite in the work directory')
+    parser.add_argument('--work-dir', help='Storage and database directory; default a temporary one, removed at the end')
+    parser.add_argument('--job-timeout', type=float, default=600, help='Seconds after which a job counts as failed')
+    parser.add_argument('--no-download', action='store_true', help='Skip the download of the anonymized files')
+    parser.add_argument('--json', help='Also write the report to this file, e.g. to compare runs')
+    parser.add_argument('--max-p95', type=float, help='Exit with status 1 when the end-to-end p95 exceeds these seconds (or a job fails)')
+    parser.add_argument('--check-cache', action='store_true',
+                        help='After the run, check that a repeated identical request is served from the anonymization cache')
+    parser.add_argument('--check-structuring', action='store_true',
+                        help='After the run, structure small multi-chunk datasets whose chunks differ in dtypes and check the Parquet output')
+    parser.add_argument('--verbose', action='store_true', help="Keep the services' INFO logs")
+    args = parser.parse_args()
+
+    check_shared_modules()
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix='anonimadata-harness-'))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    configure_environment(work_dir, args.database_url)
+    # Configured before the services, whose own basicConfig is then a no-op: they log every message they receive
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    bus, orchestrator_app, recorders = load_services(args.worker_concurrency)
+
+    driver = JobDriver(orchestrator_app, args.rows, args.job_timeout, download=not args.no_download)
+    print(f"Running {args.jobs} jobs of {args.rows} rows, {args.concurrency} at a time (work directory: {work_dir})")
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix='job') as executor:
+        results = list(executor.map(driver.run, range(args.jobs)))
+    wall_seconds = time.monotonic() - started
+    # Redeliveries and late messages of failed jobs must not be counted in the next run
+    bus.wait_idle(timeout=60)
+
+    report = build_report(results, wall_seconds, args.rows, bus, driver, recorders)
+    print_report(report)
+    cache_error = driver.check_cache_reuse() if args.check_cache else None
+    if args.check_cache:
+        print(f"\nAnonymization cache reuse: {cache_error or 'ok'}")
+    structuring_error = check_chunked_structuring() if args.check_structuring else None
+    if args.check_structuring:
+        print(f"\nChunked structuring: {structuring_error or 'ok'}")
+    bus.wait_idle(timeout=60)
+    bus.shutdown()
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    end_to_end = report['phases'].get('end_to_end', {})
+    if args.max_p95 is not None and (report['failed'] or end_to_end.get('p95_seconds', float('inf')) > args.max_p95):
+        print(f"\nFAILED: end-to-end p95 {end_to_end.get('p95_seconds')}s (limit {args.max_p95}s), {report['failed']} failed jobs")
+        sys.exit(1)
+    if cache_error or structuring_error:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
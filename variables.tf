@@ -17,4 +17,47 @@ variable "db_password" {
 variable "vpc_network" {
   description = "Self link or name of the VPC network for Cloud SQL private IP"
   type        = string
-}
\ No newline at end of file
+}
+
+# Anonymization lanes: jobs over either threshold (known after analysis) go to the large lane
+variable "large_job_rows" {
+  description = "Rows above which an anonymization job is routed to the large lane"
+  type        = number
+  default     = 1000000
+}
+
+variable "large_job_bytes" {
+  description = "Analyzed dataset size in bytes above which an anonymization job is routed to the large lane"
+  type        = number
+  default     = 104857600
+}
+
+variable "small_lane_queue_wait_slo_seconds" {
+  description = "Latency objective for the queue wait of small anonymization jobs"
+  type        = number
+  default     = 10
+}
+
+variable "anonymizer_small_min_instances" {
+  description = "Warm anonymizer instances kept for the small lane, so small jobs do not wait for a cold start"
+  type        = number
+  default     = 1
+}
+
+variable "anonymizer_large_cpus" {
+  description = "CPUs (and concurrent jobs) of each large lane anonymizer instance"
+  type        = number
+  default     = 2
+}
+
+variable "anonymizer_large_memory" {
+  description = "Memory of each large lane anonymizer instance"
+  type        = string
+  default     = "8Gi"
+}
+
+variable "anonymizer_large_max_instances" {
+  description = "Upper bound on large lane anonymizer instances"
+  type        = number
+  default     = 3
+}